@@ -0,0 +1,84 @@
+"""
+Grouped statistics of image values, computed in SQL.
+
+Images are grouped by the values of run parameters (?group_by=TOF,evap), and
+for each group the count, mean, std (sample), min and max of image values are
+returned (?values=total_atoms,settings.fudge), in a single query.
+Values are Image columns (total_atoms, pixel_size) or numeric keys of the
+settings and stats JSON fields: settings.<key>, stats.<key>. Values which
+aren't numbers are ignored. Bad shots are excluded unless ?bad_shots=include.
+"""
+from django.contrib.postgres.fields.jsonb import KeyTransform
+from django.db.models import Avg, Count, F, Max, Min, StdDev
+from rest_framework.exceptions import ParseError
+from rest_framework.response import Response
+
+from api.filters import JSONNumber, filter_parameters
+
+
+AGGREGATE_COLUMNS = ['total_atoms', 'pixel_size']
+AGGREGATE_JSON_FIELDS = ['settings', 'stats']
+AGGREGATE_STATISTICS = {'count': Count, 'mean': Avg, 'std': lambda expression: StdDev(expression, sample=True),
+                        'min': Min, 'max': Max}
+DEFAULT_AGGREGATE_VALUES = ['total_atoms']
+
+
+def value_expression(name):
+    # Expression of an image value: a column, or <json field>.<key>
+    if name in AGGREGATE_COLUMNS:
+        return F(name)
+    field, _, key = name.partition('.')
+    if field in AGGREGATE_JSON_FIELDS and key:
+        return JSONNumber(field, key)
+    raise ParseError(detail='Cannot aggregate %s: use one of %s, or settings.<key>, stats.<key>' % (
+                name, ', '.join(AGGREGATE_COLUMNS)))
+
+
+def split_param(value):
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+
+def aggregate_images(queryset, group_by, values):
+    """
+    List of groups: {'parameters': {key: value}, 'count': images, <value>: {'count', 'mean', 'std', 'min', 'max'}}
+    for the images in queryset grouped by the run parameters in group_by, ordered by the group values
+    """
+    groups = {'_group_%d' % i: KeyTransform(key, 'run__parameters') for i, key in enumerate(group_by)}
+    aggregates = {'_count': Count('id')}
+    for i, name in enumerate(values):
+        expression = value_expression(name)
+        for statistic, function in AGGREGATE_STATISTICS.items():
+            aggregates['_value_%d_%s' % (i, statistic)] = function(expression)
+
+    if groups:
+        # Explicit order_by: the model ordering mustn't end up in the GROUP BY
+        rows = queryset.annotate(**groups).values(*groups).annotate(**aggregates).order_by(*groups)
+    else:
+        rows = [queryset.aggregate(**aggregates)]
+    result = []
+    for row in rows:
+        group = {
+            'parameters': {key: row['_group_%d' % i] for i, key in enumerate(group_by)},
+            'count': row['_count'],
+        }
+        for i, name in enumerate(values):
+            group[name] = {statistic: row['_value_%d_%s' % (i, statistic)] for statistic in AGGREGATE_STATISTICS}
+        result.append(group)
+    return result
+
+
+def aggregate_response(queryset, request):
+    """
+    Response with the grouped statistics of the images in queryset, from the request's
+    group_by, values, bad_shots and param.<key> filters
+    """
+    group_by = split_param(request.query_params.get('group_by'))
+    values = split_param(request.query_params.get('values')) or DEFAULT_AGGREGATE_VALUES
+    if request.query_params.get('bad_shots', 'exclude') != 'include':
+        queryset = queryset.exclude(bad_shot=True)
+    queryset = filter_parameters(queryset, request.query_params, field='run__parameters')
+    return Response({
+        'group_by': group_by,
+        'values': values,
+        'groups': aggregate_images(queryset, group_by, values),
+    })
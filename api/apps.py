@@ -3,3 +3,11 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from api.cache import connect_invalidation_signals
+        connect_invalidation_signals()
+        from api.summaries import connect_summary_signals
+        connect_summary_signals()
+        from breadboard.db.health import connect_health_checks
+        connect_health_checks()
@@ -0,0 +1,200 @@
+"""
+Native ASGI handlers, for the requests which mostly wait.
+
+Under ASGI (breadboard/asgi.py) the Django views run in executor, a pool of
+BREADBOARD_ASGI_THREADS threads, one thread per request in progress. Long-polls
+and server-sent event streams of the live feed wait for up to minutes, so they
+are served here on the event loop instead: a waiting subscriber costs a
+coroutine, not a thread, woken up by the poller of api.livefeed.broker. Their
+queries of the database run in the pool, closing stale connections around them
+as Django does around requests. Same cursors as api.views.feedviews.LiveFeedView.
+
+These responses don't go through the Django middleware: they authenticate as
+the api does, also with a ?token= parameter for EventSource which can't send
+headers, and send the CORS headers of django-cors-headers (cors_headers).
+"""
+import asyncio
+import functools
+import json
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from importlib import import_module
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY, HASH_SESSION_KEY
+from django.contrib.auth.models import User
+from django.db import close_old_connections
+from django.utils.crypto import constant_time_compare
+from rest_framework.authtoken.models import Token
+
+from rest_framework.exceptions import ParseError
+
+from api.models import Lab
+from api.livefeed import broker, decode_cursor, encode_cursor
+from api.views.feedviews import POLL_TIMEOUT, SSE_HEARTBEAT, SSE_DURATION, SSE_RETRY, sse_message
+
+
+executor = ThreadPoolExecutor(max_workers=getattr(settings, 'BREADBOARD_ASGI_THREADS', 16),
+                              thread_name_prefix='asgi')
+
+
+def database_sync_to_async(func):
+    """
+    func run in executor, with the stale database connections of the thread
+    closed before and after it (as on request_started and request_finished)
+    """
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(run, thread_sensitive=False, executor=executor)
+
+
+def is_live_feed(scope):
+    # Long-poll and server-sent event requests of the live feed
+    if scope['type'] != 'http' or scope['method'] != 'GET' or scope['path'] != '/feed/':
+        return False
+    return query_params(scope).get('mode', 'poll') in ('poll', 'sse')
+
+
+def query_params(scope):
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    return {key: values[-1] for key, values in query.items()}
+
+
+def headers(scope):
+    return {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+
+
+def authenticate(request_headers, params):
+    """
+    Same credentials as the api: a token, or the session cookie of the browsable
+    api. EventSource can't set headers: the token can be sent as ?token=<key>.
+    """
+    keyword, _, key = request_headers.get('authorization', '').partition(' ')
+    if keyword != 'Token' or not key:
+        key = params.get('token')
+    if key:
+        token = Token.objects.select_related('user').filter(key=key.strip()).first()
+        return token.user if token is not None and token.user.is_active else None
+
+    cookie = SimpleCookie(request_headers.get('cookie', ''))
+    if settings.SESSION_COOKIE_NAME in cookie:
+        session = import_module(settings.SESSION_ENGINE).SessionStore(cookie[settings.SESSION_COOKIE_NAME].value)
+        user = User.objects.filter(pk=session.get(SESSION_KEY), is_active=True).first()
+        if user is not None and constant_time_compare(session.get(HASH_SESSION_KEY, ''), user.get_session_auth_hash()):
+            return user
+    return None
+
+
+def lab_id(name):
+    return Lab.objects.filter(name=name).values_list('id', flat=True).first()
+
+
+def cors_headers(request_headers):
+    """
+    Headers of django-cors-headers for the origin of the request, which these
+    responses don't go through the middleware for
+    """
+    origin = request_headers.get('origin')
+    allow_all = getattr(settings, 'CORS_ORIGIN_ALLOW_ALL', False)
+    if not origin or not (allow_all or origin in getattr(settings, 'CORS_ORIGIN_WHITELIST', [])):
+        return []
+    credentials = getattr(settings, 'CORS_ALLOW_CREDENTIALS', False)
+    cors = [(b'access-control-allow-origin', b'*' if allow_all and not credentials else origin.encode('latin-1'))]
+    if credentials:
+        cors.append((b'access-control-allow-credentials', b'true'))
+    if not allow_all or credentials:
+        cors.append((b'vary', b'origin'))
+    return cors
+
+
+async def send_json(send, status, data, cors=()):
+    body = json.dumps(data).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())] + list(cors),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def live_feed(scope, receive, send):
+    params = query_params(scope)
+    request_headers = headers(scope)
+    cors = cors_headers(request_headers)
+    user = await database_sync_to_async(authenticate)(request_headers, params)
+    if user is None:
+        return await send_json(send, 401, {'detail': 'Authentication credentials were not provided.'}, cors)
+    feed_lab = await database_sync_to_async(lab_id)(params.get('lab'))
+    if feed_lab is None:
+        return await send_json(send, 404, {'detail': 'Not found.'}, cors)
+    since = request_headers.get('last-event-id') or params.get('since')
+    try:
+        cursor = decode_cursor(since) if since else None
+        timeout = min(float(params.get('timeout', POLL_TIMEOUT)), POLL_TIMEOUT)
+    except ParseError as error:
+        return await send_json(send, 400, {'detail': str(error.detail)}, cors)
+    except ValueError:
+        return await send_json(send, 400, {'detail': 'timeout must be a number'}, cors)
+    feed = await database_sync_to_async(broker.feed)(feed_lab)
+    if cursor is None:
+        cursor = feed.current_cursor()
+    catch_up = database_sync_to_async(feed.catch_up)
+
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        if params.get('mode', 'poll') == 'poll':
+            events, cursor, more = await wait_for_events(feed, cursor, timeout, catch_up, disconnected)
+            return await send_json(send, 200, {'cursor': encode_cursor(cursor), 'more': more, 'events': events}, cors)
+        await stream_events(send, cors, feed, cursor, catch_up, disconnected)
+    finally:
+        disconnected.cancel()
+
+
+async def wait_for_events(feed, cursor, timeout, catch_up, disconnected):
+    # feed.wait_async, given up when the client disconnects
+    waiting = asyncio.ensure_future(feed.wait_async(cursor, timeout, catch_up))
+    await asyncio.wait([waiting, disconnected], return_when=asyncio.FIRST_COMPLETED)
+    if not waiting.done():
+        waiting.cancel()
+        return [], cursor, False
+    return waiting.result()
+
+
+async def stream_events(send, cors, feed, cursor, catch_up, disconnected):
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                    (b'x-accel-buffering', b'no')] + cors,
+    })
+
+    async def write(text):
+        await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': True})
+
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + SSE_DURATION
+    await write('retry: %d\n\n' % SSE_RETRY)
+    more = False
+    while not disconnected.done() and loop.time() < deadline:
+        timeout = 0 if more else min(SSE_HEARTBEAT, deadline - loop.time())
+        events, cursor, more = await wait_for_events(feed, cursor, timeout, catch_up, disconnected)
+        if events:
+            token = encode_cursor(cursor)
+            await write(''.join(sse_message(event, token) for event in events))
+        elif not disconnected.done():
+            await write(': keepalive\n\n')
+    await send({'type': 'http.response.body', 'body': b''})
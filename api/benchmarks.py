@@ -0,0 +1,215 @@
+"""
+Benchmarks for the image ingest and query paths.
+
+generate_lab fills a synthetic lab with runs, images and datasets, and
+run_benchmarks times every scenario through the api views, counting queries.
+Run them with `python manage.py benchmark`, which writes the results as JSON.
+"""
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api.models import Lab, Run, Image, Dataset
+from api.serializers import IMAGE_QUERY_MODES, RunSerializerList
+from api.renderers import ORJSONRenderer
+
+
+RUN_INTERVAL = 20 # seconds between synthetic runs
+
+
+def generate_lab(name, runs=1000, images=2000, parameter_keys=20, datasets=10, seed=0):
+    """
+    Create a lab with runs every RUN_INTERVAL seconds, images taken a second
+    after the runs, and the runs split between datasets.
+    """
+    rng = random.Random(seed)
+    lab = Lab.objects.create(name=name)
+    start = timezone.now() - timedelta(seconds=RUN_INTERVAL*runs)
+    dataset_objects = [Dataset.objects.create(name='%s dataset %d' % (name, i), lab=lab) for i in range(datasets)]
+
+    run_objects = [Run(
+                lab=lab,
+                runtime=start + timedelta(seconds=RUN_INTERVAL*i),
+                dataset=dataset_objects[i*datasets//runs] if datasets else None,
+                parameters={'param%d' % k: rng.choice([0, 1, 2.5, 10, 'on']) for k in range(parameter_keys)},
+            ) for i in range(runs)]
+    Run.objects.bulk_create(run_objects, batch_size=1000)
+
+    image_objects = [Image(
+                lab=lab,
+                run=run_objects[i % runs],
+                name='%s_image_%d' % (name, i),
+                created=run_objects[i % runs].runtime + timedelta(seconds=1, microseconds=i),
+                settings={'Isat': 100, 'fudge': 1},
+            ) for i in range(images)]
+    Image.objects.bulk_create(image_objects, batch_size=1000)
+    return lab
+
+
+def measure(name, func, repeat=5, items=1):
+    """
+    Time func over several repeats (after a warmup call), counting queries.
+    func returns a response, which must be successful. Responses are never
+    served from the response cache, which is left untouched.
+    """
+    times = []
+    queries = 0
+    with override_settings(BREADBOARD_RESPONSE_CACHE=False):
+        func() # warmup
+        for i in range(repeat):
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = func()
+                if hasattr(response, 'render'):
+                    response.render()
+                times.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                raise RuntimeError('%s failed with status %d' % (name, response.status_code))
+            queries = len(captured)
+    mean = statistics.mean(times)
+    return {
+        'name': name,
+        'repeat': repeat,
+        'min_ms': round(1000*min(times), 3),
+        'mean_ms': round(1000*mean, 3),
+        'median_ms': round(1000*statistics.median(times), 3),
+        'queries': queries,
+        'items': items,
+        'items_per_s': round(items/mean, 1) if mean else None,
+    }
+
+
+def call_view(user, viewset, actions, method, path, data=None, **kwargs):
+    factory = APIRequestFactory()
+    request = getattr(factory, method)(path, data)
+    force_authenticate(request, user=user, token=user.auth_token)
+    return viewset.as_view(actions)(request, **kwargs)
+
+
+def image_query_scenarios(user, lab, batch):
+    # One scenario per image query mode, plus ingest of new images
+    from api import views
+    images = list(lab.images.order_by('-created')[:batch])
+    names = ','.join(img.name for img in images)
+    created = ','.join(img.created.isoformat() for img in images)
+    window = {
+        'start_datetime': images[-1].created.isoformat(),
+        'end_datetime': images[0].created.isoformat(),
+    }
+    queries = {
+        'Quick': {'lab': lab.name},
+        'DateTimeRange': dict(window, lab=lab.name),
+        'Names': {'lab': lab.name, 'names': names},
+        'NamesCreated': {'lab': lab.name, 'names': names, 'created': created, 'force_match': 'True'},
+    }
+    assert set(queries)==set(IMAGE_QUERY_MODES)
+
+    scenarios = []
+    for mode, query in queries.items():
+        method = 'post' if mode=='NamesCreated' else 'get'
+        actions = {'post': 'create'} if method=='post' else {'get': 'list'}
+        scenarios.append(('images: ' + mode,
+                lambda method=method, actions=actions, query=query: call_view(
+                    user, views.ImageViewSet, actions, method, '/images/', query),
+                batch))
+
+    counter = iter(range(10**9))
+    def ingest():
+        # New names every call, so that images get created and matched
+        n = next(counter)
+        query = {
+            'lab': lab.name,
+            'names': ','.join('new_%d_%d' % (n, i) for i in range(batch)),
+            'created': created,
+        }
+        return call_view(user, views.ImageViewSet, {'post': 'create'}, 'post', '/images/', query)
+    scenarios.append(('images: ingest new', ingest, batch))
+    return scenarios
+
+
+def run_scenarios(user, lab, batch):
+    from api import views
+    runs = list(lab.runs.order_by('-runtime')[:batch])
+    window = {
+        'lab': lab.name,
+        'start_datetime': runs[-1].runtime.isoformat(),
+        'end_datetime': runs[0].runtime.isoformat(),
+    }
+    dataset = lab.datasets.first()
+    return [
+        ('runs: datetime range', lambda: call_view(
+            user, views.RunViewSet, {'get': 'list'}, 'get', '/runs/', window), batch),
+        ('runs: datetime range, cursor', lambda: call_view(
+            user, views.RunViewSet, {'get': 'list'}, 'get', '/runs/', dict(window, pagination='cursor')), batch),
+        ('datasets: list', lambda: call_view(
+            user, views.DatasetViewSet, {'get': 'list'}, 'get', '/datasets/', {'lab__name': lab.name}),
+            lab.datasets.count()),
+        ('datasets: list, counts', lambda: call_view(
+            user, views.DatasetViewSet, {'get': 'list'}, 'get', '/datasets/', {'lab__name': lab.name, 'related': 'count'}),
+            lab.datasets.count()),
+        ('datasets: retrieve', lambda: call_view(
+            user, views.DatasetViewSet, {'get': 'retrieve'}, 'get', '/datasets/%d/' % dataset.id, pk=str(dataset.id)),
+            dataset.runs.count()),
+    ]
+
+
+class Rendered:
+    # Stands in for a response in measure()
+    status_code = 200
+
+
+def renderer_scenarios(user, lab, batch):
+    # Rendering a page of runs with the stdlib json renderer and with orjson
+    request = Request(APIRequestFactory().get('/runs/'))
+    runs = lab.runs.all()[:batch]
+    data = RunSerializerList(runs, many=True, context={'request': request}).data
+    def render(renderer):
+        renderer.render(data, 'application/json', {})
+        return Rendered()
+    return [
+        ('render: runs, json', lambda: render(JSONRenderer()), batch),
+        ('render: runs, orjson', lambda: render(ORJSONRenderer()), batch),
+    ]
+
+
+def run_benchmarks(lab, repeat=5, batch=200, only=None):
+    """
+    Run all the scenarios against lab. Returns a list of results.
+    """
+    user, created = User.objects.get_or_create(username='breadboard-benchmark')
+    scenarios = (image_query_scenarios(user, lab, batch)
+                    + run_scenarios(user, lab, batch)
+                    + renderer_scenarios(user, lab, batch))
+    results = []
+    for name, func, items in scenarios:
+        if only and not any(pattern in name for pattern in only):
+            continue
+        results.append(measure(name, func, repeat=repeat, items=items))
+    return results
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Compare results with a baseline (both lists of results). Returns a list of
+    (name, ratio, regressed) for the scenarios in both, where ratio is the
+    ratio of mean times, and regressed flags slowdowns beyond threshold or more queries.
+    """
+    previous = {result['name']: result for result in baseline}
+    comparison = []
+    for result in results:
+        old = previous.get(result['name'])
+        if old is None:
+            continue
+        ratio = result['mean_ms'] / old['mean_ms'] if old['mean_ms'] else None
+        regressed = (ratio is not None and ratio > 1 + threshold) or result['queries'] > old['queries']
+        comparison.append((result['name'], ratio, regressed))
+    return comparison
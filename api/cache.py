@@ -0,0 +1,132 @@
+"""
+Server-side cache of api responses.
+
+Serialized response data is cached per viewset namespace, user, host and query
+string. Every namespace has a generation number which is part of the key:
+saving or deleting any model the namespace depends on bumps the generation,
+so stale entries are never read again (and expire on their own).
+
+Generations are bumped once the transaction commits, so a concurrent request
+can't cache the old rows under the new generation. Deleting a row also bumps
+the models whose foreign keys point to it: SET_NULL updates them without
+signals. The cache must be shared by every worker and instance, or the other
+processes never see the bump: responses are only cached when
+BREADBOARD_RESPONSE_CACHE is set, which it is by default for redis only.
+Cached responses are read from the primary: a lagging replica could return
+rows older than the generation they are cached under.
+"""
+import hashlib
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from rest_framework.response import Response
+
+from breadboard.db.routers import primary
+
+
+CACHE_TIMEOUT = getattr(settings, 'BREADBOARD_CACHE_TIMEOUT', 60*60*2)
+
+# Models that the responses of each namespace are built from
+CACHE_DEPENDENCIES = {
+    'lab': ('Lab', 'Project', 'UserProfile'),
+    'project': ('Project', 'Dataset'),
+    'dataset': ('Dataset', 'Run', 'DatasetSummary'),
+    'run': ('Run', 'Image'),
+    'image': ('Image', 'Run'),
+}
+
+
+def get_cache():
+    return caches['default']
+
+
+def generation_key(namespace):
+    return 'api:generation:' + namespace
+
+
+def get_generation(namespace):
+    cache = get_cache()
+    generation = cache.get(generation_key(namespace))
+    if generation is None:
+        # Start from the clock, so an evicted generation never comes back
+        cache.add(generation_key(namespace), int(time.time()*1000), None)
+        generation = cache.get(generation_key(namespace), 0)
+    return generation
+
+
+def invalidate(*model_names):
+    # Bump the generation of every namespace that depends on the given models
+    cache = get_cache()
+    for namespace, dependencies in CACHE_DEPENDENCIES.items():
+        if any(name in dependencies for name in model_names):
+            try:
+                cache.incr(generation_key(namespace))
+            except ValueError:
+                cache.add(generation_key(namespace), int(time.time()*1000), None)
+
+
+def response_cache_enabled():
+    return getattr(settings, 'BREADBOARD_RESPONSE_CACHE', False)
+
+
+def invalidate_on_change(sender, **kwargs):
+    names = [sender.__name__]
+    transaction.on_commit(lambda: invalidate(*names))
+
+
+def invalidate_on_delete(sender, **kwargs):
+    # Rows referencing the deleted one were updated (SET_NULL) or deleted with it
+    names = [sender.__name__] + [rel.related_model.__name__ for rel in sender._meta.related_objects]
+    transaction.on_commit(lambda: invalidate(*names))
+
+
+def connect_invalidation_signals():
+    model_names = {name for dependencies in CACHE_DEPENDENCIES.values() for name in dependencies}
+    for name in model_names:
+        model = apps.get_model('api', name)
+        post_save.connect(invalidate_on_change, sender=model, dispatch_uid='api-cache-save-' + name)
+        post_delete.connect(invalidate_on_delete, sender=model, dispatch_uid='api-cache-delete-' + name)
+
+
+class CachedResponseMixin:
+    """
+    ViewSet mixin caching the responses of cached_actions in cache_namespace
+    """
+    cache_namespace = None
+    cached_actions = ('list', 'retrieve')
+
+    def response_cache_key(self, request):
+        user = getattr(request.user, 'pk', None)
+        key = ':'.join(str(part) for part in (
+                    get_generation(self.cache_namespace),
+                    user,
+                    request.get_host(),
+                    request.get_full_path(),
+                ))
+        return 'api:response:%s:%s' % (self.cache_namespace, hashlib.sha1(key.encode()).hexdigest())
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        if self.action not in self.cached_actions or not response_cache_enabled():
+            return handler(request, *args, **kwargs)
+
+        cache = get_cache()
+        key = self.response_cache_key(request)
+        data = cache.get(key)
+        if data is not None:
+            return Response(data)
+
+        with primary():
+            response = handler(request, *args, **kwargs)
+        if response.status_code==200 and response.data is not None:
+            cache.set(key, response.data, CACHE_TIMEOUT)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
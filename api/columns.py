@@ -0,0 +1,100 @@
+"""
+Column-oriented fetch of run parameters.
+Runs' ids, runtimes and selected parameter keys are read with a single
+values_list query and returned as arrays: JSON columns, numpy .npz, or Arrow IPC.
+"""
+import io
+
+import numpy as np
+from django.contrib.postgres.fields.jsonb import KeyTransform
+from django.http import HttpResponse
+from django.utils import timezone
+from rest_framework.exceptions import ParseError
+from rest_framework.response import Response
+
+from api.export import parameter_keys
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+COLUMN_FORMATS = ['json', 'npz', 'arrow']
+
+
+def fetch_columns(queryset, keys):
+    """
+    Returns (ids, runtimes, {key: values}) for the runs in queryset, ordered by runtime.
+    Missing parameters are None.
+    """
+    annotations = {'parameter_%d' % i: KeyTransform(key, 'parameters') for i, key in enumerate(keys)}
+    rows = (queryset.order_by('runtime', 'id')
+                .annotate(**annotations)
+                .values_list('id', 'runtime', *annotations))
+    columns = list(zip(*rows)) or [()] * (2 + len(keys))
+    parameters = {key: list(columns[2+i]) for i, key in enumerate(keys)}
+    return list(columns[0]), list(columns[1]), parameters
+
+
+def to_array(values):
+    # Numeric columns become float arrays with nan for missing values, anything else strings
+    numeric = [v for v in values if v is not None]
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in numeric):
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    return np.array(['' if v is None else str(v) for v in values])
+
+
+def to_datetime64(runtimes):
+    # Runtimes as naive UTC datetime64, which numpy and arrow both understand
+    return np.array([timezone.make_naive(t, timezone.utc) for t in runtimes], dtype='datetime64[us]')
+
+
+def npz_response(ids, runtimes, parameters):
+    buffer = io.BytesIO()
+    arrays = {'parameters/' + key: to_array(values) for key, values in parameters.items()}
+    np.savez_compressed(buffer,
+            id=np.array(ids, dtype=np.int64),
+            runtime=to_datetime64(runtimes),
+            **arrays)
+    return HttpResponse(buffer.getvalue(), content_type='application/octet-stream')
+
+
+def arrow_response(ids, runtimes, parameters):
+    if pyarrow is None:
+        raise ParseError(detail='Arrow output needs pyarrow to be installed on the server')
+    columns = {
+        'id': pyarrow.array(ids, type=pyarrow.int64()),
+        'runtime': pyarrow.array(to_datetime64(runtimes)),
+    }
+    for key, values in parameters.items():
+        columns[key if key not in columns else 'parameters.' + key] = pyarrow.array(to_array(values))
+    table = pyarrow.table(columns)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return HttpResponse(sink.getvalue().to_pybytes(), content_type='application/vnd.apache.arrow.stream')
+
+
+def columns_response(queryset, request):
+    """
+    Respond with the runs in queryset as columns, in the format given by ?output=json|npz|arrow.
+    ?params=TOF,evap selects the parameter keys, by default all keys are returned.
+    """
+    output = request.query_params.get('output', 'json')
+    if output not in COLUMN_FORMATS:
+        raise ParseError(detail='output must be one of: ' + ', '.join(COLUMN_FORMATS))
+    params = request.query_params.get('params')
+    keys = [k for k in params.split(',') if k] if params else parameter_keys(queryset)
+
+    ids, runtimes, parameters = fetch_columns(queryset, keys)
+    if output=='npz':
+        return npz_response(ids, runtimes, parameters)
+    elif output=='arrow':
+        return arrow_response(ids, runtimes, parameters)
+    return Response({
+        'count': len(ids),
+        'id': ids,
+        'runtime': runtimes,
+        'parameters': parameters,
+    })
@@ -0,0 +1,57 @@
+"""
+Conditional GET for lists: ETag and Last-Modified validators computed from the
+queried rows (latest updated time and count) and the latest Tombstone of their
+model, so that polling clients get a 304 without the rows being fetched,
+serialized or sent when nothing has changed. The validators only depend on the
+database, so they are the same in every worker.
+"""
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from api.models import Tombstone
+
+
+def list_validators(request, queryset, fields):
+    """
+    (etag, last_modified timestamp) for the rows of queryset. The ETag depends on
+    the latest value of fields (a field, or a list of them for rows serialized
+    with related objects, eg. ['updated', 'run__updated']), the number of rows,
+    the query, and the latest deletion of a row of the model. Last-Modified is
+    the latest edit or deletion.
+    """
+    fields = [fields] if isinstance(fields, str) else list(fields)
+    aggregates = {'latest_%d' % i: Max(field) for i, field in enumerate(fields)}
+    summary = queryset.order_by().aggregate(count=Count('pk'), **aggregates)
+    tombstone = (Tombstone.objects.filter(model=queryset.model._meta.model_name)
+                    .order_by('-id').values_list('id', 'deleted').first())
+    latests = [summary[name] for name in sorted(aggregates)]
+    latest = max(filter(None, latests + [tombstone[1] if tombstone else None]), default=None)
+    key = ':'.join(str(part) for part in (
+                ','.join(value.isoformat() if value else '' for value in latests),
+                summary['count'],
+                tombstone[0] if tombstone else None,
+                getattr(request.user, 'pk', None),
+                request.get_full_path(),
+            ))
+    etag = quote_etag(hashlib.md5(key.encode()).hexdigest())
+    return etag, int(latest.timestamp()) if latest else None
+
+
+def conditional_response(request, queryset, fields, get_response):
+    """
+    Respond with 304 Not Modified if the client's validators match, else with get_response()
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return get_response()
+    etag, last_modified = list_validators(request, queryset, fields)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = get_response()
+    if response.status_code in (200, 304):
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+    return response
@@ -0,0 +1,109 @@
+"""
+Streaming export of runs as NDJSON or CSV.
+Rows are read with a server-side cursor (queryset.iterator) and written out as
+they arrive, so memory use does not depend on the number of runs exported.
+"""
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Func, CharField
+from django.http import StreamingHttpResponse
+from rest_framework.exceptions import ParseError
+
+from api.renderers import dumps, sanitize
+
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+RUN_EXPORT_FIELDS = ('id', 'created', 'runtime', 'lab', 'dataset', 'notes')
+CHUNK_SIZE = 2000 # rows fetched from the server-side cursor at a time
+ROWS_PER_WRITE = 500 # rows joined into a single chunk of the response
+
+
+def parameter_keys(queryset):
+    # All the keys used in the parameters of the runs, with a single query
+    keys = (queryset.order_by()
+                .filter(parameters__isnull=False)
+                .annotate(parameter_key=Func(F('parameters'), function='jsonb_object_keys', output_field=CharField()))
+                .values_list('parameter_key', flat=True)
+                .distinct())
+    return sorted(keys)
+
+
+def iterate_runs(queryset, chunk_size=CHUNK_SIZE):
+    # Runs as dicts, straight from a server-side cursor
+    columns = ('id', 'created', 'runtime', 'lab_id', 'dataset_id', 'notes', 'parameters')
+    for row in queryset.values_list(*columns).iterator(chunk_size=chunk_size):
+        run = dict(zip(RUN_EXPORT_FIELDS, row))
+        run['parameters'] = row[-1] or {}
+        yield run
+
+
+def batched(lines, size=ROWS_PER_WRITE):
+    # Join lines into larger chunks, fewer writes to the socket
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch)>=size:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+
+def ndjson_lines(runs, keys=None):
+    for run in runs:
+        if keys is not None:
+            run['parameters'] = {k: run['parameters'].get(k) for k in keys}
+        yield dumps(run).decode() + '\n'
+
+
+class EchoBuffer:
+    # File-like object for csv.writer that hands back the written line
+    def write(self, value):
+        return value
+
+
+def csv_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(sanitize(value), cls=DjangoJSONEncoder, allow_nan=False)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def csv_lines(runs, keys):
+    # One column per parameter key, prefixed if it clashes with a run field
+    writer = csv.writer(EchoBuffer())
+    headers = [k if k not in RUN_EXPORT_FIELDS else 'parameters.' + k for k in keys]
+    yield writer.writerow(list(RUN_EXPORT_FIELDS) + headers)
+    for run in runs:
+        parameters = run['parameters']
+        row = [csv_value(run[field]) for field in RUN_EXPORT_FIELDS]
+        row += [csv_value(parameters.get(k)) if isinstance(parameters, dict) else None for k in keys]
+        yield writer.writerow(row)
+
+
+def export_runs_response(queryset, request, filename='runs'):
+    """
+    Stream the runs in queryset in the format given by ?output=ndjson|csv.
+    ?params=TOF,evap restricts the exported parameters to the given keys.
+    """
+    output = request.query_params.get('output', 'ndjson')
+    if output not in EXPORT_FORMATS:
+        raise ParseError(detail='output must be one of: ' + ', '.join(EXPORT_FORMATS))
+    params = request.query_params.get('params')
+    keys = [k for k in params.split(',') if k] if params else None
+
+    runs = iterate_runs(queryset)
+    if output=='csv':
+        lines = csv_lines(runs, keys if keys is not None else parameter_keys(queryset))
+    else:
+        lines = ndjson_lines(runs, keys)
+
+    response = StreamingHttpResponse(batched(lines), content_type=EXPORT_FORMATS[output])
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (filename, output)
+    return response
@@ -0,0 +1,120 @@
+"""
+Server-side filtering of runs (and images) on Run.parameters.
+
+Query parameters of the form param.<key>[__<lookup>]=<value> become JSONField
+lookups, eg. ?param.TOF__gte=2&param.evap=90
+    exact (default), ne, in: JSON containment, backed by the GIN index on Run.parameters
+    gt, gte, lt, lte:        numeric comparisons, on values which are numbers
+    isnull:                  whether the key is missing
+Range lookups on a frequently used key can be indexed with
+`python manage.py parameter_index <key>`.
+"""
+import json
+
+from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.fields.jsonb import KeyTransform
+from django.db.models import F, FloatField, Func, Q
+from rest_framework.exceptions import ParseError
+
+
+PARAMETER_PREFIX = 'param.'
+PARAMETER_LOOKUPS = ['exact', 'ne', 'in', 'gt', 'gte', 'lt', 'lte', 'isnull']
+NUMERIC_LOOKUPS = ['gt', 'gte', 'lt', 'lte']
+
+
+class JSONNumber(Func):
+    """
+    Numeric value of a key in a JSONField, NULL when the value isn't a number
+    """
+    output_field = FloatField()
+
+    def __init__(self, field, key):
+        super().__init__(KeyTransform(key, field))
+
+    def as_sql(self, compiler, connection, **extra_context):
+        sql, params = compiler.compile(self.get_source_expressions()[0])
+        return ("(CASE WHEN jsonb_typeof(%s) = 'number' THEN (%s)::text::double precision END)" % (sql, sql),
+                    params*2)
+
+
+class JSONMerge(Func):
+    """
+    A JSONField with the keys of a dict added or replaced, for updates
+    """
+    output_field = JSONField()
+
+    def __init__(self, field, value):
+        super().__init__(F(field))
+        self.value = value
+
+    def as_sql(self, compiler, connection, **extra_context):
+        sql, params = compiler.compile(self.get_source_expressions()[0])
+        return "(COALESCE(%s, '{}'::jsonb) || %%s::jsonb)" % sql, params + [json.dumps(self.value)]
+
+
+def parse_value(value):
+    # Values are JSON when they can be (numbers, booleans, quoted strings), else strings
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def parse_parameter_filter(name):
+    # 'param.TOF__gte' -> ('TOF', 'gte')
+    key = name[len(PARAMETER_PREFIX):]
+    lookup = 'exact'
+    if '__' in key:
+        head, tail = key.rsplit('__', 1)
+        if tail in PARAMETER_LOOKUPS:
+            key, lookup = head, tail
+    if not key:
+        raise ParseError(detail='Missing parameter name in ' + name)
+    return key, lookup
+
+
+def query_items(query_params):
+    # (name, list of values) pairs from a QueryDict, or from a dict parsed from JSON
+    if hasattr(query_params, 'lists'):
+        return query_params.lists()
+    return ((k, v if isinstance(v, list) else [v]) for k, v in query_params.items())
+
+
+def filter_parameters(queryset, query_params, field='parameters'):
+    """
+    Filter queryset with the param.<key>[__<lookup>] entries of query_params.
+    field is the path to the parameters JSONField, eg. 'run__parameters' for images.
+    """
+    numeric = 0
+    for name, values in query_items(query_params):
+        if not name.startswith(PARAMETER_PREFIX):
+            continue
+        key, lookup = parse_parameter_filter(name)
+        for value in values:
+            if not isinstance(value, str):
+                # from a JSON body
+                value = json.dumps(value)
+            if lookup=='exact':
+                queryset = queryset.filter(**{field + '__contains': {key: parse_value(value)}})
+            elif lookup=='ne':
+                queryset = queryset.exclude(**{field + '__contains': {key: parse_value(value)}})
+            elif lookup=='in':
+                q = Q()
+                for item in value.split(','):
+                    q |= Q(**{field + '__contains': {key: parse_value(item)}})
+                queryset = queryset.filter(q)
+            elif lookup=='isnull':
+                has_key = Q(**{field + '__has_key': key})
+                isnull = parse_value(value)
+                if not isinstance(isnull, bool):
+                    raise ParseError(detail='%s must be true or false' % name)
+                queryset = queryset.filter(~has_key if isnull else has_key)
+            else:
+                try:
+                    number = float(value)
+                except ValueError:
+                    raise ParseError(detail='%s must be a number' % name)
+                alias = '_parameter_%d' % numeric
+                numeric += 1
+                queryset = queryset.annotate(**{alias: JSONNumber(field, key)}).filter(**{alias + '__' + lookup: number})
+    return queryset
@@ -0,0 +1,251 @@
+"""
+Previews of the image files referenced by Image.
+
+Image only stores paths (filepath, odpath, atomsperpixel) on the lab file
+server, mounted at settings.BREADBOARD_IMAGE_ROOT. Files are opened with
+memory-mapped I/O (FITS, or .npy), downscaled by block averaging, and encoded
+as 8-bit grayscale PNGs. Previews are cached on disk, keyed by path, mtime and
+size, in a directory bounded to BREADBOARD_PREVIEW_CACHE_BYTES: the least
+recently used previews are removed first.
+"""
+import hashlib
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+IMAGE_ROOT = getattr(settings, 'BREADBOARD_IMAGE_ROOT', None)
+PREVIEW_CACHE_DIR = getattr(settings, 'BREADBOARD_PREVIEW_CACHE_DIR',
+            os.path.join(tempfile.gettempdir(), 'breadboard-previews'))
+PREVIEW_CACHE_BYTES = getattr(settings, 'BREADBOARD_PREVIEW_CACHE_BYTES', 512*1024*1024)
+PREVIEW_CACHE_RESCAN = 100 # writes between scans of the cache directory
+
+PREVIEW_KINDS = {'raw': 'filepath', 'od': 'odpath', 'atoms': 'atomsperpixel'}
+PREVIEW_SIZES = (32, 2048) # min and max size of the longest side
+DEFAULT_PREVIEW_SIZE = 256
+
+FITS_BLOCK = 2880
+FITS_CARD = 80
+FITS_DTYPES = {8: '>u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+
+class ImageDataError(Exception):
+    pass
+
+
+def resolve_path(path, root=None):
+    """
+    Local path of a file stored in an Image, which must be within the image root.
+    Paths are relative to the root, with either separator.
+    """
+    root = root or IMAGE_ROOT
+    if not root:
+        # A server error, not a missing file
+        raise ImproperlyConfigured('BREADBOARD_IMAGE_ROOT is not configured')
+    if not path:
+        raise ImageDataError('No file for this image')
+    root = os.path.realpath(root)
+    relative = path.replace('\\', '/').lstrip('/')
+    local = os.path.realpath(os.path.join(root, relative))
+    if os.path.commonpath([root, local]) != root:
+        raise ImageDataError('Path outside of the image root: ' + path)
+    if not os.path.isfile(local):
+        raise ImageDataError('File not found: ' + path)
+    return local
+
+
+def read_fits_header(f):
+    # Header cards as a dict, and the offset of the data
+    header = {}
+    offset = 0
+    while True:
+        block = f.read(FITS_BLOCK)
+        if len(block) < FITS_BLOCK:
+            raise ImageDataError('Truncated FITS header')
+        offset += FITS_BLOCK
+        for i in range(0, FITS_BLOCK, FITS_CARD):
+            card = block[i:i+FITS_CARD].decode('ascii', 'replace')
+            keyword = card[:8].strip()
+            if keyword == 'END':
+                return header, offset
+            if card[8:10] == '= ':
+                value = card[10:].split('/')[0].strip()
+                header[keyword] = value.strip("'").strip()
+
+
+def read_fits(path):
+    """
+    (data, header) of a FITS file, data being a memory-mapped array of its
+    primary data, with shape (frames, rows, columns) or (rows, columns)
+    """
+    with open(path, 'rb') as f:
+        header, offset = read_fits_header(f)
+    try:
+        dtype = FITS_DTYPES[int(header['BITPIX'])]
+        naxis = int(header['NAXIS'])
+        # NAXIS1 is the fastest varying axis
+        shape = tuple(int(header['NAXIS%d' % i]) for i in range(naxis, 0, -1))
+    except (KeyError, ValueError):
+        raise ImageDataError('Unsupported FITS file: ' + path)
+    if naxis < 2:
+        raise ImageDataError('FITS file without an image: ' + path)
+    if os.path.getsize(path) < offset + int(np.prod(shape)) * np.dtype(dtype).itemsize:
+        raise ImageDataError('Truncated FITS file: ' + path)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape), header
+
+
+def read_image(path):
+    # 2D array of a FITS or .npy file: the first frame of multi-frame files
+    header = {}
+    if path.lower().endswith('.npy'):
+        data = np.load(path, mmap_mode='r')
+    else:
+        data, header = read_fits(path)
+    while data.ndim > 2:
+        data = data[0]
+    # Scaling of the FITS values, only on the frame read
+    bzero = float(header.get('BZERO', 0))
+    bscale = float(header.get('BSCALE', 1))
+    if bzero != 0 or bscale != 1:
+        return data * bscale + bzero
+    return data
+
+
+def downscale(data, size):
+    """
+    Block mean of data, so that its longest side is at most size, and its
+    shortest side at least 1 pixel
+    """
+    factor = max(1, min(-(-max(data.shape) // size), min(data.shape)))
+    rows, columns = (data.shape[0] // factor) * factor, (data.shape[1] // factor) * factor
+    if factor == 1:
+        return np.asarray(data, dtype=np.float64)
+    blocks = np.asarray(data[:rows, :columns], dtype=np.float64).reshape(
+                rows // factor, factor, columns // factor, factor)
+    return blocks.mean(axis=(1, 3))
+
+
+def to_uint8(data):
+    # Scale between the 1st and 99th percentiles, ignoring NaNs
+    finite = np.isfinite(data)
+    if not finite.any():
+        return np.zeros(data.shape, dtype=np.uint8)
+    low, high = np.percentile(data[finite], [1, 99])
+    if high <= low:
+        high = low + 1
+    scaled = (np.where(finite, data, low) - low) * (255 / (high - low))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def encode_png(pixels):
+    """
+    PNG of a 2D uint8 array, as 8-bit grayscale
+    """
+    height, width = pixels.shape
+    # Each row starts with its filter type: 0, none
+    rows = np.hstack([np.zeros((height, 1), dtype=np.uint8), pixels])
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)),
+        png_chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)),
+        png_chunk(b'IEND', b''),
+    ])
+
+
+class PreviewCache:
+    """
+    Previews on disk, removing the least recently used when over max_bytes.
+    Hits touch the file, so mtimes order the entries by last use. The size of
+    the directory is counted from the writes of this process, and scanned again
+    when over max_bytes or every PREVIEW_CACHE_RESCAN writes (other processes).
+    """
+    def __init__(self, directory=PREVIEW_CACHE_DIR, max_bytes=PREVIEW_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = None # bytes in the directory, None until scanned
+        self.writes = 0
+
+    def key(self, path, kind, size):
+        stat = os.stat(path)
+        return hashlib.sha1(('%s|%d|%d|%s|%d' % (path, stat.st_mtime_ns, stat.st_size, kind, size)).encode()).hexdigest()
+
+    def get(self, key):
+        filename = os.path.join(self.directory, key + '.png')
+        try:
+            with open(filename, 'rb') as f:
+                content = f.read()
+            os.utime(filename)
+            return content
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, content):
+        os.makedirs(self.directory, exist_ok=True)
+        # Write then rename, so that readers never see a partial file
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(temporary, os.path.join(self.directory, key + '.png'))
+        self.writes += 1
+        if self.size is not None:
+            self.size += len(content)
+        if self.size is None or self.size > self.max_bytes or self.writes >= PREVIEW_CACHE_RESCAN:
+            self.prune()
+
+    def prune(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.png'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.size = total
+        self.writes = 0
+
+
+preview_cache = PreviewCache()
+
+
+def preview_key(image, kind='raw', size=DEFAULT_PREVIEW_SIZE, cache=None):
+    """
+    (path, key, size) of the preview of one of the files of image, key identifying
+    its content. Only stats the file, so that clients can be sent a 304 first.
+    """
+    if kind not in PREVIEW_KINDS:
+        raise ImageDataError('kind must be one of ' + ', '.join(PREVIEW_KINDS))
+    size = min(max(int(size), PREVIEW_SIZES[0]), PREVIEW_SIZES[1])
+    cache = cache or preview_cache
+    path = resolve_path(getattr(image, PREVIEW_KINDS[kind]))
+    return path, cache.key(path, kind, size), size
+
+
+def render_preview(path, key, size, cache=None):
+    """
+    PNG of the preview of path, from the cache or rendered and cached
+    """
+    cache = cache or preview_cache
+    content = cache.get(key)
+    if content is None:
+        content = encode_png(to_uint8(downscale(read_image(path), size)))
+        cache.set(key, content)
+    return content
@@ -0,0 +1,128 @@
+"""
+Statistics of the images, computed from their files.
+
+For images with an atomsperpixel or odpath file, image_statistics computes
+within Image.cropi the total atom number (sum of atoms per pixel), the
+centroid and RMS widths in pixels, and the peak OD. They are stored in
+Image.stats by `python manage.py process_images`, which processes the new
+images in a pool of processes. Image.total_atoms is only filled in when it is
+empty: clients may set it, eg. from a fit.
+
+cropi is either {'xmin': .., 'xmax': .., 'ymin': .., 'ymax': ..} or
+[xmin, xmax, ymin, ymax], in pixels, max excluded. Missing bounds are the
+edges of the image.
+"""
+import numpy as np
+from django.db import transaction
+from django.db.models import Case, FloatField, Value, When
+from django.utils import timezone
+
+from api.cache import invalidate
+from api.imagedata import read_image, resolve_path, ImageDataError
+from api.models import Image
+
+
+STATS_VERSION = 1
+CROP_KEYS = ('xmin', 'xmax', 'ymin', 'ymax')
+
+
+def crop_bounds(cropi, shape):
+    # (ymin, ymax, xmin, xmax) within an image of this shape
+    if isinstance(cropi, (list, tuple)) and len(cropi) == 4:
+        cropi = dict(zip(CROP_KEYS, cropi))
+    if not isinstance(cropi, dict):
+        cropi = {}
+    def bound(key, default, limit):
+        try:
+            return min(max(int(cropi[key]), 0), limit)
+        except (KeyError, TypeError, ValueError):
+            return default
+    rows, columns = shape
+    return (bound('ymin', 0, rows), bound('ymax', rows, rows),
+            bound('xmin', 0, columns), bound('xmax', columns, columns))
+
+
+def moments(weights, offset):
+    # Centroid and RMS width along the axis of weights, a 1D array
+    total = weights.sum()
+    if total <= 0:
+        return None, None
+    positions = np.arange(len(weights)) + offset
+    center = (weights * positions).sum() / total
+    width = np.sqrt((weights * (positions - center)**2).sum() / total)
+    return float(center), float(width)
+
+
+def image_statistics(atoms=None, od=None, cropi=None):
+    """
+    Statistics of an image from its 2D atoms per pixel and/or OD arrays
+    """
+    source = atoms if atoms is not None else od
+    if source is None:
+        raise ImageDataError('No atoms per pixel or OD data')
+    ymin, ymax, xmin, xmax = crop_bounds(cropi, source.shape)
+    if ymax <= ymin or xmax <= xmin:
+        raise ImageDataError('Empty crop region')
+
+    stats = {'version': STATS_VERSION, 'crop': [xmin, xmax, ymin, ymax]}
+    region = np.nan_to_num(np.asarray(source[ymin:ymax, xmin:xmax], dtype=np.float64))
+    if atoms is not None:
+        stats['total_atoms'] = float(region.sum())
+    if od is not None:
+        od_region = np.asarray(od[ymin:ymax, xmin:xmax], dtype=np.float64)
+        stats['peak_od'] = float(np.nanmax(od_region)) if np.isfinite(od_region).any() else None
+
+    # Negative values are noise: moments of the positive part only
+    weights = np.clip(region, 0, None)
+    stats['centroid_x'], stats['width_x'] = moments(weights.sum(axis=0), xmin)
+    stats['centroid_y'], stats['width_y'] = moments(weights.sum(axis=1), ymin)
+    return stats
+
+
+def process_image(task):
+    """
+    (id, stats) of an image, from (id, atomsperpixel, odpath, cropi, root).
+    Runs in the worker processes: no database access here.
+    """
+    image_id, atomsperpixel, odpath, cropi, root = task
+    try:
+        atoms = read_image(resolve_path(atomsperpixel, root=root)) if atomsperpixel else None
+        od = read_image(resolve_path(odpath, root=root)) if odpath else None
+        return image_id, image_statistics(atoms=atoms, od=od, cropi=cropi)
+    except (ImageDataError, OSError, ValueError) as e:
+        # Stored, so that the image isn't retried on every pass
+        return image_id, {'version': STATS_VERSION, 'error': str(e)}
+
+
+def pending_images(queryset=None, reprocess=False):
+    # Images with a file to process, oldest first
+    queryset = Image.objects.all() if queryset is None else queryset
+    queryset = queryset.exclude(atomsperpixel__isnull=True, odpath__isnull=True).exclude(
+                atomsperpixel='', odpath='')
+    if not reprocess:
+        queryset = queryset.filter(stats__isnull=True)
+    return queryset.only('id', 'atomsperpixel', 'odpath', 'cropi').order_by('id')
+
+
+def process_batch(images, executor, root=None):
+    """
+    Compute the stats of images (a list) in the executor, and save them with one
+    bulk update. Returns the number of images without errors.
+    """
+    tasks = [(img.id, img.atomsperpixel, img.odpath, img.cropi, root) for img in images]
+    results = dict(executor.map(process_image, tasks, chunksize=max(1, len(tasks) // 32)))
+    now = timezone.now()
+    for img in images:
+        img.stats = results[img.id]
+        img.updated = now
+    total_atoms = {img.id: img.stats['total_atoms'] for img in images if img.stats.get('total_atoms') is not None}
+    with transaction.atomic():
+        # bulk_update doesn't apply auto_now (updated is set above), or send signals
+        Image.objects.bulk_update(images, ['stats', 'updated'])
+        if total_atoms:
+            # Checked in the update itself: the images may have changed since they were read
+            Image.objects.filter(id__in=total_atoms, total_atoms__isnull=True).update(total_atoms=Case(
+                        *[When(id=image_id, then=Value(value)) for image_id, value in total_atoms.items()],
+                        output_field=FloatField()))
+        transaction.on_commit(lambda: invalidate('Image'))
+    return sum(1 for img in images if 'error' not in img.stats)
@@ -0,0 +1,90 @@
+"""
+Batched ingest of images posted in NamesCreated mode.
+A burst of images from a camera is resolved, created and matched to runs
+with a fixed number of queries, independent of the number of images.
+"""
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from api.models import Image
+from api.matching import RunMatcher
+from api.cache import invalidate
+
+
+DEFAULT_DELTA = 7 # default delta value: range = center +- delta
+
+
+def parse_created(created):
+    # Created times arrive as strings from the query, or as datetimes
+    if isinstance(created, str):
+        created = parse_datetime(created.strip())
+    if created is not None and timezone.is_naive(created):
+        created = timezone.make_aware(created)
+    return created
+
+
+def ingest_images(lab, namelist, createdlist, image_params=None, delta=DEFAULT_DELTA, policy='nearest'):
+    """
+    Find or create the images given by names and created times, and attach runs.
+
+    Existing images are resolved with one lookup, missing ones are created with
+    bulk_create, runs are matched with one range query (see api.matching) and attached with bulk_update.
+    Returns (images, created_images), with images in the order of namelist.
+    """
+    image_params = image_params or {}
+    created_times = [parse_created(created) for created in createdlist]
+    pairs = list(zip(namelist, created_times))
+
+    with transaction.atomic():
+        # Resolve every names/created pair with a single query
+        candidates = lab.images.select_related('run').filter(
+                    name__in=set(namelist),
+                    created__in=set(created_times),
+                ).order_by('id')
+        found = {}
+        duplicates = []
+        for img in candidates:
+            key = (img.name, img.created)
+            if key in found:
+                print('Warning: multiple images found for imagename = ' + img.name)
+                duplicates.append(img.id)
+            else:
+                found[key] = img
+        if duplicates:
+            # Remove copies
+            Image.objects.filter(id__in=duplicates).delete()
+
+        # Create the missing images in one insert
+        new_images = []
+        for name, created in pairs:
+            if (name, created) not in found:
+                img = Image(lab=lab, name=name, created=created, **image_params)
+                found[(name, created)] = img
+                new_images.append(img)
+        if new_images:
+            print('Creating %d new image objects' % len(new_images))
+            Image.objects.bulk_create(new_images)
+
+        images = [found[pair] for pair in pairs]
+
+        # Attach runs to all the images at once
+        changed = {}
+        now = timezone.now()
+        matcher = RunMatcher(lab, created_times, delta, policy=policy)
+        for img, run in zip(images, matcher.match(created_times)):
+            if run is None:
+                print('Warning: no run found for imagename = ' + img.name)
+            elif img.run_id != run.id:
+                img.run = run
+                img.updated = now
+                changed[img.id] = img
+        if changed:
+            # bulk_update doesn't apply auto_now: updated is set above
+            Image.objects.bulk_update(list(changed.values()), ['run', 'updated'])
+
+        if new_images or changed:
+            # bulk operations don't send signals: invalidate cached responses here
+            transaction.on_commit(lambda: invalidate('Image'))
+
+    return images, new_images
@@ -0,0 +1,328 @@
+"""
+Live feed of the new images and runs of a lab, read from the database and fanned
+out to the waiting subscribers.
+
+Subscribers hold a cursor per kind: the last id up to which every row was
+sent, and the ids above it which were sent already. Ids are assigned before
+the rows commit, so a row with a lower id can still show up after a higher
+one: the last id only moves past rows older than FEED_LAG, as the sync tokens
+of /changes/ only move past changes older than SYNC_LAG. Every row is sent
+once, whichever worker or instance created it and whichever one serves the
+subscriber.
+
+Each process has a single poller thread (Broker), which queries the new rows of
+every lab with subscribers every FEED_POLL_INTERVAL, keeps the latest FEED_BUFFER
+of each kind in memory (LabFeed), and wakes up the subscribers waiting on them.
+However many subscribers wait, the database sees two queries per lab and poll.
+Subscribers whose cursor is older than the buffer catch up with one query of
+their own. Waiting subscribers cost a blocked thread under WSGI, and a coroutine
+under ASGI (api/asgi.py).
+"""
+import asyncio
+import base64
+import binascii
+import bisect
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Max
+from django.utils import timezone
+from rest_framework.exceptions import ParseError
+
+from api.models import Image, Run
+from breadboard.db.routers import primary
+
+
+logger = logging.getLogger(__name__)
+
+FEED_KINDS = {'image': Image, 'run': Run} # events are new-<kind>
+FEED_LIMIT = 1000 # max new ids per kind in a response
+FEED_BUFFER = 5000 # rows kept in memory per lab and kind
+FEED_LAG = timedelta(seconds=10) # rows more recent than this may still be committing
+FEED_POLL_INTERVAL = 1 # seconds between queries of the poller
+FEED_IDLE = 60 # seconds without subscribers before a lab is no longer polled
+
+
+def encode_cursor(cursor):
+    data = json.dumps(cursor, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def decode_cursor(token):
+    # {kind: [last id, [ids above it already sent]]}
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return {kind: [int(data[kind][0]), [int(i) for i in data[kind][1]]] for kind in FEED_KINDS}
+    except (ValueError, TypeError, KeyError, IndexError, AttributeError, binascii.Error):
+        raise ParseError(detail='Invalid feed cursor')
+
+
+def fetch_rows(queryset, position, limit):
+    # (id, updated) of the rows after position, a (last id, sent ids) pair
+    last, sent = position
+    return list(queryset.filter(id__gt=last).order_by('id').values_list('id', 'updated')[:limit+len(sent)+1])
+
+
+def walk(rows, position, horizon, limit):
+    """
+    (new ids, new position, more) from rows, the (id, updated) pairs after
+    position in order of id
+    """
+    last, sent = position
+    more = len(rows) > limit + len(sent)
+    rows = rows[:limit+len(sent)]
+    sent = set(sent)
+    new_ids = []
+    unsettled = []
+    for row_id, updated in rows:
+        if not unsettled and updated <= horizon:
+            last = row_id
+        else:
+            unsettled.append(row_id)
+        if row_id not in sent:
+            new_ids.append(row_id)
+    return new_ids, [last, unsettled], more
+
+
+def settled_position(queryset, horizon):
+    return [queryset.filter(updated__lte=horizon).aggregate(last=Max('id'))['last'] or 0, []]
+
+
+def events_from(new_ids_by_kind):
+    return [{'event': 'new-' + kind, 'ids': new_ids} for kind, new_ids in new_ids_by_kind.items() if new_ids]
+
+
+def feed_events(lab_id, cursor, limit=FEED_LIMIT):
+    """
+    (events, new cursor, more) with the rows of the lab created after cursor,
+    straight from the database. Events are {'event': 'new-image', 'ids': [...]}.
+    """
+    horizon = timezone.now() - FEED_LAG
+    new_ids = {}
+    cursor = dict(cursor)
+    more = False
+    for kind, model in FEED_KINDS.items():
+        rows = fetch_rows(model.objects.filter(lab_id=lab_id), cursor[kind], limit)
+        new_ids[kind], cursor[kind], kind_more = walk(rows, cursor[kind], horizon, limit)
+        more = more or kind_more
+    return events_from(new_ids), cursor, more
+
+
+class LabFeed:
+    """
+    The latest new rows of a lab, as seen by the poller
+    """
+    def __init__(self, lab_id, size=FEED_BUFFER):
+        self.lab_id = lab_id
+        self.size = size
+        self.condition = threading.Condition()
+        self.polling = threading.Lock()
+        self.waiters = set() # callbacks waking up async subscribers
+        self.subscribers = 0
+        self.last_used = time.monotonic()
+        self.cursor = None
+        self.horizon = None
+        self.rows = {kind: [] for kind in FEED_KINDS} # (id, updated), in order of id
+        self.watermark = {} # the buffer holds every row after it
+
+    def poll(self, first=False):
+        """
+        Query the new rows of the lab, and wake up the subscribers if there are.
+        Returns whether there are more rows to query right away. With first,
+        only polls a feed which never was.
+        """
+        with self.polling:
+            if first and self.cursor is not None:
+                return False
+            return self.poll_rows()
+
+    def poll_rows(self):
+        horizon = timezone.now() - FEED_LAG
+        cursor = self.cursor
+        fetched = {}
+        # A lagging replica could move the cursor past rows it doesn't have yet
+        with primary():
+            for kind, model in FEED_KINDS.items():
+                queryset = model.objects.filter(lab_id=self.lab_id)
+                position = cursor[kind] if cursor else settled_position(queryset, horizon)
+                fetched[kind] = position, fetch_rows(queryset, position, FEED_LIMIT)
+
+        more = False
+        added = False
+        with self.condition:
+            cursor = {}
+            for kind, (position, rows) in fetched.items():
+                new_ids, cursor[kind], kind_more = walk(rows, position, horizon, FEED_LIMIT)
+                more = more or kind_more
+                self.watermark.setdefault(kind, position[0])
+                buffer = self.rows[kind]
+                added = added or bool(new_ids)
+                for row in rows:
+                    # Rows seen before are refetched until they settle
+                    i = bisect.bisect_left(buffer, (row[0],))
+                    if i < len(buffer) and buffer[i][0] == row[0]:
+                        buffer[i] = row
+                    else:
+                        buffer.insert(i, row)
+                # Only rows the poller has moved past leave the buffer
+                while len(buffer) > self.size and buffer[0][0] <= cursor[kind][0]:
+                    self.watermark[kind] = buffer.pop(0)[0]
+            self.cursor = cursor
+            self.horizon = horizon
+            if added:
+                self.condition.notify_all()
+            waiters = list(self.waiters) if added else []
+        for wake in waiters:
+            wake()
+        return more
+
+    def current_cursor(self):
+        # Cursor from now on: the rows already seen are never sent
+        with self.condition:
+            return {kind: [last, list(sent)] for kind, (last, sent) in self.cursor.items()}
+
+    def behind(self, cursor):
+        # Whether rows after cursor may have left the buffer
+        return any(cursor[kind][0] < self.watermark[kind] for kind in FEED_KINDS)
+
+    def events_after(self, cursor):
+        # (events, new cursor, more) from the buffer. Must be called with the condition held
+        new_ids = {}
+        new_cursor = {}
+        more = False
+        for kind, (last, sent) in cursor.items():
+            buffer = self.rows[kind]
+            rows = buffer[bisect.bisect_left(buffer, (last + 1,)):]
+            new_ids[kind], new_cursor[kind], kind_more = walk(rows, [last, sent], self.horizon, FEED_LIMIT)
+            more = more or kind_more
+        return events_from(new_ids), new_cursor, more
+
+    def catch_up(self, cursor):
+        """
+        (events, new cursor, more) from the database for a cursor behind the buffer.
+        The new cursor is moved up to the buffer when every row before it was sent.
+        """
+        with primary():
+            events, cursor, more = feed_events(self.lab_id, cursor)
+        if not more:
+            for kind, (last, sent) in cursor.items():
+                last = max(last, self.watermark[kind])
+                cursor[kind] = [last, [i for i in sent if i > last]]
+        return events, cursor, more
+
+    def wait(self, cursor, timeout):
+        # Block until there are events after cursor, or the timeout
+        deadline = time.monotonic() + timeout
+        if self.behind(cursor):
+            events, cursor, more = self.catch_up(cursor)
+            if events or more or self.behind(cursor):
+                return events, cursor, more
+        with self.condition:
+            self.subscribers += 1
+            try:
+                while True:
+                    events, new_cursor, more = self.events_after(cursor)
+                    remaining = deadline - time.monotonic()
+                    if events or remaining <= 0:
+                        return events, new_cursor, more
+                    self.condition.wait(remaining)
+            finally:
+                self.subscribers -= 1
+                self.last_used = time.monotonic()
+
+    async def wait_async(self, cursor, timeout, catch_up):
+        # As wait, on the event loop: catch_up runs self.catch_up off the loop
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        if self.behind(cursor):
+            events, cursor, more = await catch_up(cursor)
+            if events or more or self.behind(cursor):
+                return events, cursor, more
+        waiter = asyncio.Event()
+        def wake():
+            try:
+                loop.call_soon_threadsafe(waiter.set)
+            except RuntimeError:
+                # the loop is closed
+                pass
+        with self.condition:
+            self.waiters.add(wake)
+            self.subscribers += 1
+        try:
+            while True:
+                waiter.clear()
+                with self.condition:
+                    events, new_cursor, more = self.events_after(cursor)
+                remaining = deadline - loop.time()
+                if events or remaining <= 0:
+                    return events, new_cursor, more
+                try:
+                    await asyncio.wait_for(waiter.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.condition:
+                self.waiters.discard(wake)
+                self.subscribers -= 1
+                self.last_used = time.monotonic()
+
+
+class Broker:
+    """
+    The lab feeds of this process, and the thread polling them
+    """
+    def __init__(self, size=FEED_BUFFER):
+        self.size = size
+        self.lock = threading.Lock()
+        self.feeds = {}
+        self.thread = None
+
+    def feed(self, lab_id):
+        """
+        The feed of a lab, polled once before it is returned. Queries the
+        database the first time, call it off the event loop.
+        """
+        with self.lock:
+            feed = self.feeds.get(lab_id)
+            if feed is None:
+                feed = self.feeds[lab_id] = LabFeed(lab_id, self.size)
+            feed.last_used = time.monotonic()
+            if self.thread is None and getattr(settings, 'BREADBOARD_FEED_POLLER', True):
+                self.thread = threading.Thread(target=self.run, name='livefeed-poller', daemon=True)
+                self.thread.start()
+        feed.poll(first=True)
+        return feed
+
+    def active_feeds(self):
+        # Feeds with subscribers, or used recently. Stops the thread when there are none
+        with self.lock:
+            now = time.monotonic()
+            for lab_id, feed in list(self.feeds.items()):
+                if not feed.subscribers and now - feed.last_used > FEED_IDLE:
+                    del self.feeds[lab_id]
+            if not self.feeds:
+                self.thread = None
+            return list(self.feeds.values())
+
+    def run(self):
+        while True:
+            feeds = self.active_feeds()
+            if not feeds:
+                return
+            more = False
+            for feed in feeds:
+                try:
+                    more = feed.poll() or more
+                except Exception:
+                    logger.exception('Live feed poll of lab %s failed', feed.lab_id)
+            close_old_connections()
+            if not more:
+                time.sleep(FEED_POLL_INTERVAL)
+
+
+broker = Broker()
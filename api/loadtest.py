@@ -0,0 +1,59 @@
+"""
+Load test of a running breadboard server.
+
+load_test sends requests to a list of paths from concurrent clients, and
+reports the throughput and latency percentiles per path. Run it against the
+WSGI (gunicorn) and ASGI (uvicorn) deployments with the same settings to
+compare them: `python manage.py loadtest <url> --token <token> --output sync.json`.
+"""
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from api.middleware import percentile
+
+
+def fetch(url, headers, timeout):
+    # (latency, status) of a GET request, status None when it didn't complete
+    request = urllib.request.Request(url, headers=headers)
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = None
+    return time.perf_counter() - start, status
+
+
+def load_test(base_url, paths, token=None, concurrency=50, requests=500, timeout=30):
+    """
+    Send requests GET requests to each path, concurrency at a time. Returns a list of results.
+    """
+    headers = {'Accept-Encoding': 'gzip'}
+    if token:
+        headers['Authorization'] = 'Token ' + token
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for path in paths:
+            url = base_url.rstrip('/') + path
+            start = time.perf_counter()
+            samples = list(executor.map(lambda i: fetch(url, headers, timeout), range(requests)))
+            elapsed = time.perf_counter() - start
+            latencies = sorted(latency for latency, status in samples)
+            errors = sum(1 for latency, status in samples if status is None or status >= 400)
+            results.append({
+                'name': path,
+                'requests': requests,
+                'concurrency': concurrency,
+                'errors': errors,
+                'requests_per_s': round(requests/elapsed, 1),
+                'p50_ms': round(1000*percentile(latencies, 50), 2),
+                'p90_ms': round(1000*percentile(latencies, 90), 2),
+                'p99_ms': round(1000*percentile(latencies, 99), 2),
+                'max_ms': round(1000*latencies[-1], 2),
+            })
+    return results
@@ -0,0 +1,72 @@
+import json
+import platform
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from api.benchmarks import generate_lab, run_benchmarks, compare
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the image and run endpoints on a synthetic lab, and write the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=1000)
+        parser.add_argument('--images', type=int, default=2000)
+        parser.add_argument('--params', type=int, default=20, help='number of parameter keys per run')
+        parser.add_argument('--datasets', type=int, default=10)
+        parser.add_argument('--batch', type=int, default=200, help='images or runs per request')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--only', nargs='*', help='only run scenarios containing these strings')
+        parser.add_argument('--output', help='file to write the results to')
+        parser.add_argument('--compare', help='results file of a previous benchmark to compare with')
+        parser.add_argument('--threshold', type=float, default=0.2, help='slowdown flagged as a regression')
+        parser.add_argument('--keep', action='store_true', help='keep the synthetic lab in the database')
+
+    def handle(self, *args, **options):
+        if options['batch'] > min(options['runs'], options['images']):
+            raise CommandError('--batch must not be larger than --runs and --images')
+
+        meta = {
+            'date': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'runs': options['runs'],
+            'images': options['images'],
+            'params': options['params'],
+            'datasets': options['datasets'],
+            'batch': options['batch'],
+        }
+        # Everything happens in a transaction, rolled back at the end unless --keep
+        try:
+            with transaction.atomic():
+                self.stdout.write('Generating synthetic lab...')
+                lab = generate_lab('benchmark-%s' % timezone.now().strftime('%Y%m%d%H%M%S'),
+                            runs=options['runs'], images=options['images'],
+                            parameter_keys=options['params'], datasets=options['datasets'])
+                results = run_benchmarks(lab, repeat=options['repeat'], batch=options['batch'], only=options['only'])
+                if not options['keep']:
+                    raise Rollback()
+        except Rollback:
+            pass
+
+        for result in results:
+            self.stdout.write('%-32s %10.2f ms %6d queries %10s items/s' % (
+                    result['name'], result['mean_ms'], result['queries'], result['items_per_s']))
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)['results']
+            self.stdout.write(self.style.MIGRATE_HEADING('Compared to ' + options['compare']))
+            for name, ratio, regressed in compare(results, baseline, options['threshold']):
+                line = '%-32s %6.2fx' % (name, ratio) if ratio is not None else name
+                self.stdout.write(self.style.ERROR(line + ' regression') if regressed else line)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'meta': meta, 'results': results}, f, indent=2)
+            self.stdout.write('Results written to ' + options['output'])
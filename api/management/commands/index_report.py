@@ -0,0 +1,77 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from api.models import Image, Run, Lab
+
+
+INDEX_USAGE_SQL = """
+    SELECT relname, indexrelname, idx_scan, idx_tup_read, idx_tup_fetch,
+           pg_size_pretty(pg_relation_size(indexrelid))
+    FROM pg_stat_user_indexes
+    WHERE relname IN %s
+    ORDER BY relname, indexrelname
+"""
+
+TABLE_USAGE_SQL = """
+    SELECT relname, seq_scan, seq_tup_read, idx_scan, n_live_tup
+    FROM pg_stat_user_tables
+    WHERE relname IN %s
+    ORDER BY relname
+"""
+
+
+class Command(BaseCommand):
+    help = 'Report index usage and EXPLAIN plans for the image and run queries issued by the API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('lab', help='lab name used for the sample queries')
+        parser.add_argument('--hours', type=float, default=24, help='width of the sample datetime range')
+        parser.add_argument('--analyze', action='store_true', help='run EXPLAIN ANALYZE (executes the queries)')
+
+    def sample_queries(self, lab, hours):
+        # The queries issued by ImageViewSet and RunViewSet, for a representative window
+        latest = lab.images.order_by('-created').values_list('created', flat=True).first()
+        if latest is None:
+            raise CommandError('Lab "%s" has no images' % lab.name)
+        window = (latest - timedelta(hours=hours), latest)
+        names = list(lab.images.order_by('-created').values_list('name', flat=True)[:10])
+        return [
+            ('images: Quick', lab.images.all()[:200]),
+            ('images: DateTimeRange', lab.images.select_related('run').filter(created__range=window)[:200]),
+            ('images: Names', lab.images.select_related('run').filter(name__in=names)),
+            ('images: NamesCreated lookup', lab.images.filter(name__in=names, created__range=window)),
+            ('runs: lab and runtime range', Run.objects.filter(lab__name=lab.name, runtime__range=window)[:200]),
+            ('runs: runtime range', Run.objects.filter(runtime__range=window)[:200]),
+            ('runs: matching window', Run.objects.filter(lab=lab, runtime__range=window).order_by('runtime', 'id')),
+            ('runs: parameters containment', Run.objects.filter(lab=lab, parameters__contains={'TOF': 0})[:200]),
+        ]
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Index reports need a postgres database')
+        try:
+            lab = Lab.objects.get(name=options['lab'])
+        except Lab.DoesNotExist:
+            raise CommandError('Lab "%s" does not exist' % options['lab'])
+
+        tables = (Image._meta.db_table, Run._meta.db_table)
+        with connection.cursor() as cursor:
+            self.stdout.write(self.style.MIGRATE_HEADING('Table scans'))
+            cursor.execute(TABLE_USAGE_SQL, [tables])
+            for row in cursor.fetchall():
+                self.stdout.write('  %-12s seq_scan=%s seq_tup_read=%s idx_scan=%s rows=%s' % row)
+
+            self.stdout.write(self.style.MIGRATE_HEADING('Index usage'))
+            cursor.execute(INDEX_USAGE_SQL, [tables])
+            for row in cursor.fetchall():
+                self.stdout.write('  %-12s %-40s scans=%s read=%s fetched=%s size=%s' % row)
+
+        for label, queryset in self.sample_queries(lab, options['hours']):
+            self.stdout.write(self.style.MIGRATE_HEADING('EXPLAIN ' + label))
+            plan = queryset.explain(analyze=options['analyze'])
+            if 'Seq Scan' in plan:
+                self.stdout.write(self.style.WARNING('  sequential scan in plan'))
+            for line in plan.splitlines():
+                self.stdout.write('  ' + line)
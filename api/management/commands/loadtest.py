@@ -0,0 +1,58 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.loadtest import load_test
+
+
+DEFAULT_PATHS = [
+    '/images/?lab={lab}',
+    '/images/?lab={lab}&pagination=cursor',
+    '/runs/?lab={lab}',
+    '/runs/?lab={lab}&pagination=cursor',
+]
+
+
+class Command(BaseCommand):
+    help = 'Load test a running server (WSGI or ASGI) on the image and run lists, and write the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help='base url of the server, eg. http://localhost:8000')
+        parser.add_argument('--lab', default='bec1')
+        parser.add_argument('--token', help='api token of the requests')
+        parser.add_argument('--paths', nargs='*', help='paths to request, {lab} is replaced by --lab')
+        parser.add_argument('--concurrency', type=int, default=50, help='concurrent clients')
+        parser.add_argument('--requests', type=int, default=500, help='requests per path')
+        parser.add_argument('--output', help='file to write the results to')
+        parser.add_argument('--compare', help='results file of a previous load test to compare with')
+
+    def handle(self, *args, **options):
+        paths = [path.format(lab=options['lab']) for path in options['paths'] or DEFAULT_PATHS]
+        results = load_test(options['url'], paths, token=options['token'],
+                    concurrency=options['concurrency'], requests=options['requests'])
+
+        for result in results:
+            self.stdout.write('%-40s %8.1f req/s  p50 %8.2f ms  p99 %8.2f ms  %d errors' % (
+                    result['name'], result['requests_per_s'], result['p50_ms'], result['p99_ms'], result['errors']))
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = {result['name']: result for result in json.load(f)['results']}
+            self.stdout.write(self.style.MIGRATE_HEADING('Compared to ' + options['compare']))
+            for result in results:
+                old = baseline.get(result['name'])
+                if old and old['requests_per_s'] and old['p99_ms']:
+                    self.stdout.write('%-40s %6.2fx throughput  %6.2fx p99' % (result['name'],
+                            result['requests_per_s']/old['requests_per_s'], result['p99_ms']/old['p99_ms']))
+
+        if options['output']:
+            meta = {
+                'date': timezone.now().isoformat(),
+                'url': options['url'],
+                'concurrency': options['concurrency'],
+                'requests': options['requests'],
+            }
+            with open(options['output'], 'w') as f:
+                json.dump({'meta': meta, 'results': results}, f, indent=2)
+            self.stdout.write('Results written to ' + options['output'])
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from api.models import Image, Lab
+from api.ingest import DEFAULT_DELTA
+from api.matching import RunMatcher, MATCH_POLICIES
+from api.cache import invalidate
+
+
+class Command(BaseCommand):
+    help = 'Match the images of a lab to runs in a single pass (backfill or re-match)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('lab', help='lab name')
+        parser.add_argument('--start', help='only images created after this datetime')
+        parser.add_argument('--end', help='only images created before this datetime')
+        parser.add_argument('--delta', type=float, default=DEFAULT_DELTA, help='matching window in seconds')
+        parser.add_argument('--policy', choices=MATCH_POLICIES, default='nearest')
+        parser.add_argument('--all', action='store_true', help='re-match images which already have a run')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        try:
+            lab = Lab.objects.get(name=options['lab'])
+        except Lab.DoesNotExist:
+            raise CommandError('Lab "%s" does not exist' % options['lab'])
+
+        images = lab.images.only('id', 'created', 'run', 'updated')
+        if not options['all']:
+            images = images.filter(run__isnull=True)
+        if options['start']:
+            images = images.filter(created__gte=parse_datetime(options['start']))
+        if options['end']:
+            images = images.filter(created__lte=parse_datetime(options['end']))
+        images = list(images)
+
+        created_times = [img.created for img in images]
+        matcher = RunMatcher(lab, created_times, options['delta'], policy=options['policy'])
+        changed = []
+        now = timezone.now()
+        for img, run in zip(images, matcher.match(created_times)):
+            if run is not None and img.run_id != run.id:
+                img.run = run
+                img.updated = now
+                changed.append(img)
+
+        if not options['dry_run']:
+            Image.objects.bulk_update(changed, ['run', 'updated'], batch_size=1000)
+            invalidate('Image')
+        self.stdout.write('%d images checked, %d matched to runs' % (len(images), len(changed)))
@@ -0,0 +1,34 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from api.models import Run
+
+
+class Command(BaseCommand):
+    help = ('Create (or drop) an expression index for numeric range filters on one key of Run.parameters, '
+            'eg. ?param.TOF__gte=2. Exact filters already use the GIN index.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('key', help='parameter name, eg. TOF')
+        parser.add_argument('--drop', action='store_true')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Parameter indexes need a postgres database')
+        key = options['key']
+        name = 'run_param_%s_num' % re.sub(r'\W', '_', key).lower()[:30]
+        with connection.cursor() as cursor:
+            if options['drop']:
+                cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % connection.ops.quote_name(name))
+                self.stdout.write('Dropped index ' + name)
+                return
+            # Same expression as api.filters.JSONNumber, so that the planner can use it
+            value = "(%s -> %%s)" % connection.ops.quote_name('parameters')
+            cursor.execute(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s "
+                "((CASE WHEN jsonb_typeof(%s) = 'number' THEN (%s)::text::double precision END))" % (
+                    connection.ops.quote_name(name), connection.ops.quote_name(Run._meta.db_table), value, value),
+                [key, key])
+        self.stdout.write('Created index ' + name)
@@ -0,0 +1,55 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from api.imagestats import pending_images, process_batch
+
+
+class Command(BaseCommand):
+    help = 'Compute the statistics (total atoms, centroid, widths, peak OD) of the images with files, in a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lab', help='only process the images of this lab')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes (default: one per cpu)')
+        parser.add_argument('--batch', type=int, default=200, help='images saved per update')
+        parser.add_argument('--limit', type=int, help='stop after this many images')
+        parser.add_argument('--reprocess', action='store_true', help='also process images which have stats')
+        parser.add_argument('--watch', type=float, metavar='SECONDS',
+                    help='keep running, looking for new images every SECONDS')
+
+    def handle(self, *args, **options):
+        root = getattr(settings, 'BREADBOARD_IMAGE_ROOT', None)
+        if not root:
+            raise CommandError('BREADBOARD_IMAGE_ROOT is not configured')
+        queryset = pending_images(reprocess=options['reprocess'])
+        if options['lab']:
+            queryset = queryset.filter(lab__name=options['lab'])
+
+        # Workers are forked: they mustn't share the database connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            processed = 0
+            last_id = 0
+            while True:
+                # Keyset pagination: images that fail keep their error and aren't fetched again
+                images = list(queryset.filter(id__gt=last_id)[:options['batch']])
+                if options['limit'] is not None:
+                    images = images[:options['limit'] - processed]
+                if images:
+                    succeeded = process_batch(images, executor, root=root)
+                    processed += len(images)
+                    last_id = images[-1].id
+                    self.stdout.write('Processed %d images (%d errors), %d in total' % (
+                                len(images), len(images) - succeeded, processed))
+                    if options['limit'] is None or processed < options['limit']:
+                        continue
+                if not options['watch'] or (options['limit'] is not None and processed >= options['limit']):
+                    break
+                # Next pass: images without stats, including older ones which got files since
+                queryset = pending_images(queryset)
+                last_id = 0
+                time.sleep(options['watch'])
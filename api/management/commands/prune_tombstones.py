@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.models import Tombstone
+from api.views.syncviews import TOMBSTONE_RETENTION
+
+
+class Command(BaseCommand):
+    help = 'Delete the tombstones older than BREADBOARD_TOMBSTONE_RETENTION_DAYS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='only count the tombstones to delete')
+
+    def handle(self, *args, **options):
+        tombstones = Tombstone.objects.filter(deleted__lt=timezone.now() - TOMBSTONE_RETENTION)
+        if options['dry_run']:
+            self.stdout.write('%d tombstones to delete' % tombstones.count())
+            return
+        count, _ = tombstones.delete()
+        self.stdout.write('Deleted %d tombstones' % count)
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Dataset
+from api.summaries import refresh_summary
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the parameter summaries of datasets from their runs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('datasets', nargs='*', type=int, help='ids of the datasets (default: all)')
+        parser.add_argument('--lab', help='only the datasets of this lab')
+        parser.add_argument('--missing', action='store_true', help='only the datasets without a summary')
+
+    def handle(self, *args, **options):
+        datasets = Dataset.objects.order_by('id')
+        if options['datasets']:
+            datasets = datasets.filter(id__in=options['datasets'])
+        if options['lab']:
+            datasets = datasets.filter(lab__name=options['lab'])
+        if options['missing']:
+            datasets = datasets.filter(summary__isnull=True)
+        count = 0
+        for dataset_id in datasets.values_list('id', flat=True).iterator():
+            summary = refresh_summary(dataset_id)
+            count += 1
+            self.stdout.write('Dataset %d: %d runs, %d parameters' % (
+                        dataset_id, summary.run_count, len(summary.value_counts)))
+        self.stdout.write('Refreshed %d summaries' % count)
@@ -0,0 +1,88 @@
+"""
+Matching of image created times to run times.
+Candidate runtimes for the covered time window are loaded once, sorted, and
+every image is assigned a run with a binary search (numpy searchsorted).
+"""
+from datetime import timedelta
+
+import numpy as np
+
+from api.models import Run
+
+
+# Policies for choosing between several runs within delta of an image
+MATCH_POLICIES = [
+    'nearest',  # the run closest in time (earliest run on exact ties)
+    'earliest', # the earliest run within delta
+    'latest',   # the latest run within delta
+]
+
+
+def to_seconds(datetimes):
+    # Timezone aware datetimes to an array of POSIX timestamps
+    return np.array([dt.timestamp() for dt in datetimes], dtype=np.float64)
+
+
+def match_times(created, runtimes, delta, policy='nearest'):
+    """
+    Assign every created time the index of a runtime within +- delta.
+
+    created and runtimes are arrays of timestamps in seconds, runtimes must be sorted.
+    Returns an integer array of indices into runtimes, with -1 where no run is in range.
+    """
+    if policy not in MATCH_POLICIES:
+        raise ValueError('Unknown match policy: ' + str(policy))
+    created = np.asarray(created, dtype=np.float64)
+    runtimes = np.asarray(runtimes, dtype=np.float64)
+    matches = np.full(created.shape, -1, dtype=np.int64)
+    if runtimes.size==0 or created.size==0:
+        return matches
+
+    # Window of runtimes within [created - delta, created + delta] for every image
+    lo = np.searchsorted(runtimes, created - delta, side='left')
+    hi = np.searchsorted(runtimes, created + delta, side='right')
+    found = hi > lo
+
+    if policy=='earliest':
+        matches[found] = lo[found]
+    elif policy=='latest':
+        matches[found] = hi[found] - 1
+    else:
+        # The nearest run is one of the two neighbours of the insertion point
+        right = np.clip(np.searchsorted(runtimes, created, side='left'), 0, runtimes.size-1)
+        left = np.clip(right - 1, 0, runtimes.size-1)
+        nearest = np.where(
+                    np.abs(created - runtimes[left]) <= np.abs(runtimes[right] - created),
+                    left, right)
+        matches[found] = nearest[found]
+    return matches
+
+
+class RunMatcher:
+    """
+    Matches many created times to the runs of a lab in a single pass.
+    Usage:
+        matcher = RunMatcher(lab, created_times, delta=7)
+        runs = matcher.match(created_times) # list of runs or None
+    """
+    def __init__(self, lab, created_times, delta, policy='nearest', queryset=None):
+        self.delta = delta
+        self.policy = policy
+        self.runs = []
+        self.runtimes = np.array([], dtype=np.float64)
+        if not created_times:
+            return
+
+        # Load the candidate runs for the covered time window once
+        runtime_delta = timedelta(seconds=delta)
+        if queryset is None:
+            queryset = Run.objects.all()
+        self.runs = list(queryset.filter(
+                    lab=lab,
+                    runtime__range=(min(created_times)-runtime_delta, max(created_times)+runtime_delta),
+                ).order_by('runtime', 'id'))
+        self.runtimes = to_seconds([run.runtime for run in self.runs])
+
+    def match(self, created_times):
+        indices = match_times(to_seconds(created_times), self.runtimes, self.delta, policy=self.policy)
+        return [self.runs[i] if i>=0 else None for i in indices]
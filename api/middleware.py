@@ -0,0 +1,193 @@
+"""
+Middleware for the api.
+QueryStatsMiddleware records latency, SQL query count and SQL time per view,
+adds them to a Server-Timing header, and logs slow requests with their queries.
+CompressionMiddleware compresses responses with brotli, zstd or gzip.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+
+SLOW_REQUEST_MS = getattr(settings, 'BREADBOARD_SLOW_REQUEST_MS', 1000)
+STATS_WINDOW = 1000 # requests kept per view for the percentiles
+
+
+class QueryRecorder:
+    """
+    Database execute wrapper, counting queries and the time spent in them
+    """
+    def __init__(self):
+        self.count = 0
+        self.time = 0
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.time += duration
+            self.queries.append((duration, sql))
+
+
+def percentile(values, q):
+    # values must be sorted
+    if not values:
+        return None
+    return values[min(len(values)-1, int(q/100*len(values)))]
+
+
+class RequestStats:
+    """
+    Per view stats of the latest requests handled by this process
+    """
+    def __init__(self, window=STATS_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.samples = defaultdict(lambda: deque(maxlen=self.window))
+            self.totals = defaultdict(int)
+
+    def record(self, view, latency, queries, sql_time):
+        with self.lock:
+            self.samples[view].append((latency, queries, sql_time))
+            self.totals[view] += 1
+
+    def summary(self):
+        with self.lock:
+            samples = {view: list(values) for view, values in self.samples.items()}
+            totals = dict(self.totals)
+        summary = {}
+        for view, values in sorted(samples.items()):
+            latencies, queries, sql_times = (sorted(column) for column in zip(*values))
+            summary[view] = {
+                'requests': totals[view],
+                'latency_ms': {
+                    'p50': round(1000*percentile(latencies, 50), 2),
+                    'p90': round(1000*percentile(latencies, 90), 2),
+                    'p99': round(1000*percentile(latencies, 99), 2),
+                    'max': round(1000*latencies[-1], 2),
+                },
+                'queries': {
+                    'p50': percentile(queries, 50),
+                    'p90': percentile(queries, 90),
+                    'max': queries[-1],
+                },
+                'sql_ms': {
+                    'p50': round(1000*percentile(sql_times, 50), 2),
+                    'p90': round(1000*percentile(sql_times, 90), 2),
+                    'max': round(1000*sql_times[-1], 2),
+                },
+            }
+        return summary
+
+
+request_stats = RequestStats()
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    name = (match.view_name if match is not None else None) or request.path
+    return request.method + ' ' + name
+
+
+class QueryStatsMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        latency = time.perf_counter() - start
+
+        view = view_name(request)
+        request_stats.record(view, latency, recorder.count, recorder.time)
+        response['Server-Timing'] = 'total;dur=%.1f, db;dur=%.1f;desc="%d queries"' % (
+                    1000*latency, 1000*recorder.time, recorder.count)
+
+        if 1000*latency > SLOW_REQUEST_MS:
+            logger.warning('Slow request: %s %s took %.0f ms, %d queries in %.0f ms\n%s',
+                    view, request.get_full_path(), 1000*latency, recorder.count, 1000*recorder.time,
+                    '\n'.join('  %.1f ms: %s' % (1000*duration, sql) for duration, sql in recorder.queries))
+        return response
+
+
+def compressors():
+    # Available encodings, in order of preference
+    available = []
+    if brotli is not None:
+        available.append(('br', lambda content: brotli.compress(content, quality=5)))
+    if zstandard is not None:
+        available.append(('zstd', lambda content: zstandard.ZstdCompressor(level=6).compress(content)))
+    return available
+
+
+def accepted_encodings(request):
+    # Encodings in the Accept-Encoding header, without the ones refused with q=0
+    accepted = set()
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = item.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """
+    Compresses responses with brotli or zstd when the client accepts them and
+    the libraries are installed, and with gzip otherwise (as GZipMiddleware)
+    """
+    def process_response(self, request, response):
+        accepted = accepted_encodings(request)
+        available = [(name, compress) for name, compress in compressors() if name in accepted]
+        if not available or response.streaming:
+            return super().process_response(request, response)
+
+        # Same rules as GZipMiddleware: skip short or already encoded responses
+        if len(response.content) < 200 or response.has_header('Content-Encoding'):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        name, compress = available[0]
+        compressed = compress(response.content)
+        if len(compressed) >= len(response.content):
+            return response
+        response.content = compressed
+        response['Content-Length'] = str(len(response.content))
+        # The ETag of the uncompressed content is only a weak validator now
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = name
+        return response
@@ -0,0 +1,42 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:12
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+def add_index_concurrently(model_name, index, columns, method='btree'):
+    # CREATE INDEX without CONCURRENTLY blocks the writes to the table for the whole build.
+    # Django 2.2 has no AddIndexConcurrently: same state, built with RunSQL
+    return migrations.RunSQL(
+        sql='CREATE INDEX CONCURRENTLY IF NOT EXISTS "%s" ON "api_%s" USING %s (%s)' % (
+                    index.name, model_name, method, columns),
+        reverse_sql='DROP INDEX CONCURRENTLY IF EXISTS "%s"' % index.name,
+        state_operations=[migrations.AddIndex(model_name=model_name, index=index)],
+    )
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('api', '0012_remove_run_workday'),
+    ]
+
+    operations = [
+        add_index_concurrently('image',
+            models.Index(fields=['lab', 'name'], name='image_lab_name_idx'),
+            '"lab_id", "name"'),
+        add_index_concurrently('image',
+            models.Index(fields=['lab', '-created', 'name'], name='image_lab_created_idx'),
+            '"lab_id", "created" DESC, "name"'),
+        add_index_concurrently('run',
+            models.Index(fields=['lab', '-runtime'], name='run_lab_runtime_idx'),
+            '"lab_id", "runtime" DESC'),
+        add_index_concurrently('run',
+            models.Index(fields=['-runtime'], name='run_runtime_idx'),
+            '"runtime" DESC'),
+        add_index_concurrently('run',
+            django.contrib.postgres.indexes.GinIndex(fields=['parameters'], name='run_parameters_gin'),
+            '"parameters"', method='gin'),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 2.2.13 on 2026-10-18 11:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now, verbose_name='datetime last modified'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now, verbose_name='datetime last modified'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now, verbose_name='datetime last modified'),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=20, verbose_name='name of the model of the deleted object')),
+                ('object_id', models.IntegerField(verbose_name='id of the deleted object')),
+                ('deleted', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='datetime deleted')),
+                ('lab', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='tombstones', to='api.Lab')),
+            ],
+            options={
+                'verbose_name': 'tombstone',
+                'verbose_name_plural': 'tombstones',
+                'ordering': ['deleted', 'id'],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.13 on 2026-10-18 14:20
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_updated_tombstone'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='stats',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True, verbose_name='statistics computed from the image files, see api/imagestats.py'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.13 on 2026-10-18 15:05
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import api.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_image_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatasetSummary',
+            fields=[
+                ('run_count', models.IntegerField(default=0, verbose_name='number of runs')),
+                ('first_runtime', models.DateTimeField(blank=True, null=True, verbose_name='runtime of the first run')),
+                ('last_runtime', models.DateTimeField(blank=True, null=True, verbose_name='runtime of the last run')),
+                ('value_counts', django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=api.models.default_params, verbose_name='number of runs per parameter and JSON encoded value')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='datetime last modified')),
+                ('dataset', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='api.Dataset')),
+            ],
+            options={
+                'verbose_name': 'dataset summary',
+                'verbose_name_plural': 'dataset summaries',
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.13 on 2026-10-18 18:40
+
+from django.db import migrations
+from django.db.models import Count, Max, Min
+
+from api.summaries import parameter_value_counts
+
+
+def create_missing_summaries(apps, schema_editor):
+    # Summaries were built on the first read of each dataset: build the missing ones
+    Dataset = apps.get_model('api', 'Dataset')
+    DatasetSummary = apps.get_model('api', 'DatasetSummary')
+    Run = apps.get_model('api', 'Run')
+    using = schema_editor.connection.alias
+    missing = Dataset.objects.using(using).filter(summary__isnull=True).order_by('id')
+    for dataset_id in missing.values_list('id', flat=True).iterator():
+        bounds = Run.objects.using(using).filter(dataset_id=dataset_id).order_by().aggregate(
+                    first=Min('runtime'), last=Max('runtime'), count=Count('id'))
+        DatasetSummary.objects.using(using).create(dataset_id=dataset_id,
+                    run_count=bounds['count'], first_runtime=bounds['first'], last_runtime=bounds['last'],
+                    value_counts=parameter_value_counts(dataset_id, using))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_datasetsummary'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_missing_summaries, migrations.RunPython.noop),
+    ]
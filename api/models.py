@@ -3,9 +3,10 @@ import datetime
 from django.db import models
 from django.conf import settings
 from django.contrib.postgres.fields import JSONField, ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from django.utils import timezone
 
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_delete, post_delete
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 
@@ -66,6 +67,8 @@ class Image(models.Model):
     settings = JSONField('additional settings, such as Isat, fudge, subsample, etc', default=default_params, blank=True, null=True)
     pixel_size = models.FloatField(default=1, blank=True, null=True)
     bad_shot = models.NullBooleanField('Was this image a bad shot?', default=False, blank=True)
+    stats = JSONField('statistics computed from the image files, see api/imagestats.py', blank=True, null=True)
+    updated = models.DateTimeField('datetime last modified', auto_now=True, db_index=True)
     # Choices for atoms in the image. Can be used for processing, and integration with camera UIs
     LITHIUM = 'Li'
     SODIUM = 'Na'
@@ -91,6 +94,10 @@ class Image(models.Model):
         ordering = ['-created', 'name']
         verbose_name = 'image'
         verbose_name_plural =  'images'
+        indexes = [
+            models.Index(fields=['lab', 'name'], name='image_lab_name_idx'),
+            models.Index(fields=['lab', '-created', 'name'], name='image_lab_created_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -108,6 +115,7 @@ class Run(models.Model):
     runtime = models.DateTimeField('datetime for expt run', default=timezone.now , blank=True)
     parameters = JSONField('Variables and parameters', default=default_params, blank=True, null=True)
     notes = models.TextField('Run notes', default='', blank=True, null=True)
+    updated = models.DateTimeField('datetime last modified', auto_now=True, db_index=True)
 
     # Relationships
     lab = models.ForeignKey('Lab', on_delete=models.PROTECT, related_name='runs', null=True, blank=True)
@@ -117,6 +125,11 @@ class Run(models.Model):
         ordering = ['-runtime']
         verbose_name = 'run'
         verbose_name_plural =  'runs'
+        indexes = [
+            models.Index(fields=['lab', '-runtime'], name='run_lab_runtime_idx'),
+            models.Index(fields=['-runtime'], name='run_runtime_idx'),
+            GinIndex(fields=['parameters'], name='run_parameters_gin'),
+        ]
 
     def __str__(self):
         return self.runtime.strftime("%Y-%m-%d %H:%M:%S")
@@ -132,6 +145,7 @@ class Dataset(models.Model):
     notes = models.TextField('Dataset notes', default='', blank=True, null=True)
     flag = models.CharField('Dataset flags', max_length=200, default='', blank=True, null=True)
     tags =  JSONField('tags for the dataset', default=default_params, blank=True, null=True)
+    updated = models.DateTimeField('datetime last modified', auto_now=True, db_index=True)
 
     # Relationships
     project = models.ForeignKey('Project', on_delete=models.SET_NULL,  blank=True, null=True, related_name='datasets')
@@ -148,6 +162,30 @@ class Dataset(models.Model):
 
 
 
+class DatasetSummary(models.Model):
+    """
+    Summary of the run parameters of a dataset, kept up to date as runs are
+    added and removed (see api/summaries.py)
+    """
+    run_count = models.IntegerField('number of runs', default=0)
+    first_runtime = models.DateTimeField('runtime of the first run', blank=True, null=True)
+    last_runtime = models.DateTimeField('runtime of the last run', blank=True, null=True)
+    value_counts = JSONField('number of runs per parameter and JSON encoded value', default=default_params, blank=True)
+    updated = models.DateTimeField('datetime last modified', auto_now=True)
+
+    # relationships
+    dataset = models.OneToOneField('Dataset', on_delete=models.CASCADE, primary_key=True, related_name='summary')
+
+    class Meta:
+        verbose_name = 'dataset summary'
+        verbose_name_plural =  'dataset summaries'
+
+    def __str__(self):
+        return 'Summary of dataset %d' % self.dataset_id
+
+
+
+
 class Project(models.Model):
     """
     Class for a project: a collection of datasets
@@ -185,3 +223,44 @@ class Lab(models.Model):
 
     def __str__(self):
         return self.name
+
+
+
+class Tombstone(models.Model):
+    """
+    Record of a deleted image, run or dataset, for clients syncing changes
+    """
+    model = models.CharField('name of the model of the deleted object', max_length=20)
+    object_id = models.IntegerField('id of the deleted object')
+    deleted = models.DateTimeField('datetime deleted', default=timezone.now, db_index=True)
+
+    # relationships
+    lab = models.ForeignKey('Lab', on_delete=models.CASCADE, related_name='tombstones', null=True, blank=True)
+
+    class Meta:
+        ordering = ['deleted', 'id']
+        verbose_name = 'tombstone'
+        verbose_name_plural =  'tombstones'
+
+    def __str__(self):
+        return '%s %d' % (self.model, self.object_id)
+
+
+@receiver(post_delete, sender=Image)
+@receiver(post_delete, sender=Run)
+@receiver(post_delete, sender=Dataset)
+def create_tombstone(sender, instance=None, **kwargs):
+    Tombstone.objects.create(
+        model=sender._meta.model_name,
+        object_id=instance.pk,
+        lab_id=instance.lab_id,
+    )
+
+
+@receiver(pre_delete, sender=Dataset)
+@receiver(pre_delete, sender=Project)
+def touch_set_null_children(sender, instance=None, **kwargs):
+    # Deleting sets their foreign key to null without signals or auto_now: bump updated
+    # so that /changes/ and the ETags see it
+    children = instance.runs if sender is Dataset else instance.datasets
+    children.update(updated=timezone.now())
@@ -0,0 +1,171 @@
+"""
+Asynchronous notifications for clients (eg. new images in a lab).
+
+Events are enqueued once the database transaction commits, and delivered from
+a background thread: bursts of events for the same channel are coalesced into
+one message carrying all the ids. Requests never wait on the notification service.
+
+The backend is configured in settings.BREADBOARD_NOTIFICATIONS:
+    BREADBOARD_NOTIFICATIONS = {
+        'BACKEND': 'api.notifications.PusherBackend',
+        'COALESCE_WINDOW': 0.05, # seconds to wait for more events of a burst
+        'MAX_RETRIES': 3,
+    }
+"""
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BACKEND': 'api.notifications.PusherBackend',
+    'COALESCE_WINDOW': 0.05,
+    'MAX_RETRIES': 3,
+    'RETRY_DELAY': 0.5,
+    'MAX_IDS_PER_MESSAGE': 500, # keeps messages under the pusher size limit
+}
+
+EVENT_MESSAGES = {
+    'new-image': 'new image',
+}
+
+
+class PusherBackend:
+    """
+    Delivers events through the hosted pusher service
+    """
+    def __init__(self):
+        import pusher
+        from breadboard.secrets import secrets as secrets
+        self.client = pusher.Pusher(
+            app_id=secrets.PUSHER_APP_ID,
+            key=secrets.PUSHER_KEY,
+            secret=secrets.PUSHER_SECRET,
+            cluster='us2',
+            ssl=True
+        )
+
+    def send(self, channel, event, data):
+        self.client.trigger(channel, event, data)
+
+
+class InMemoryBackend:
+    """
+    Keeps delivered events in memory, for tests and offline labs
+    """
+    def __init__(self):
+        self.sent = []
+
+    def send(self, channel, event, data):
+        self.sent.append((channel, event, data))
+
+
+def coalesce(events, max_ids=DEFAULTS['MAX_IDS_PER_MESSAGE']):
+    # Merge events on the same channel into messages carrying all their ids
+    merged = OrderedDict()
+    for channel, event, ids in events:
+        merged.setdefault((channel, event), []).extend(ids)
+    for (channel, event), ids in merged.items():
+        for i in range(0, max(len(ids), 1), max_ids):
+            chunk = ids[i:i+max_ids]
+            yield channel, event, {
+                'message': EVENT_MESSAGES.get(event, event),
+                'ids': chunk,
+                'count': len(chunk),
+            }
+
+
+class NotificationDispatcher:
+    """
+    Queue of events, delivered by a background worker thread
+    """
+    def __init__(self, backend, coalesce_window=DEFAULTS['COALESCE_WINDOW'],
+                    max_retries=DEFAULTS['MAX_RETRIES'], retry_delay=DEFAULTS['RETRY_DELAY'],
+                    max_ids_per_message=DEFAULTS['MAX_IDS_PER_MESSAGE']):
+        self.backend = backend
+        self.coalesce_window = coalesce_window
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_ids_per_message = max_ids_per_message
+        self.queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def notify(self, channel, event, ids):
+        # Enqueue once the current transaction commits (or now, in autocommit mode)
+        ids = list(ids)
+        transaction.on_commit(lambda: self.enqueue(channel, event, ids))
+
+    def enqueue(self, channel, event, ids):
+        self.start()
+        self.queue.put((channel, event, list(ids)))
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='notifications', daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        # Block until every enqueued event has been delivered (or given up on)
+        self.queue.join()
+
+    def deliver(self, channel, event, data):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.backend.send(channel, event, data)
+                return True
+            except Exception:
+                logger.warning('Notification %s on %s failed (attempt %d)', event, channel, attempt+1, exc_info=True)
+                if attempt < self.max_retries:
+                    time.sleep(self.retry_delay * 2**attempt)
+        logger.error('Dropping notification %s on %s after %d attempts', event, channel, self.max_retries+1)
+        return False
+
+    def _run(self):
+        while True:
+            events = [self.queue.get()]
+            # Wait a little for the rest of the burst, then take everything queued
+            time.sleep(self.coalesce_window)
+            while True:
+                try:
+                    events.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for channel, event, data in coalesce(events, self.max_ids_per_message):
+                    self.deliver(channel, event, data)
+            finally:
+                for _ in events:
+                    self.queue.task_done()
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            config = dict(DEFAULTS, **getattr(settings, 'BREADBOARD_NOTIFICATIONS', {}))
+            _dispatcher = NotificationDispatcher(
+                backend=import_string(config['BACKEND'])(),
+                coalesce_window=config['COALESCE_WINDOW'],
+                max_retries=config['MAX_RETRIES'],
+                retry_delay=config['RETRY_DELAY'],
+                max_ids_per_message=config['MAX_IDS_PER_MESSAGE'],
+            )
+        return _dispatcher
+
+
+def notify(channel, event, ids):
+    get_dispatcher().notify(channel, event, ids)
@@ -0,0 +1,61 @@
+"""
+Pagination styles for the api.
+The default is LimitOffsetPagination (settings.REST_FRAMEWORK). Clients walking
+through a whole lab can opt in to keyset (cursor) pagination per request with
+?pagination=cursor, which avoids OFFSET scans and the total COUNT(*).
+"""
+from rest_framework.pagination import CursorPagination
+from rest_framework.settings import api_settings
+
+from api.models import Image, Run
+
+
+PAGINATION_PARAMS = ('limit', 'offset', 'cursor', 'pagination')
+
+
+def wants_cursor(request):
+    # Cursor pagination is opt-in: ?pagination=cursor, or a cursor from a previous page
+    query_params = request.query_params
+    return query_params.get('pagination')=='cursor' or 'cursor' in query_params
+
+
+def strip_pagination_params(query_params):
+    # The query parameters of a request, without the ones used for pagination
+    return {k: v for k, v in query_params.items() if k not in PAGINATION_PARAMS}
+
+
+class ImageCursorPagination(CursorPagination):
+    ordering = Image._meta.ordering
+    page_size_query_param = 'limit'
+    max_page_size = 1000
+
+
+class RunCursorPagination(CursorPagination):
+    ordering = Run._meta.ordering
+    page_size_query_param = 'limit'
+    max_page_size = 1000
+
+
+def get_paginator(request, cursor_pagination_class=None):
+    # A new paginator for this request: paginators hold per-request state
+    if cursor_pagination_class is not None and wants_cursor(request):
+        return cursor_pagination_class()
+    return api_settings.DEFAULT_PAGINATION_CLASS()
+
+
+class OptInCursorPaginationMixin:
+    """
+    ViewSet mixin that switches to cursor_pagination_class when the request asks for it
+    """
+    cursor_pagination_class = None
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if self.cursor_pagination_class is not None and wants_cursor(self.request):
+                self._paginator = self.cursor_pagination_class()
+            elif self.pagination_class is None:
+                self._paginator = None
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
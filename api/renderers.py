@@ -0,0 +1,66 @@
+"""
+Renderers for the api.
+ORJSONRenderer renders with orjson when it is installed, and falls back to
+DRF's JSONRenderer otherwise. Differences with the stdlib json module:
+    datetimes in UTC end with Z, as DRF's encoder does
+    NaN and Infinity (eg. in Run.parameters) become null, so the output is valid JSON
+    Decimals, timedeltas, uuids, lazy strings etc. go through DRF's encoder
+dumps and sanitize give the same output outside of responses (eg. NDJSON exports).
+"""
+import json
+import math
+
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+_encoder = encoders.JSONEncoder()
+
+
+def default(obj):
+    # Types orjson doesn't know about
+    return _encoder.default(obj)
+
+
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+def sanitize(obj):
+    # NaN and Infinity to None, in nested dicts and lists
+    if isinstance(obj, float) and not math.isfinite(obj):
+        return None
+    if isinstance(obj, dict):
+        return {key: sanitize(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [sanitize(value) for value in obj]
+    return obj
+
+
+def dumps(data):
+    """
+    Valid JSON (bytes) of data, as rendered by ORJSONRenderer
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=default, option=ORJSON_OPTIONS)
+    return json.dumps(sanitize(data), cls=encoders.JSONEncoder, allow_nan=False, separators=(',', ':')).encode()
+
+
+class ORJSONRenderer(JSONRenderer):
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None:
+            return super().render(sanitize(data), accepted_media_type, renderer_context)
+        if data is None:
+            return b''
+        renderer_context = renderer_context or {}
+        option = ORJSON_OPTIONS
+        if self.get_indent(accepted_media_type, renderer_context):
+            # orjson only indents by two spaces
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(data, default=default, option=option)
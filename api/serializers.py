@@ -1,11 +1,17 @@
 import re
 
 from django.contrib.auth.models import User, Group
+from django.core.exceptions import FieldDoesNotExist
+from django.db import router, transaction
+from django.db.models import Count, Prefetch
+from django.utils import timezone
 from rest_framework import serializers
 from api.models import (
-        Image, Run, Dataset,
+        Image, Run, Dataset, DatasetSummary,
         Project, Lab, UserProfile
         )
+from api.summaries import build_summary, refresh_summaries, summary_data
+from api.cache import invalidate
 
 IMAGE_QUERY_MODES = [
     'Quick',
@@ -14,7 +20,181 @@ IMAGE_QUERY_MODES = [
     'DateTimeRange',
 ]
 
-class UserSerializer(serializers.ModelSerializer):
+# Representations of large reverse relations, chosen with ?related=
+RELATED_MODES = [
+    'ids',    # list of ids (default)
+    'count',  # number of related objects
+    'ranges', # [first, last] ranges of consecutive ids
+]
+
+
+def id_ranges(ids):
+    # Compress ids into [first, last] ranges of consecutive ids
+    ranges = []
+    for i in sorted(ids):
+        if ranges and i==ranges[-1][1]+1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ranges
+
+
+def get_related_mode(request):
+    if request is None or request.method!='GET':
+        return 'ids'
+    mode = request.query_params.get('related', 'ids')
+    return mode if mode in RELATED_MODES else 'ids'
+
+
+class RelatedSummaryMixin:
+    """
+    Serializer mixin for the reverse relations in summary_fields.
+    With ?related=count or ?related=ranges, they are read as counts or id ranges
+    instead of full lists of ids. Use prefetch_queryset to avoid a query per object.
+    """
+    summary_fields = ()
+
+    @property
+    def related_mode(self):
+        if not hasattr(self, '_related_mode'):
+            self._related_mode = get_related_mode(self.context.get('request'))
+        return self._related_mode
+
+    @property
+    def _readable_fields(self):
+        for field in super()._readable_fields:
+            if self.related_mode=='ids' or field.field_name not in self.summary_fields:
+                yield field
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        summary_fields = [name for name in self.summary_fields if name in self.fields]
+        if self.related_mode=='count':
+            for name in summary_fields:
+                count = getattr(instance, name + '_count', None)
+                data[name] = count if count is not None else getattr(instance, name).count()
+        elif self.related_mode=='ranges':
+            for name in summary_fields:
+                data[name] = id_ranges(obj.pk for obj in getattr(instance, name).all())
+        return data
+
+    @classmethod
+    def prefetch_queryset(cls, queryset, request):
+        # Fetch the related ids (or counts) for all the objects at once
+        if get_related_mode(request)=='count':
+            return queryset.annotate(**{name + '_count': Count(name, distinct=True) for name in cls.summary_fields})
+        prefetches = []
+        for name in cls.summary_fields:
+            relation = queryset.model._meta.get_field(name)
+            related = relation.related_model.objects.only('id', relation.field.name)
+            prefetches.append(Prefetch(name, queryset=related))
+        return queryset.prefetch_related(*prefetches)
+
+def split_names(value):
+    return [name for name in value.split(',') if name] if value else []
+
+
+def requested_fields(request):
+    """
+    Fields asked for with ?fields=name,run and ?exclude=tags,settings (reads only).
+    Returns (fields, exclude), lists which may be empty.
+    """
+    if request is None or request.method!='GET':
+        return [], []
+    return (split_names(request.query_params.get('fields')),
+            split_names(request.query_params.get('exclude')))
+
+
+def selected_field_names(serializer_class, request):
+    # Names of the fields of serializer_class that the request wants
+    fields, exclude = requested_fields(request)
+    names = list(serializer_class.Meta.fields)
+    if fields:
+        names = [name for name in names if name in fields]
+    return [name for name in names if name not in exclude]
+
+
+def model_column_names(serializer_class, names):
+    """
+    Model fields backing the serializer fields in names, or None if some
+    fields need more than the model's own columns (urls, nested serializers, reverse relations)
+    """
+    model = serializer_class.Meta.model
+    columns = []
+    for name in names:
+        if name=='url' or name in serializer_class._declared_fields:
+            return None
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if not field.concrete or field.many_to_many:
+            return None
+        columns.append(name)
+    return columns
+
+
+def sparse_queryset(queryset, serializer_class, request):
+    """
+    Push a sparse fieldset down to the queryset: only fetch the columns needed
+    """
+    fields, exclude = requested_fields(request)
+    if not (fields or exclude):
+        return queryset
+    names = selected_field_names(serializer_class, request)
+    if any(name in serializer_class._declared_fields for name in names):
+        # Nested representations need the full related rows
+        return queryset
+    model = serializer_class.Meta.model
+    columns = []
+    for name in names:
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            continue
+        if field.concrete and not field.many_to_many:
+            columns.append(name)
+    return queryset.select_related(None).only(model._meta.pk.name, *columns)
+
+
+def lean_queryset(queryset, serializer_class, request, ordering=()):
+    """
+    Fast path for read-only lists which only ask for plain columns (?fields=name,run):
+    rows come straight from queryset.values(), bypassing the serializer fields.
+    Returns (queryset of dicts, field names), or (None, None) when not possible.
+    The ordering fields are fetched too, for cursor pagination; use lean_rows to drop them.
+    """
+    fields, exclude = requested_fields(request)
+    if not fields:
+        return None, None
+    names = selected_field_names(serializer_class, request)
+    columns = model_column_names(serializer_class, names)
+    if not columns:
+        return None, None
+    extra = [field.lstrip('-') for field in ordering if field.lstrip('-') not in columns]
+    return queryset.select_related(None).values(*columns, *extra), columns
+
+
+def lean_rows(rows, names):
+    return [{name: row[name] for name in names} for row in rows]
+
+
+class SparseFieldsetMixin:
+    """
+    Serializer mixin for sparse fieldsets: ?fields=name,run only returns these
+    fields, ?exclude=tags,settings returns all the others
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields, exclude = requested_fields(self.context.get('request'))
+        if fields or exclude:
+            names = selected_field_names(type(self), self.context.get('request'))
+            for name in list(self.fields):
+                if name not in names:
+                    self.fields.pop(name)
+
+
+class UserSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     userprofile = serializers.PrimaryKeyRelatedField(
         queryset = UserProfile.objects.all(),
         many=False,
@@ -39,7 +219,7 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ('url', 'id', 'username', 'password', 'email', 'groups', 'userprofile')
 
 
-class UserProfileSerializer(serializers.ModelSerializer):
+class UserProfileSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     user = serializers.PrimaryKeyRelatedField(
         queryset = User.objects.all(),
         many=False,
@@ -52,13 +232,14 @@ class UserProfileSerializer(serializers.ModelSerializer):
         fields = ('url', 'id', 'user', 'lab', 'description')
 
 
-class GroupSerializer(serializers.ModelSerializer):
+class GroupSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Group
         fields = ('url', 'id', 'name')
 
 
-class DatasetSerializer(serializers.ModelSerializer):
+class DatasetSerializer(SparseFieldsetMixin, RelatedSummaryMixin, serializers.ModelSerializer):
+    summary_fields = ('runs',)
     runs = serializers.PrimaryKeyRelatedField(
         queryset = Run.objects.all(),
         #view_name='run-detail',
@@ -66,14 +247,57 @@ class DatasetSerializer(serializers.ModelSerializer):
         allow_null=True,
         default=[],
     )
+    summary = serializers.SerializerMethodField()
 
     class Meta:
         model = Dataset
         fields = ('url', 'id','name', 'created', 'notes',
                 'flag', 'tags', 'project', 'lab',
-                'runs')
+                'runs', 'summary')
+
+    def get_summary(self, dataset):
+        # Stored summary of the runs' parameters. Reads don't write: a missing
+        # one (see refresh_summaries) is built from the runs, unsaved
+        try:
+            summary = dataset.summary
+        except DatasetSummary.DoesNotExist:
+            summary = build_summary(dataset.id, using=router.db_for_read(Run))
+        return summary_data(summary)
+
+    def set_runs(self, dataset, runs):
+        """
+        Assign exactly runs to dataset. As dataset.runs.set() (what DRF would do), with
+        queryset updates, but bumping Run.updated for /changes/ and the ETags, then
+        refreshing the summaries and cached responses which the updates bypass.
+        """
+        ids = [run.id for run in runs]
+        removed = Run.objects.filter(dataset=dataset).exclude(id__in=ids)
+        added = Run.objects.filter(id__in=ids).exclude(dataset=dataset)
+        sources = list(added.values_list('dataset_id', flat=True).distinct())
+        now = timezone.now()
+        removed.update(dataset=None, updated=now)
+        added.update(dataset=dataset, updated=now)
+        dataset.summary = refresh_summaries(sources + [dataset.id])[dataset.id]
+        transaction.on_commit(lambda: invalidate('Run'))
 
-class ProjectSerializer(serializers.ModelSerializer):
+    def create(self, validated_data):
+        runs = validated_data.pop('runs', None) or []
+        with transaction.atomic():
+            dataset = super().create(validated_data)
+            self.set_runs(dataset, runs)
+        return dataset
+
+    def update(self, dataset, validated_data):
+        if 'runs' not in validated_data:
+            return super().update(dataset, validated_data)
+        runs = validated_data.pop('runs') or []
+        with transaction.atomic():
+            dataset = super().update(dataset, validated_data)
+            self.set_runs(dataset, runs)
+        return dataset
+
+class ProjectSerializer(SparseFieldsetMixin, RelatedSummaryMixin, serializers.ModelSerializer):
+    summary_fields = ('datasets',)
     datasets = serializers.PrimaryKeyRelatedField(
         queryset = Dataset.objects.all(),
         #view_name='dataset-detail',
@@ -85,7 +309,8 @@ class ProjectSerializer(serializers.ModelSerializer):
         model = Project
         fields = ('url', 'id','name', 'created', 'notes', 'lab', 'datasets')
 
-class LabSerializer(serializers.ModelSerializer):
+class LabSerializer(SparseFieldsetMixin, RelatedSummaryMixin, serializers.ModelSerializer):
+    summary_fields = ('projects', 'userprofiles')
     projects = serializers.PrimaryKeyRelatedField(
         queryset = Project.objects.all(),
         #view_name='project-detail',
@@ -108,13 +333,23 @@ class LabSerializer(serializers.ModelSerializer):
 
 
 
-class RunSerializerList(serializers.ModelSerializer):
+class RunSerializerList(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Run
         fields = ('url', 'id','created', 'runtime', 'parameters',
                     'notes', 'dataset')
 
-class RunSerializerDetail(serializers.ModelSerializer):
+class RunBulkSerializer(serializers.Serializer):
+    # Lightweight validation for runs posted in bulk:
+    # the labs and datasets are checked once for the whole list, by the view
+    created = serializers.DateTimeField(required=False)
+    runtime = serializers.DateTimeField(required=False)
+    parameters = serializers.JSONField(required=False)
+    notes = serializers.CharField(required=False, allow_blank=True, allow_null=True)
+    lab = serializers.IntegerField(required=False, allow_null=True)
+    dataset = serializers.IntegerField(required=False, allow_null=True)
+
+class RunSerializerDetail(SparseFieldsetMixin, serializers.ModelSerializer):
     images = serializers.HyperlinkedRelatedField(
         queryset = Image.objects.all(),
         view_name='image-detail',
@@ -126,22 +361,42 @@ class RunSerializerDetail(serializers.ModelSerializer):
         fields = ('url', 'id','created', 'runtime', 'parameters',
                     'notes', 'lab', 'dataset', 'images')
 
-class ImageSerializerList(serializers.ModelSerializer):
+class ImageSerializerList(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Image
         fields = ('url', 'id','name', 'created', 'notes', 'filepath', 'tags',
                     'cropi', 'atom', 'odpath', 'total_atoms', 'settings',
-                    'atomsperpixel', 'thumbnail', 'run', 'pixel_size','bad_shot')
+                    'atomsperpixel', 'thumbnail', 'run', 'pixel_size','bad_shot', 'stats')
+        read_only_fields = ('stats',)
 
-class ImageSerializerDetail(serializers.ModelSerializer):
+class ImageSerializerDetail(SparseFieldsetMixin, serializers.ModelSerializer):
     run = RunSerializerList(many=False, read_only=True)
     class Meta:
         model = Image
         fields = ('url', 'id','name', 'created', 'notes', 'filepath', 'tags',
                     'cropi', 'atom', 'odpath', 'total_atoms', 'settings',
-                    'atomsperpixel', 'thumbnail', 'run', 'pixel_size','bad_shot')
+                    'atomsperpixel', 'thumbnail', 'run', 'pixel_size','bad_shot', 'stats')
+        read_only_fields = ('stats',)
+
 
 
+class ImageBulkUpdateSerializer(serializers.Serializer):
+    # Fields which can be set on many images at once: tags and settings are merged
+    # into the existing dicts, the other fields are replaced
+    merged_fields = ('tags', 'settings')
+    bad_shot = serializers.NullBooleanField(required=False)
+    notes = serializers.CharField(required=False, allow_blank=True, allow_null=True)
+    cropi = serializers.JSONField(required=False)
+    tags = serializers.DictField(required=False)
+    settings = serializers.DictField(required=False)
+    pixel_size = serializers.FloatField(required=False, allow_null=True)
+    atom = serializers.ChoiceField(choices=Image.ATOM_CHOICES, required=False, allow_null=True)
+
+    def validate(self, data):
+        if not data:
+            raise serializers.ValidationError('Nothing to update')
+        return data
+
 
 class ImageQuerySerializer(serializers.Serializer):
     # Allows us to validate get queries sent to imageviews
@@ -0,0 +1,204 @@
+"""
+Materialized summaries of the run parameters of datasets.
+
+Each dataset has a DatasetSummary with its run count, first and last
+runtimes, and the number of runs for every parameter value. It is updated
+incrementally when runs are saved or deleted (signals, within the same
+transaction), and by the bulk paths which send no signals. Datasets which
+had none got it from migration 0017, and summaries can be rebuilt with
+`python manage.py refresh_summaries`. Reads never save one: a missing summary
+is built from the runs and returned unsaved. Stored summaries are always built
+from the primary: a lagging replica would store stale counts.
+"""
+import json
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Count, Max, Min
+from django.db.models.signals import pre_save, post_save, post_delete
+
+from api.models import Run, DatasetSummary
+
+
+SUMMARY_MAX_VALUES = 100 # unique values listed per parameter
+SUMMARY_FIELDS = ('dataset_id', 'runtime', 'parameters')
+
+
+def value_key(value):
+    return json.dumps(value, sort_keys=True)
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def sort_key(value):
+    # Numbers first, in order, then everything else by its JSON
+    return (0, value, '') if is_number(value) else (1, 0, value_key(value))
+
+
+def parameter_value_counts(dataset_id, using=DEFAULT_DB_ALIAS):
+    # {key: {value key: runs}} of the runs of a dataset, in one query
+    sql = '''
+        SELECT parameter.key, parameter.value, COUNT(*)
+        FROM {table}, jsonb_each(CASE WHEN jsonb_typeof({table}.parameters) = 'object'
+                                      THEN {table}.parameters ELSE '{{}}'::jsonb END) AS parameter
+        WHERE {table}.dataset_id = %s
+        GROUP BY parameter.key, parameter.value
+    '''.format(table=Run._meta.db_table)
+    counts = {}
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, [dataset_id])
+        for key, value, count in cursor.fetchall():
+            counts.setdefault(key, {})[value_key(value)] = count
+    return counts
+
+
+def summary_values(dataset_id, using=DEFAULT_DB_ALIAS):
+    # Fields of the summary of a dataset, from its runs
+    bounds = Run.objects.using(using).filter(dataset_id=dataset_id).order_by().aggregate(
+                first=Min('runtime'), last=Max('runtime'), count=Count('id'))
+    return {
+        'run_count': bounds['count'],
+        'first_runtime': bounds['first'],
+        'last_runtime': bounds['last'],
+        'value_counts': parameter_value_counts(dataset_id, using),
+    }
+
+
+def build_summary(dataset_id, using=DEFAULT_DB_ALIAS):
+    """
+    Summary of a dataset from its runs, unsaved
+    """
+    return DatasetSummary(dataset_id=dataset_id, **summary_values(dataset_id, using))
+
+
+def refresh_summary(dataset_id):
+    """
+    Build the summary of a dataset from its runs, and save it
+    """
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        summary, created = DatasetSummary.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+                    dataset_id=dataset_id, defaults=summary_values(dataset_id))
+    return summary
+
+
+def refresh_summaries(dataset_ids):
+    # For runs moved between datasets without signals, eg. by dataset.runs.set(). {id: summary}
+    return {dataset_id: refresh_summary(dataset_id)
+                for dataset_id in sorted(set(dataset_ids) - {None})}
+
+
+def apply_runs(summary, runs, sign):
+    # Add (sign=1) or remove (sign=-1) runs, as (runtime, parameters) pairs, from summary
+    counts = summary.value_counts
+    for runtime, parameters in runs:
+        summary.run_count += sign
+        for key, value in (parameters if isinstance(parameters, dict) else {}).items():
+            values = counts.setdefault(key, {})
+            count = values.get(value_key(value), 0) + sign
+            if count > 0:
+                values[value_key(value)] = count
+            else:
+                values.pop(value_key(value), None)
+            if not values:
+                counts.pop(key)
+        if sign > 0 and runtime is not None:
+            summary.first_runtime = min(summary.first_runtime or runtime, runtime)
+            summary.last_runtime = max(summary.last_runtime or runtime, runtime)
+
+
+def update_summary(dataset_id, added=(), removed=()):
+    """
+    Update the summary of a dataset after runs (as (runtime, parameters) pairs) were
+    added to it or removed from it. The database must already reflect the change.
+    """
+    if dataset_id is None:
+        return
+    with transaction.atomic():
+        summary = DatasetSummary.objects.using(DEFAULT_DB_ALIAS).select_for_update().filter(dataset_id=dataset_id).first()
+        if summary is None:
+            refresh_summary(dataset_id)
+            return
+        apply_runs(summary, removed, -1)
+        apply_runs(summary, added, 1)
+        bounds = (summary.first_runtime, summary.last_runtime)
+        if any(runtime is not None and (bounds[0] is None or runtime <= bounds[0] or runtime >= bounds[1])
+                    for runtime, parameters in removed):
+            # A removed run may have been the first or last one
+            bounds = Run.objects.using(DEFAULT_DB_ALIAS).filter(dataset_id=dataset_id).order_by().aggregate(
+                        first=Min('runtime'), last=Max('runtime'))
+            summary.first_runtime, summary.last_runtime = bounds['first'], bounds['last']
+        summary.save()
+
+
+def add_runs(runs):
+    # For bulk created runs, which send no signals
+    by_dataset = {}
+    for run in runs:
+        by_dataset.setdefault(run.dataset_id, []).append((run.runtime, run.parameters))
+    for dataset_id, added in by_dataset.items():
+        update_summary(dataset_id, added=added)
+
+
+def summary_data(summary):
+    """
+    Serialized summary: counts, time span, parameters with their unique values
+    (when there are few), numeric ranges, and the keys which vary between runs
+    """
+    parameters = {}
+    for key, counts in sorted(summary.value_counts.items()):
+        values = [json.loads(value) for value in counts]
+        numbers = [value for value in values if is_number(value)]
+        parameters[key] = {
+            'runs': sum(counts.values()),
+            'unique': len(values),
+            'min': min(numbers) if numbers else None,
+            'max': max(numbers) if numbers else None,
+        }
+        if len(values) <= SUMMARY_MAX_VALUES:
+            parameters[key]['values'] = sorted(values, key=sort_key)
+    return {
+        'run_count': summary.run_count,
+        'first_runtime': summary.first_runtime,
+        'last_runtime': summary.last_runtime,
+        'parameters': parameters,
+        'varied': [key for key, info in parameters.items()
+                    if info['unique'] > 1 or info['runs'] < summary.run_count],
+    }
+
+
+def summary_fields_changed(update_fields):
+    return update_fields is None or any(
+                name in update_fields for name in ('dataset', 'dataset_id', 'runtime', 'parameters'))
+
+
+def remember_run_state(sender, instance=None, raw=False, update_fields=None, **kwargs):
+    # The state before the save, to remove from the summary
+    if raw or instance.pk is None or not summary_fields_changed(update_fields):
+        return
+    instance._summary_state = Run.objects.filter(pk=instance.pk).values_list(*SUMMARY_FIELDS).first()
+
+
+def update_summary_on_save(sender, instance=None, raw=False, update_fields=None, **kwargs):
+    if raw or not summary_fields_changed(update_fields):
+        return
+    old = instance.__dict__.pop('_summary_state', None)
+    new = (instance.dataset_id, instance.runtime, instance.parameters)
+    if old == new:
+        return
+    if old is not None and old[0] == new[0]:
+        update_summary(new[0], added=[new[1:]], removed=[old[1:]])
+        return
+    if old is not None:
+        update_summary(old[0], removed=[old[1:]])
+    update_summary(new[0], added=[new[1:]])
+
+
+def update_summary_on_delete(sender, instance=None, **kwargs):
+    update_summary(instance.dataset_id, removed=[(instance.runtime, instance.parameters)])
+
+
+def connect_summary_signals():
+    pre_save.connect(remember_run_state, sender=Run, dispatch_uid='api-summary-pre-save')
+    post_save.connect(update_summary_on_save, sender=Run, dispatch_uid='api-summary-save')
+    post_delete.connect(update_summary_on_delete, sender=Run, dispatch_uid='api-summary-delete')
@@ -1,10 +1,47 @@
-from django.test import TestCase
+import json
+import os
+import struct
+import tempfile
+from decimal import Decimal
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.http import HttpResponse
+from django.core.cache import cache
 from django.contrib.auth.models import User
-from api.models import Lab, Run, Image, Dataset
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from api.models import Lab, Run, Image, Dataset, Project, DatasetSummary
 from rest_framework.test import APIRequestFactory
 from rest_framework.test import force_authenticate
 from api import views
+from api.matching import match_times
+from api.notifications import NotificationDispatcher, InMemoryBackend
+from api.middleware import request_stats
+from api.benchmarks import generate_lab, run_benchmarks
+from api.renderers import ORJSONRenderer
+from api.export import ndjson_lines
+from api.livefeed import LabFeed, broker, feed_events
+from api.asgi import authenticate, cors_headers
+from api.imagedata import read_image, downscale, encode_png, to_uint8, resolve_path, PreviewCache, ImageDataError
+from api.summaries import refresh_summary
+from api.imagestats import image_statistics, crop_bounds, pending_images, process_batch
+from breadboard.db.routers import ReplicaRouter, ReplicaMiddleware, use_replica, primary, REPLICA_PIN_COOKIE
+from api.cache import get_generation
+from api.views.syncviews import encode_token, TOMBSTONE_RETENTION
+
+
 
+def run_commit_hooks():
+    # TestCase never commits: run the on_commit callbacks of the test transaction
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for sids, func in callbacks:
+        func()
 
 
 class DatasetTests(TestCase):
@@ -49,6 +86,135 @@ class DatasetTests(TestCase):
         # print(response.status_code)
         self.assertEqual(response.status_code, 200)
 
+    def test_dataset_export(self):
+        # Stream the runs of a dataset as csv, with one column per parameter
+        self.run.parameters = {"TOF":0, "evap":90}
+        self.run.save()
+        request = self.factory.get('/datasets/%d/export/' % self.dataset.id, {'output': 'csv'})
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        view = views.DatasetViewSet.as_view({'get':'export'})
+        response = view(request, pk=str(self.dataset.id))
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'id,created,runtime,lab,dataset,notes,TOF,evap')
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].endswith(',0,90'))
+
+    def test_dataset_columns(self):
+        # Get the dataset parameters as columns
+        self.run.parameters = {"TOF":0, "evap":90}
+        self.run.save()
+        request = self.factory.get('/datasets/%d/columns/' % self.dataset.id, {'params': 'TOF,missing'})
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        view = views.DatasetViewSet.as_view({'get':'columns'})
+        response = view(request, pk=str(self.dataset.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.get('id'), [self.run.id])
+        self.assertEqual(response.data.get('parameters'), {'TOF': [0], 'missing': [None]})
+
+    def test_dataset_get_query_count(self):
+        # Listing datasets costs the same number of queries however many there are
+        def count_queries():
+            cache.clear()
+            request = self.factory.get('/datasets/')
+            force_authenticate(request, user=self.user, token=self.user.auth_token)
+            view = views.DatasetViewSet.as_view({'get':'list'})
+            with CaptureQueriesContext(connection) as queries:
+                response = view(request)
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        few = count_queries()
+        for i in range(5):
+            dataset = Dataset.objects.create(name='dataset %d' % i, lab=self.lab)
+            Run.objects.create(lab=self.lab, dataset=dataset)
+        self.assertEqual(count_queries(), few)
+
+    def test_dataset_get_related_count(self):
+        # Get run counts and id ranges instead of lists of run ids
+        extra_run = Run.objects.create(lab=self.lab, dataset=self.dataset)
+        view = views.DatasetViewSet.as_view({'get':'retrieve'})
+        request = self.factory.get('/datasets/%d/' % self.dataset.id, {'related': 'count'})
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        response = view(request, pk=str(self.dataset.id))
+        self.assertEqual(response.data.get('runs'), 2)
+
+        request = self.factory.get('/datasets/%d/' % self.dataset.id, {'related': 'ranges'})
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        response = view(request, pk=str(self.dataset.id))
+        self.assertEqual(response.data.get('runs'), [[self.run.id, extra_run.id]])
+
+
+    def test_dataset_aggregate(self):
+        # Mean atom number per TOF, without the bad shots
+        other = Run.objects.create(lab=self.lab, dataset=self.dataset, parameters={'TOF': 2})
+        self.run.parameters = {'TOF': 1}
+        self.run.save()
+        Image.objects.create(lab=self.lab, run=self.run, name='a', total_atoms=100, settings={'fudge': 1})
+        Image.objects.create(lab=self.lab, run=self.run, name='b', total_atoms=300, settings={'fudge': 'x'})
+        Image.objects.create(lab=self.lab, run=other, name='c', total_atoms=50)
+        Image.objects.create(lab=self.lab, run=other, name='d', total_atoms=1e6, bad_shot=True)
+        request = self.factory.get('/datasets/%d/aggregate/' % self.dataset.id,
+                    {'group_by': 'TOF', 'values': 'total_atoms,settings.fudge'})
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        view = views.DatasetViewSet.as_view({'get': 'aggregate'})
+        response = view(request, pk=str(self.dataset.id))
+        self.assertEqual(response.status_code, 200)
+        groups = response.data.get('groups')
+        self.assertEqual([group['parameters'] for group in groups], [{'TOF': 1}, {'TOF': 2}])
+        self.assertEqual([group['count'] for group in groups], [2, 1])
+        self.assertEqual(groups[0]['total_atoms']['mean'], 200)
+        self.assertEqual(groups[1]['total_atoms']['max'], 50)
+        self.assertEqual(groups[0]['settings.fudge']['count'], 1)
+
+
+    def test_dataset_summary(self):
+        # The summary follows the runs as they are saved and deleted
+        self.run.parameters = {'TOF': 0, 'evap': 90}
+        self.run.save()
+        Run.objects.create(lab=self.lab, dataset=self.dataset, parameters={'TOF': 1, 'evap': 90})
+        last = Run.objects.create(lab=self.lab, dataset=self.dataset, parameters={'TOF': 2, 'evap': 90})
+        last.delete()
+
+        request = self.factory.get('/datasets/%d/' % self.dataset.id)
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        view = views.DatasetViewSet.as_view({'get': 'retrieve'})
+        response = view(request, pk=str(self.dataset.id))
+        self.assertEqual(response.status_code, 200)
+        summary = response.data.get('summary')
+        self.assertEqual(summary['run_count'], 2)
+        self.assertEqual(summary['varied'], ['TOF'])
+        self.assertEqual(summary['parameters']['TOF']['values'], [0, 1])
+        self.assertEqual(summary['parameters']['evap']['values'], [90])
+
+        stored = DatasetSummary.objects.get(dataset=self.dataset).value_counts
+        self.assertEqual(stored, refresh_summary(self.dataset.id).value_counts)
+
+    def test_dataset_summary_missing(self):
+        # Reads build a missing summary without saving it
+        dataset = Dataset.objects.create(name='unsummarized', lab=self.lab)
+        Run.objects.filter(pk=self.run.pk).update(dataset=dataset)
+        request = self.factory.get('/datasets/%d/' % dataset.id)
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        response = views.DatasetViewSet.as_view({'get': 'retrieve'})(request, pk=str(dataset.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.get('summary')['run_count'], 1)
+        self.assertFalse(DatasetSummary.objects.filter(dataset=dataset).exists())
+
+    def test_dataset_summary_runs_moved(self):
+        # Assigning runs to a dataset moves them without signals: both summaries follow
+        self.assertEqual(DatasetSummary.objects.get(dataset=self.dataset).run_count, 1)
+        request = self.factory.post('/datasets/', {'name': 'moved', 'lab': self.lab.id, 'runs': [self.run.id]}, format='json')
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        response = views.DatasetViewSet.as_view({'post': 'create'})(request)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data.get('summary')['run_count'], 1)
+        self.assertEqual(DatasetSummary.objects.get(dataset=self.dataset).run_count, 0)
+        # The move is a change of the run, for /changes/ and the ETags
+        moved = Run.objects.get(pk=self.run.pk)
+        self.assertEqual(moved.dataset_id, response.data.get('id'))
+        self.assertGreater(moved.updated, self.run.updated)
+
 
 class LabTests(TestCase):
     def setUp(self):
@@ -73,6 +239,34 @@ class LabTests(TestCase):
         response = view(request)
         self.assertEqual(response.status_code, 201)
 
+    @override_settings(BREADBOARD_RESPONSE_CACHE=True)
+    def test_lab_get_cached(self):
+        # Repeated requests are served from the cache, until a project changes
+        cache.clear()
+        lab = Lab.objects.create(name='cachedlab')
+        def get_labs():
+            request = self.factory.get('/labs/')
+            force_authenticate(request, user=self.user, token=self.user.auth_token)
+            view = views.LabViewSet.as_view({'get':'list'})
+            return view(request)
+
+        get_labs()
+        with self.assertNumQueries(0):
+            response = get_labs()
+        self.assertEqual(response.data.get('results')[0].get('projects'), [])
+
+        project = Project.objects.create(name='newproject', lab=lab)
+        run_commit_hooks()
+        response = get_labs()
+        self.assertEqual(response.data.get('results')[0].get('projects'), [project.id])
+
+        # Deleting the project sets the project of its datasets to null, without signals
+        generation = get_generation('dataset')
+        project.delete()
+        self.assertEqual(get_generation('dataset'), generation)
+        run_commit_hooks()
+        self.assertNotEqual(get_generation('dataset'), generation)
+
 
 class RunTests(TestCase):
     def setUp(self):
@@ -88,6 +282,43 @@ class RunTests(TestCase):
         response = view(request)
         self.assertEqual(response.status_code, 200)
 
+    def test_run_get_not_modified(self):
+        # Polling with the ETag gets a 304 until the runs change
+        lab = Lab.objects.create(name='polllab')
+        run = Run.objects.create(lab=lab)
+        view = views.RunViewSet.as_view({'get':'list'})
+        def get_runs(**headers):
+            request = self.factory.get('/runs/', {'lab': 'polllab'}, **headers)
+            force_authenticate(request, user=self.user, token=self.user.auth_token)
+            return view(request)
+
+        etag = get_runs()['ETag']
+        self.assertEqual(get_runs(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        run.notes = 'edited'
+        run.save()
+        self.assertEqual(get_runs(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        # Replacing a run with another keeps the count, but not the ETag
+        etag = get_runs()['ETag']
+        other = Run.objects.create(lab=lab)
+        Run.objects.filter(pk=other.pk).update(updated=run.updated)
+        run.delete()
+        self.assertEqual(get_runs(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_run_get_cursor(self):
+        # Walk runs with cursor pagination: no total count, and a link to the next page
+        lab = Lab.objects.create(name='cursorlab')
+        for i in range(3):
+            Run.objects.create(lab=lab)
+        request = self.factory.get('/runs/', {'pagination': 'cursor', 'limit': 2})
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        view = views.RunViewSet.as_view({'get':'list'})
+        response = view(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('count', response.data)
+        self.assertEqual(len(response.data.get('results')), 2)
+        self.assertIn('cursor=', response.data.get('next'))
+
     def test_run_post(self):
         # Create a Run
         runobj = {
@@ -99,6 +330,54 @@ class RunTests(TestCase):
         response = view(request)
         self.assertEqual(response.status_code, 201)
 
+    def test_run_get_parameter_filters(self):
+        # Filter runs on their parameters
+        lab = Lab.objects.create(name='filterlab')
+        for tof in [0, 2.5, 10, 'on']:
+            Run.objects.create(lab=lab, parameters={"TOF":tof, "evap":9})
+        view = views.RunViewSet.as_view({'get':'list'})
+        def count_runs(query):
+            request = self.factory.get('/runs/', dict(query, lab='filterlab'))
+            force_authenticate(request, user=self.user, token=self.user.auth_token)
+            response = view(request)
+            self.assertEqual(response.status_code, 200)
+            return response.data.get('count')
+
+        self.assertEqual(count_runs({'param.TOF__gte': 2}), 2)
+        self.assertEqual(count_runs({'param.TOF__lt': 5, 'param.evap': 9}), 2)
+        self.assertEqual(count_runs({'param.TOF': 'on'}), 1)
+        self.assertEqual(count_runs({'param.TOF__in': '0,10'}), 2)
+        self.assertEqual(count_runs({'param.evap__ne': 9}), 0)
+        self.assertEqual(count_runs({'param.missing__isnull': 'true'}), 4)
+
+    def test_run_post_bulk(self):
+        # Create runs from a list, and from NDJSON
+        lab = Lab.objects.create(name='bulklab')
+        runs = [{'lab': lab.id, 'parameters': {"TOF":i, "evap":9}} for i in range(3)]
+        request = self.factory.post('/runs/bulk/', runs, format='json')
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        view = views.RunViewSet.as_view({'post':'bulk'})
+        response = view(request)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data.get('count'), 3)
+        self.assertEqual(lab.runs.count(), 3)
+
+        ndjson = '\n'.join(json.dumps(run) for run in runs)
+        request = self.factory.post('/runs/bulk/', ndjson, content_type='application/x-ndjson')
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        response = view(request)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(lab.runs.count(), 6)
+
+    def test_run_post_bulk_missing_lab(self):
+        # Nothing is created if a lab doesn't exist
+        request = self.factory.post('/runs/bulk/', [{'lab': 0}], format='json')
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        view = views.RunViewSet.as_view({'post':'bulk'})
+        response = view(request)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Run.objects.count(), 0)
+
 
 
 class ImageTests(TestCase):
@@ -123,6 +402,67 @@ class ImageTests(TestCase):
         self.assertEqual(response.status_code, 200)
 
 
+    def test_image_get_detail_not_modified(self):
+        # Images in detail mode nest their run: editing the run changes the ETag
+        self.image.run = self.run
+        self.image.save()
+        view = views.ImageViewSet.as_view({'get':'list'})
+        def get_images(**headers):
+            request = self.factory.get('/images/', {'lab': 'newlab', 'query_mode': 'Names', 'names': 'newimage'}, **headers)
+            force_authenticate(request, user=self.user, token=self.user.auth_token)
+            return view(request)
+
+        etag = get_images()['ETag']
+        self.assertEqual(get_images(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Run.objects.filter(pk=self.run.pk).update(notes='edited', updated=self.image.updated + timedelta(seconds=1))
+        self.assertEqual(get_images(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_image_bulk_update(self):
+        # One request, one statement: merge tags and mark bad shots
+        other = Image.objects.create(name='otherimage', lab=self.lab, tags={'keep': 1})
+        view = views.ImageViewSet.as_view({'post': 'bulk_update'})
+        request = self.factory.post('/images/bulk_update/',
+                    {'ids': [self.image.id, other.id], 'update': {'bad_shot': True, 'tags': {'checked': True}}},
+                    format='json')
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        with CaptureQueriesContext(connection) as queries:
+            response = view(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.get('count'), 2)
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('UPDATE')]), 1)
+        other.refresh_from_db()
+        self.assertTrue(other.bad_shot)
+        self.assertEqual(other.tags, {'keep': 1, 'checked': True})
+
+        # Select by an image query instead
+        request = self.factory.post('/images/bulk_update/',
+                    {'filter': {'lab': 'newlab', 'names': 'otherimage'}, 'update': {'notes': 'relabeled'}},
+                    format='json')
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        response = view(request)
+        self.assertEqual(response.data.get('count'), 1)
+        self.assertEqual(Image.objects.get(id=other.id).notes, 'relabeled')
+        self.assertNotEqual(Image.objects.get(id=self.image.id).notes, 'relabeled')
+
+
+    def test_image_get_sparse(self):
+        # Only get the requested fields
+        view = views.ImageViewSet.as_view({'get':'list'})
+        request = self.factory.get('/images/', {'fields': 'name,run'})
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        response = view(request)
+        result = response.data.get('results')[0]
+        self.assertEqual(set(result), {'name', 'run'})
+        self.assertEqual(result.get('name'), self.image.name)
+
+        request = self.factory.get('/images/', {'lab': 'newlab', 'exclude': 'tags,settings,cropi'})
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        response = view(request)
+        result = response.data.get('results')[0]
+        self.assertNotIn('tags', result)
+        self.assertIn('url', result)
+
+
     def test_image_post(self):
         # Create an image
         img = {
@@ -153,4 +493,418 @@ class ImageTests(TestCase):
         result = response.data.get('results')[0]
         print(result)
         self.assertEqual(result.get('name'), self.image.name)
-        self.assertEqual(response.status_code, 200)
\ No newline at end of file
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_image_post_attaches_run(self):
+        # Create images close to a run, and check that the run gets attached
+        created = self.run.runtime + timedelta(seconds=2)
+        img = {
+            'names':'run_image_1,run_image_2',
+            'lab':'newlab',
+            'created':','.join([created.isoformat()]*2)
+            }
+        request = self.factory.post('/images/',img)
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        view = views.ImageViewSet.as_view({'post':'create'})
+        response = view(request)
+        results = response.data.get('results')
+        self.assertEqual([r.get('name') for r in results], ['run_image_1', 'run_image_2'])
+        self.assertEqual(results[0].get('run').get('id'), self.run.id)
+        self.assertEqual(Image.objects.filter(run=self.run).count(), 2)
+
+
+    def test_image_post_query_count(self):
+        # The number of queries should not grow with the number of posted images
+        def post_images(n, prefix):
+            created = self.run.runtime + timedelta(seconds=1)
+            img = {
+                'names':','.join(prefix + str(i) for i in range(n)),
+                'lab':'newlab',
+                'created':','.join([created.isoformat()]*n)
+                }
+            request = self.factory.post('/images/',img)
+            force_authenticate(request, user=self.user, token=self.user.auth_token)
+            view = views.ImageViewSet.as_view({'post':'create'})
+            with CaptureQueriesContext(connection) as queries:
+                response = view(request)
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        self.assertEqual(post_images(2, 'small_'), post_images(20, 'large_'))
+
+
+
+class MatchingTests(SimpleTestCase):
+    def test_match_policies(self):
+        runtimes = [0, 10, 14, 30]
+        created = [12, 13, 25, 100]
+        self.assertEqual(list(match_times(created, runtimes, 7, policy='nearest')), [1, 2, 3, -1])
+        self.assertEqual(list(match_times(created, runtimes, 7, policy='earliest')), [1, 1, 3, -1])
+        self.assertEqual(list(match_times(created, runtimes, 7, policy='latest')), [2, 2, 3, -1])
+
+    def test_match_empty(self):
+        self.assertEqual(list(match_times([1, 2], [], 7)), [-1, -1])
+
+
+
+class NotificationTests(SimpleTestCase):
+    def test_coalesce_burst(self):
+        # A burst of events on one channel is delivered as a single message
+        backend = InMemoryBackend()
+        dispatcher = NotificationDispatcher(backend, coalesce_window=0.1)
+        for i in range(5):
+            dispatcher.enqueue('newlab', 'new-image', [i])
+        dispatcher.enqueue('otherlab', 'new-image', [10])
+        dispatcher.flush()
+        self.assertEqual(len(backend.sent), 2)
+        channel, event, data = backend.sent[0]
+        self.assertEqual((channel, event), ('newlab', 'new-image'))
+        self.assertEqual(data.get('ids'), [0, 1, 2, 3, 4])
+
+    def test_retry(self):
+        # Failed deliveries are retried
+        class FlakyBackend(InMemoryBackend):
+            failures = 2
+            def send(self, channel, event, data):
+                if self.failures:
+                    self.failures -= 1
+                    raise ConnectionError('notification service unavailable')
+                super().send(channel, event, data)
+        backend = FlakyBackend()
+        dispatcher = NotificationDispatcher(backend, coalesce_window=0, retry_delay=0)
+        dispatcher.enqueue('newlab', 'new-image', [1])
+        dispatcher.flush()
+        self.assertEqual(len(backend.sent), 1)
+
+
+
+class StatsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@mit.edu', password='top_secret')
+        self.admin = User.objects.create_superuser(
+            username='admin', email='admin@mit.edu', password='top_secret')
+
+    def test_server_timing(self):
+        # Requests are timed, with their query counts
+        request_stats.reset()
+        self.client.force_login(self.user)
+        response = self.client.get('/runs/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('queries', response['Server-Timing'])
+        self.assertIn('GET run-list', request_stats.summary())
+
+    def test_stats_admin_only(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/stats/').status_code, 403)
+        self.client.force_login(self.admin)
+        self.assertEqual(self.client.get('/stats/').status_code, 200)
+
+
+
+class BenchmarkTests(TestCase):
+    def test_benchmarks_run(self):
+        # A small benchmark run, to check that every scenario works
+        lab = generate_lab('benchlab', runs=20, images=40, parameter_keys=3, datasets=2)
+        results = run_benchmarks(lab, repeat=1, batch=10)
+        names = [result.get('name') for result in results]
+        self.assertIn('images: NamesCreated', names)
+        self.assertIn('runs: datetime range', names)
+        for result in results:
+            if not result.get('name').startswith('render'):
+                self.assertGreater(result.get('queries'), 0)
+
+
+
+class RendererTests(SimpleTestCase):
+    def test_render_types(self):
+        # Datetimes, decimals and NaN in parameters render as valid JSON
+        data = {
+            'runtime': datetime(2019, 3, 4, 15, 10, 6, tzinfo=dt_timezone.utc),
+            'parameters': {'TOF': Decimal('2.5'), 'evap': float('nan')},
+        }
+        rendered = json.loads(ORJSONRenderer().render(data, 'application/json', {}))
+        self.assertEqual(rendered, {
+            'runtime': '2019-03-04T15:10:06Z',
+            'parameters': {'TOF': 2.5, 'evap': None},
+        })
+
+    def test_ndjson_nan(self):
+        # Exported lines are valid JSON too
+        runs = [{'id': 1, 'parameters': {'evap': float('nan'), 'TOF': [float('inf'), 1]}}]
+        line = next(ndjson_lines(runs))
+        self.assertEqual(json.loads(line), {'id': 1, 'parameters': {'evap': None, 'TOF': [None, 1]}})
+        self.assertNotIn('NaN', line)
+
+
+
+class ChangesTests(TestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@mit.edu', password='top_secret')
+        self.lab = Lab.objects.create(name='synclab')
+        self.run = Run.objects.create(lab=self.lab)
+
+    def get_changes(self, since=None):
+        query = {'lab': 'synclab'}
+        if since:
+            query['since'] = since
+        request = self.factory.get('/changes/', query)
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        response = views.ChangesView.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_changes(self):
+        # New runs are sent, and deleted runs come back as tombstones
+        changes = self.get_changes()
+        self.assertEqual([run.get('id') for run in changes.get('runs')], [self.run.id])
+        self.assertFalse(changes.get('more'))
+
+        run_id = self.run.id
+        self.run.delete()
+        changes = self.get_changes(since=changes.get('token'))
+        self.assertEqual(changes.get('runs'), [])
+        self.assertEqual(changes.get('deleted'), {'runs': [run_id]})
+
+    def test_invalid_token(self):
+        bad_datetime = encode_token({'runs': ['not a datetime', 1]}, timezone.now().isoformat())
+        for token in ('not a token', bad_datetime):
+            request = self.factory.get('/changes/', {'lab': 'synclab', 'since': token})
+            force_authenticate(request, user=self.user, token=self.user.auth_token)
+            response = views.ChangesView.as_view()(request)
+            self.assertEqual(response.status_code, 400)
+
+    def test_expired_token(self):
+        # Tokens older than the tombstones kept must sync again from scratch
+        synced = timezone.now() - TOMBSTONE_RETENTION - timedelta(days=1)
+        request = self.factory.get('/changes/', {'lab': 'synclab', 'since': encode_token({}, synced.isoformat())})
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        response = views.ChangesView.as_view()(request)
+        self.assertEqual(response.status_code, 410)
+
+
+@override_settings(BREADBOARD_FEED_POLLER=False)
+class LiveFeedTests(TestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@mit.edu', password='top_secret')
+        self.lab = Lab.objects.create(name='feedlab')
+        self.addCleanup(broker.feeds.clear)
+
+    def get_feed(self, **params):
+        request = self.factory.get('/feed/', dict(params, lab='feedlab'))
+        force_authenticate(request, user=self.user, token=self.user.auth_token)
+        return views.LiveFeedView.as_view()(request)
+
+    def test_cursor(self):
+        # New rows are sent once, and the cursor moves past them once they are settled
+        feed = LabFeed(self.lab.id)
+        feed.poll()
+        start = feed.current_cursor()
+        run = Run.objects.create(lab=self.lab)
+        feed.poll()
+        events, cursor, more = feed.wait(start, 0)
+        self.assertEqual(events, [{'event': 'new-run', 'ids': [run.id]}])
+        self.assertEqual(cursor['run'], [start['run'][0], [run.id]])
+        self.assertEqual(feed.wait(cursor, 0)[0], [])
+        self.assertEqual(feed_events(self.lab.id, cursor)[0], [])
+
+        Run.objects.filter(pk=run.pk).update(updated=timezone.now() - timedelta(minutes=1))
+        feed.poll()
+        events, cursor, more = feed.wait(cursor, 0)
+        self.assertEqual(events, [])
+        self.assertEqual(cursor['run'], [run.id, []])
+
+    def test_buffer(self):
+        # Cursors older than the rows kept in memory catch up from the database
+        feed = LabFeed(self.lab.id, size=1)
+        feed.poll()
+        start = feed.current_cursor()
+        runs = [Run.objects.create(lab=self.lab) for i in range(3)]
+        Run.objects.update(updated=timezone.now() - timedelta(minutes=1))
+        feed.poll()
+        self.assertEqual(len(feed.rows['run']), 1)
+        self.assertTrue(feed.behind(start))
+        events, cursor, more = feed.wait(start, 0)
+        self.assertEqual(events, [{'event': 'new-run', 'ids': [run.id for run in runs]}])
+        self.assertFalse(feed.behind(cursor))
+        self.assertEqual(feed.wait(cursor, 0)[0], [])
+
+    def test_poll(self):
+        response = self.get_feed(timeout=0)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.get('events'), [])
+        image = Image.objects.create(lab=self.lab, name='feedimage')
+        broker.feed(self.lab.id).poll()
+        response = self.get_feed(since=response.data.get('cursor'), timeout=0)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.get('events'), [{'event': 'new-image', 'ids': [image.id]}])
+
+    def test_invalid(self):
+        self.assertEqual(self.get_feed(since='not a cursor', timeout=0).status_code, 400)
+        # Event streams would hold a WSGI worker
+        self.assertEqual(self.get_feed(mode='sse').status_code, 400)
+
+    def test_asgi_token(self):
+        # EventSource can't send an Authorization header
+        key = self.user.auth_token.key
+        self.assertEqual(authenticate({'authorization': 'Token ' + key}, {}), self.user)
+        self.assertEqual(authenticate({}, {'token': key}), self.user)
+        self.assertIsNone(authenticate({}, {'token': 'not a token'}))
+        self.assertIsNone(authenticate({}, {}))
+
+    @override_settings(CORS_ORIGIN_WHITELIST=['https://neptune.fermi3.com'])
+    def test_asgi_cors(self):
+        self.assertIn((b'access-control-allow-origin', b'https://neptune.fermi3.com'),
+                      cors_headers({'origin': 'https://neptune.fermi3.com'}))
+        self.assertEqual(cors_headers({'origin': 'https://example.com'}), [])
+        self.assertEqual(cors_headers({}), [])
+
+
+@override_settings(DATABASE_REPLICAS=['replica0'])
+class ReplicaRouterTests(SimpleTestCase):
+    def tearDown(self):
+        use_replica(False)
+
+    def test_router(self):
+        router = ReplicaRouter()
+        use_replica(True)
+        self.assertEqual(router.db_for_read(Run), 'replica0')
+        self.assertEqual(router.db_for_write(Run), 'default')
+        use_replica(False)
+        self.assertEqual(router.db_for_read(Run), 'default')
+
+    def test_middleware(self):
+        # Reads of GET requests go to the replica, and writes pin the client to the primary
+        router = ReplicaRouter()
+        factory = APIRequestFactory()
+        seen = []
+        middleware = ReplicaMiddleware(lambda request: seen.append(router.db_for_read(Run)) or HttpResponse())
+        middleware(factory.get('/runs/'))
+        response = middleware(factory.post('/runs/'))
+        self.assertIn(REPLICA_PIN_COOKIE, response.cookies)
+        request = factory.get('/runs/')
+        request.COOKIES[REPLICA_PIN_COOKIE] = '1'
+        middleware(request)
+        self.assertEqual(seen, ['replica0', 'default', 'default'])
+        self.assertEqual(router.db_for_read(Run), 'default')
+
+    def test_pin_token(self):
+        # Token clients send no cookies: they are pinned by their token
+        router = ReplicaRouter()
+        factory = APIRequestFactory()
+        seen = []
+        middleware = ReplicaMiddleware(lambda request: seen.append(router.db_for_read(Run)) or HttpResponse())
+        cache.clear()
+        middleware(factory.post('/runs/', HTTP_AUTHORIZATION='Token abc'))
+        middleware(factory.get('/runs/', HTTP_AUTHORIZATION='Token abc'))
+        middleware(factory.get('/runs/', HTTP_AUTHORIZATION='Token other'))
+        use_replica(True)
+        with primary():
+            seen.append(router.db_for_read(Run))
+        seen.append(router.db_for_read(Run))
+        self.assertEqual(seen, ['default', 'default', 'replica0', 'default', 'replica0'])
+
+
+def write_fits(path, frames, rows, columns, values):
+    # Minimal 16 bit FITS file
+    cards = ['SIMPLE  =                    T', 'BITPIX  =                   16', 'NAXIS   =                    3',
+             'NAXIS1  = %20d' % columns, 'NAXIS2  = %20d' % rows, 'NAXIS3  = %20d' % frames, 'END']
+    header = ''.join(card.ljust(80) for card in cards).ljust(2880)
+    data = struct.pack('>%dh' % len(values), *values)
+    with open(path, 'wb') as f:
+        f.write(header.encode('ascii') + data + b'\0'*(-len(data) % 2880))
+
+
+class ImageDataTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_fits_preview(self):
+        path = os.path.join(self.root, 'shot.fits')
+        write_fits(path, 2, 4, 6, list(range(24)) + [0]*24)
+        data = read_image(path)
+        self.assertEqual(data.shape, (4, 6))
+        self.assertEqual(data[1, 0], 6)
+        small = downscale(data, 3)
+        self.assertEqual(small.shape, (2, 3))
+        self.assertEqual(small[0, 0], (0 + 1 + 6 + 7)/4)
+        png = encode_png(to_uint8(small))
+        self.assertTrue(png.startswith(b'\x89PNG'))
+        self.assertEqual(struct.unpack('>II', png[16:24]), (3, 2))
+        # The short side is never downscaled to nothing
+        self.assertEqual(downscale(np.ones((2, 600)), 32).shape, (1, 300))
+
+    def test_resolve_path(self):
+        open(os.path.join(self.root, 'shot.fits'), 'wb').close()
+        self.assertEqual(resolve_path('\\shot.fits', root=self.root), os.path.realpath(os.path.join(self.root, 'shot.fits')))
+        with self.assertRaises(ImageDataError):
+            resolve_path('../etc/passwd', root=self.root)
+        with mock.patch('api.imagedata.IMAGE_ROOT', None), self.assertRaises(ImproperlyConfigured):
+            resolve_path('shot.fits')
+
+    def test_cache_eviction(self):
+        cache = PreviewCache(directory=self.root, max_bytes=250)
+        cache.set('a', b'a'*100)
+        with mock.patch.object(cache, 'prune') as prune:
+            # Under max_bytes, the directory isn't scanned
+            cache.set('b', b'b'*100)
+            prune.assert_not_called()
+        os.utime(os.path.join(self.root, 'a.png'), (0, 0))
+        cache.set('c', b'c'*100)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), b'c'*100)
+        self.assertEqual(cache.size, 200)
+
+    def test_truncated_fits(self):
+        path = os.path.join(self.root, 'shot.fits')
+        write_fits(path, 2, 4, 6, list(range(24)) + [0]*24)
+        with open(path, 'r+b') as f:
+            # Half of the data
+            f.truncate(2880 + 48)
+        with self.assertRaises(ImageDataError):
+            read_image(path)
+
+
+class ImageStatsTests(SimpleTestCase):
+    def test_statistics(self):
+        # A 2x2 cloud of 10 atoms per pixel, centered on (x, y) = (4.5, 2.5)
+        atoms = np.zeros((6, 8))
+        atoms[2:4, 4:6] = 10
+        atoms[0, 0] = -5 # noise, outside of the crop
+        od = atoms / 10
+        stats = image_statistics(atoms=atoms, od=od, cropi={'xmin': 2, 'xmax': 8, 'ymin': 1, 'ymax': 6})
+        self.assertEqual(stats['total_atoms'], 40)
+        self.assertEqual(stats['peak_od'], 1)
+        self.assertEqual((stats['centroid_x'], stats['centroid_y']), (4.5, 2.5))
+        self.assertEqual((stats['width_x'], stats['width_y']), (0.5, 0.5))
+        self.assertEqual(stats['crop'], [2, 8, 1, 6])
+
+    def test_crop_bounds(self):
+        self.assertEqual(crop_bounds({}, (6, 8)), (0, 6, 0, 8))
+        self.assertEqual(crop_bounds([1, 100, -3, 4], (6, 8)), (0, 4, 1, 8))
+
+
+class ProcessImagesTests(TestCase):
+    def test_total_atoms_kept(self):
+        # total_atoms is only filled in where it is empty
+        with tempfile.TemporaryDirectory() as root:
+            np.save(os.path.join(root, 'atoms.npy'), np.full((4, 4), 2.5))
+            lab = Lab.objects.create(name='statslab')
+            fitted = Image.objects.create(lab=lab, name='fitted', atomsperpixel='atoms.npy', total_atoms=5)
+            empty = Image.objects.create(lab=lab, name='empty', atomsperpixel='atoms.npy')
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                processed = process_batch(list(pending_images(Image.objects.filter(lab=lab))), executor, root=root)
+        self.assertEqual(processed, 2)
+        fitted.refresh_from_db()
+        empty.refresh_from_db()
+        self.assertEqual((fitted.total_atoms, fitted.stats['total_atoms']), (5, 40))
+        self.assertEqual((empty.total_atoms, empty.stats['total_atoms']), (40, 40))
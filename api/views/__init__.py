@@ -1,3 +1,5 @@
 from api.views.runviews import *
 from api.views.imageviews import *
 from api.views.otherviews import *
+from api.views.syncviews import *
+from api.views.feedviews import *
@@ -0,0 +1,51 @@
+from django.shortcuts import get_object_or_404
+from rest_framework.exceptions import ParseError
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from api.models import Lab
+from api.livefeed import broker, decode_cursor, encode_cursor
+from api.renderers import dumps
+
+
+POLL_TIMEOUT = 25 # max seconds a long-poll request waits for events, under ASGI
+WSGI_POLL_TIMEOUT = 10 # same under WSGI, where it holds a worker thread: well below the worker timeout
+SSE_HEARTBEAT = 15 # seconds between keepalive comments on an idle stream
+SSE_DURATION = 300 # seconds before a stream is closed; clients reconnect with Last-Event-ID
+SSE_RETRY = 2000 # milliseconds clients wait before reconnecting
+
+
+def sse_message(event, cursor):
+    # The cursor after the event is its id, sent back as Last-Event-ID on reconnection
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (cursor, event['event'], dumps(event).decode())
+
+
+class LiveFeedView(APIView):
+    """
+    API endpoint with a live feed of the new images and runs of a lab:
+        /feed/?lab=bec1&mode=poll&since=<cursor>   long-poll, waits for images and runs after cursor
+        /feed/?lab=bec1&mode=sse                   server-sent events, under ASGI only (api/asgi.py)
+    Under ASGI both modes are served on the event loop (api/asgi.py), this view
+    only serves the long-poll under WSGI, for up to WSGI_POLL_TIMEOUT.
+    Under ASGI the token can also be sent as ?token=<key>, for EventSource.
+    Events carry their type (new-image, new-run) and the new ids. Without since,
+    the feed starts from now. Poll again with the returned cursor.
+    """
+    def get(self, request):
+        lab = get_object_or_404(Lab, name=request.query_params.get('lab'))
+        mode = request.query_params.get('mode', 'poll')
+        if mode=='sse':
+            # A stream would hold a worker for its whole duration
+            raise ParseError(detail='Server-sent events are only served under ASGI (breadboard.asgi): use mode=poll')
+        if mode!='poll':
+            raise ParseError(detail='mode must be sse or poll')
+
+        try:
+            timeout = min(float(request.query_params.get('timeout', WSGI_POLL_TIMEOUT)), WSGI_POLL_TIMEOUT)
+        except ValueError:
+            raise ParseError(detail='timeout must be a number')
+        since = request.query_params.get('since')
+        cursor = decode_cursor(since) if since else None
+        feed = broker.feed(lab.id)
+        events, cursor, more = feed.wait(cursor or feed.current_cursor(), timeout)
+        return Response({'cursor': encode_cursor(cursor), 'more': more, 'events': events})
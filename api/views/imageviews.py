@@ -1,5 +1,4 @@
 import time
-from datetime import timedelta
 import re
 
 from django.shortcuts import render
@@ -8,14 +7,15 @@ from django.shortcuts import get_object_or_404
 from django.core.signals import request_finished, request_started
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import cache_page
-from django.utils.dateparse import parse_datetime
+from django.http import HttpResponse, HttpResponseNotModified
+from django.db import transaction
+from django.utils import timezone
 
 from rest_framework import viewsets
 from rest_framework import permissions
 from rest_framework.generics import CreateAPIView
 from rest_framework.exceptions import ParseError, NotFound
 from rest_framework.response import Response
-from rest_framework.settings import api_settings
 from rest_framework.decorators import action
 
 
@@ -23,45 +23,113 @@ from api.serializers import (
                 ImageSerializerList,
                 ImageSerializerDetail,
                 ImageQuerySerializer,
+                ImageBulkUpdateSerializer,
                 IMAGE_QUERY_MODES,
         )
 
-from api.models import Image, Run, Lab
+from api.models import Image, Lab
+from api.ingest import ingest_images, DEFAULT_DELTA
+from api.notifications import notify
+from api.cache import CachedResponseMixin, invalidate
+from api.filters import filter_parameters, JSONMerge
+from api.views.mixins import serialize_and_paginate, SparseListMixin
+from api.conditional import conditional_response
+from api.parsers import ORJSONParser
+from api.imagedata import preview_key, render_preview, ImageDataError, DEFAULT_PREVIEW_SIZE
+from api.pagination import (
+                get_paginator,
+                strip_pagination_params,
+                ImageCursorPagination,
+                OptInCursorPaginationMixin,
+        )
 
-from breadboard.secrets import secrets as secrets
+def serialize_and_paginate_queryset(queryset, request, mode='detail'):
+    # Paginate request and then serialize it 
+    # Lists of images (from NamesCreated) can only be paginated by offset
+    if isinstance(queryset, list):
+        paginator = get_paginator(request)
+    else:
+        paginator = get_paginator(request, ImageCursorPagination)
 
-import pusher
+    if mode=='list':        serializer_function = ImageSerializerList
+    elif mode=='detail':    serializer_function = ImageSerializerDetail
+    # The detail serializer nests the run of each image
+    validator_fields = ['updated', 'run__updated'] if mode=='detail' else 'updated'
 
-pusher_client = pusher.Pusher(
-  app_id=secrets.PUSHER_APP_ID,
-  key=secrets.PUSHER_KEY,
-  secret=secrets.PUSHER_SECRET,
-  cluster='us2',
-  ssl=True
-)
+    if isinstance(queryset, list):
+        return serialize_and_paginate(queryset, request, serializer_function, paginator)
+    # 304 Not Modified for polling clients when the images haven't changed
+    return conditional_response(request, queryset, validator_fields,
+                lambda: serialize_and_paginate(queryset, request, serializer_function, paginator))
 
-DEFAULT_DELTA = 7 # default delta value: range = center +- delta
 
+def get_image_queryset(lab, query, requestdata):
+    """
+    Images of lab matching a validated image query in one of the read modes
+    (Quick, DateTimeRange, Names), with the param.<key> filters of requestdata
+    """
+    query_mode = query.get('query_mode')
+    if query_mode=='Quick':
+        # Quick mode: just get all images from a lab
+        queryset = lab.images.all()
+
+    elif query_mode=='DateTimeRange':
+        # DateTimeRange mode: get images from a lab created in a time window, with runtimes
+        queryset = lab.images.select_related('run').filter(
+                    created__range=(query.get('start_datetime'), query.get('end_datetime')))
 
-# The style to use for queryset pagination.
-pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
-paginator = pagination_class()
+    elif query_mode=='Names':
+        # Names mode: get named images from a lab, and return with runtimes attached
+        namelist = query.get('namelist')
+        queryset = lab.images.select_related('run').filter(name__in= namelist)
+        if queryset.count()<len(namelist):
+            raise NotFound(detail='Not all images were found')
+        elif queryset.count()>len(namelist):
+            raise NotFound(detail='Multiple images found with the same name. Try specifying created times.')
 
+    else:
+        raise ParseError(detail='Query mode %s does not select existing images' % query_mode)
 
+    return filter_parameters(queryset, requestdata, field='run__parameters')
 
-def serialize_and_paginate_queryset(queryset, request, mode='detail'):
-    # Paginate request and then serialize it 
-    page = paginator.paginate_queryset(queryset, request)
-    context={'request': request}
 
-    if mode=='list':        serializer_function = ImageSerializerList
-    elif mode=='detail':    serializer_function = ImageSerializerDetail
+def bulk_update_images(data):
+    """
+    Apply {'update': {...}} to the images selected by {'ids': [...]}, or by
+    {'filter': {...}} (an image query, plus an optional dataset id), with a
+    single UPDATE. Returns the number of images updated.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('update'), dict):
+        raise ParseError(detail='Expected {"update": {...}} with "ids" or "filter"')
+    update = ImageBulkUpdateSerializer(data=data['update'])
+    update.is_valid(raise_exception=True)
+
+    if 'ids' in data:
+        ids = data['ids']
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            raise ParseError(detail='ids must be a list of image ids')
+        queryset = Image.objects.filter(id__in=ids)
+    elif isinstance(data.get('filter'), dict):
+        query = ImageQuerySerializer(data=data['filter'])
+        query.is_valid(raise_exception=True)
+        lab = get_object_or_404(Lab, name=query.validated_data.get('lab'))
+        queryset = get_image_queryset(lab, query.validated_data, data['filter'])
+        dataset = data['filter'].get('dataset')
+        if dataset is not None:
+            if not isinstance(dataset, int) or isinstance(dataset, bool):
+                raise ParseError(detail='dataset must be a dataset id')
+            queryset = queryset.filter(run__dataset_id=dataset)
+    else:
+        raise ParseError(detail='Select the images with "ids" or "filter"')
 
-    if page is not None:
-        serializer = serializer_function(page, many=True, context=context)
-        return paginator.get_paginated_response(serializer.data)
-    serializer = serializer_function(queryset, many=True, context=context)
-    return Response(serializer.data)
+    values = {name: JSONMerge(name, value) if name in ImageBulkUpdateSerializer.merged_fields else value
+                for name, value in update.validated_data.items()}
+    # update() doesn't apply auto_now, or send signals
+    values['updated'] = timezone.now()
+    with transaction.atomic():
+        count = queryset.select_related(None).order_by().update(**values)
+        transaction.on_commit(lambda: invalidate('Image'))
+    return count
 
 
 def handle_image_query(request, method):
@@ -78,43 +146,17 @@ def handle_image_query(request, method):
     lab_name = imagequery.validated_data.get('lab')
     namelist = imagequery.validated_data.get('namelist')
     createdlist = imagequery.validated_data.get('createdlist')
-    datetimerange = (
-                imagequery.validated_data.get('start_datetime'),
-                imagequery.validated_data.get('end_datetime'),
-            )
     force_match = imagequery.validated_data.get('force_match')
 
     lab = Lab.objects.get(name=lab_name)
 
-    if query_mode=='Quick':
-        # Quick mode: just get all images from a lab
-        queryset = lab.images.all()
-        return serialize_and_paginate_queryset(queryset, request, mode='list')
-
-    elif query_mode=='DateTimeRange':
-        # Names mode: get named images from a lab, and return with runtimes
-        lab = Lab.objects.get(name=lab_name)
-        queryset = lab.images.select_related('run').filter(created__range=datetimerange)
-        return serialize_and_paginate_queryset(queryset, request, mode='detail')
-
-    elif query_mode=='Names':
-        # Names mode: get named images from a lab, and return with runtimes attached
-        lab = Lab.objects.get(name=lab_name)
-        queryset = lab.images.select_related('run').filter(name__in= namelist)
-        if queryset.count()<len(namelist):
-            raise NotFound(detail='Not all images were found')
-        elif queryset.count()>len(namelist):
-            raise NotFound(detail='Multiple images found with the same name. Try specifying created times.')
-        return serialize_and_paginate_queryset(queryset, request, mode='detail')
+    if query_mode in ('Quick', 'DateTimeRange', 'Names'):
+        queryset = get_image_queryset(lab, imagequery.validated_data, requestdata)
+        return serialize_and_paginate_queryset(queryset, request, mode='list' if query_mode=='Quick' else 'detail')
 
     elif query_mode=='NamesCreated':
         # NamesCreated mode: Find images by name or if not found, associate run, and return with runtimes
         # Note: only this mode can create an image
-        created_times = [parse_datetime(dt) for dt in createdlist]
-        runtime_delta = timedelta(seconds=DEFAULT_DELTA)
-        runtime_range_search = [(created_time-runtime_delta, created_time+runtime_delta) for created_time in created_times]
-
-        lab = Lab.objects.get(name=lab_name)
         queryset = lab.images.select_related('run').filter(name__in=namelist)
 
         # First try to find by imagenames
@@ -124,77 +166,26 @@ def handle_image_query(request, method):
 
         else:
             # Otherwise, if forcing matching, or some images not found,
-            #   create them, and match runtimes
-            all_images = []
+            #   create them, and match runtimes in a single batch
             # Note: handling param filtering on the client side
-
-            for i in range(len(namelist)):
-                # I used to have a try/except here, now I use count() to check the queryset
-                matched_images = Image.objects.filter(
-                    name= namelist[i],
-                    lab__name= lab_name,
-                    created= createdlist[i]
-                )
-                print(matched_images.count())
-                numimages = matched_images.count()
-                if numimages>1:
-                    print('Warning: multiple images found for imagename = ' + namelist[i])
-                    # Remove copies
-                    for img in matched_images[1:]:
-                        img.delete()
-                elif numimages==0:
-                    # if image not found, make a new image:
-                    # TODO: use serializer for this part
-                    print('Creating new image object')
-                    pusher_client.trigger(lab_name, 'new-image', {'message': 'new image'})
-                    img = lab.images.create(
-                        name = namelist[i],
-                        created = createdlist[i],
-                        notes = imagequery.validated_data.get('notes'),
-                        filepath = imagequery.validated_data.get('filepath'),
-                        tags = imagequery.validated_data.get('tags'),
-                        thumbnail = imagequery.validated_data.get('thumbnail'),
-                        total_atoms = imagequery.validated_data.get('total_atoms'),
-                        odpath = imagequery.validated_data.get('odpath'),
-                        atomsperpixel = imagequery.validated_data.get('atomsperpixel'),
-                        cropi = imagequery.validated_data.get('cropi'),
-                        settings = imagequery.validated_data.get('settings'),
-                        pixel_size = imagequery.validated_data.get('pixel_size'),
-                        atom = imagequery.validated_data.get('atom'),
-                        bad_shot = imagequery.validated_data.get('bad_shot')
-                        )
-                    
-                # always pick the first result for multiple images
-                img = matched_images[0]
-
-
-                # attach a run to the image                    
-                try:
-                    found_run = Run.objects.get(runtime__range=runtime_range_search[i], lab__name= lab_name)
-                    img.run = found_run
-                    print('Run attached to image')
-                    img.save()
-                except Run.DoesNotExist:
-                    print('Warning: no run found')
-                    # raise NotFound(detail='warning: no run found')
-                except Run.MultipleObjectsReturned:
-                    found_runs = Run.objects.filter(runtime__range=runtime_range_search[i], lab__name= lab_name)
-                    img.run = found_runs[0]
-                    print('Run attached to image')
-                    img.save()
-                    # raise NotFound(detail='warning: many runs found')
-
-                all_images = all_images + [img]
-
+            image_params = {param: imagequery.validated_data.get(param) for param in ImageQuerySerializer.postparams}
+            all_images, new_images = ingest_images(lab, namelist, createdlist,
+                                        image_params=image_params, delta=DEFAULT_DELTA)
+            if new_images:
+                notify(lab_name, 'new-image', [img.id for img in new_images])
 
             return serialize_and_paginate_queryset(all_images, request, mode='detail')
 
 
 
-class ImageViewSet(viewsets.ModelViewSet):
+class ImageViewSet(CachedResponseMixin, SparseListMixin, OptInCursorPaginationMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows images to be viewed or edited
     """
+    cursor_pagination_class = ImageCursorPagination
+    cache_namespace = 'image'
+    cached_actions = ('retrieve',)
+
     def get_serializer_class(self):
         if self.action == 'list':
             return ImageSerializerList
@@ -211,9 +202,12 @@ class ImageViewSet(viewsets.ModelViewSet):
         '''
         List methods
         '''
-        if request.query_params=={}:
+        query = strip_pagination_params(request.query_params)
+        if not [k for k in query if k not in ('fields', 'exclude')]:
             # Default request
-            return super().list(request)
+            queryset = self.filter_queryset(self.get_queryset())
+            return conditional_response(request, queryset, 'updated',
+                        lambda: super(ImageViewSet, self).list(request))
         else:
             return handle_image_query(request, method='GET')
 
@@ -229,3 +223,37 @@ class ImageViewSet(viewsets.ModelViewSet):
             return super().create(request)
         else:
             return handle_image_query(request, method='POST')
+
+
+    @action(detail=False, methods=['post'], parser_classes=[ORJSONParser])
+    def bulk_update(self, request):
+        '''
+        Update many images with one statement:
+            {"ids": [1, 2], "update": {"bad_shot": true}}
+            {"filter": {"lab": "bec1", "names": "a,b"}, "update": {"tags": {"good": true}}}
+        tags and settings are merged into the existing ones, other fields replaced.
+        '''
+        return Response({'count': bulk_update_images(request.data)})
+
+    @action(detail=True, methods=['get'])
+    def preview(self, request, pk=None):
+        '''
+        Downscaled PNG of the image file: ?kind=raw|od|atoms&size=<longest side in pixels>
+        '''
+        image = self.get_object()
+        try:
+            size = int(request.query_params.get('size', DEFAULT_PREVIEW_SIZE))
+        except ValueError:
+            raise ParseError(detail='size must be an integer')
+        try:
+            path, key, size = preview_key(image, kind=request.query_params.get('kind', 'raw'), size=size)
+            etag = '"%s"' % key
+            if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+                return HttpResponseNotModified()
+            content = render_preview(path, key, size)
+        except ImageDataError as e:
+            raise NotFound(detail=str(e))
+        response = HttpResponse(content, content_type='image/png')
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, max-age=3600'
+        return response
@@ -0,0 +1,37 @@
+from rest_framework.response import Response
+
+from api.serializers import sparse_queryset, lean_queryset, lean_rows
+
+
+def serialize_and_paginate(queryset, request, serializer_class, paginator, context=None):
+    """
+    Paginate a queryset and serialize the page, with sparse fieldsets (?fields=, ?exclude=)
+    pushed down to the queryset, and the lean path for lists of plain columns.
+    Lists of objects are paginated and serialized as they are.
+    """
+    context = context if context is not None else {'request': request}
+    lean_names = None
+    if not isinstance(queryset, list):
+        lean, lean_names = lean_queryset(queryset, serializer_class, request,
+                                ordering=getattr(paginator, 'ordering', None) or ())
+        queryset = lean if lean is not None else sparse_queryset(queryset, serializer_class, request)
+
+    page = paginator.paginate_queryset(queryset, request) if paginator is not None else None
+    rows = page if page is not None else queryset
+    if lean_names is not None:
+        data = lean_rows(rows, lean_names)
+    else:
+        data = serializer_class(rows, many=True, context=context).data
+    if page is not None:
+        return paginator.get_paginated_response(data)
+    return Response(data)
+
+
+class SparseListMixin:
+    """
+    ViewSet mixin whose list action supports sparse fieldsets and the lean path
+    """
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        return serialize_and_paginate(queryset, request, self.get_serializer_class(),
+                    self.paginator, context=self.get_serializer_context())
@@ -6,8 +6,10 @@ from django.contrib.auth.models import User, Group
 from django.shortcuts import get_object_or_404
 from rest_framework import permissions
 from rest_framework.generics import CreateAPIView
+from rest_framework.views import APIView
 from rest_framework.exceptions import ParseError
 from rest_framework.response import Response
+from rest_framework.decorators import action
 from django.core.signals import request_finished, request_started
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import cache_page
@@ -29,6 +31,11 @@ from api.serializers import (
         )
 
 from api.models import UserProfile, Image, Run, Dataset, Project, Lab
+from api.export import export_runs_response
+from api.columns import columns_response
+from api.aggregate import aggregate_response
+from api.cache import CachedResponseMixin
+from api.middleware import request_stats
 
 
 
@@ -41,6 +48,22 @@ class CreateUserView(CreateAPIView):
     serializer_class = UserSerializer
 
 
+class StatsView(APIView):
+    """
+    API endpoint with per view latency and query stats of this server process (admins only)
+    """
+    permission_classes = [
+        permissions.IsAdminUser
+    ]
+
+    def get(self, request):
+        return Response(request_stats.summary())
+
+    def delete(self, request):
+        request_stats.reset()
+        return Response(status=204)
+
+
 class UserViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited
@@ -62,32 +85,76 @@ class GroupViewSet(viewsets.ModelViewSet):
     queryset = Group.objects.all()
     serializer_class = GroupSerializer
 
-class DatasetViewSet(viewsets.ModelViewSet):
+class DatasetViewSet(CachedResponseMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows groups of runs (datasets) to be viewed or edited
     """
+    cache_namespace = 'dataset'
     queryset = Dataset.objects.all()
     serializer_class = DatasetSerializer
     filter_backends = (filters.SearchFilter, DjangoFilterBackend)
     filterset_fields = ('name', 'lab__name')
     search_fields = ('name', 'notes')
 
-class ProjectViewSet(viewsets.ModelViewSet):
+    def get_queryset(self):
+        # Related ids (or counts, with ?related=count) for all objects in a single query
+        queryset = super().get_queryset()
+        if self.action in ('export', 'columns', 'aggregate'):
+            # These actions query the runs themselves
+            return queryset
+        return DatasetSerializer.prefetch_queryset(queryset, self.request).select_related('summary')
+
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        '''
+        Stream the runs in the dataset as NDJSON or CSV (?output=ndjson|csv)
+        '''
+        dataset = self.get_object()
+        return export_runs_response(dataset.runs.all(), request, filename='dataset-%d' % dataset.id)
+
+    @action(detail=True, methods=['get'])
+    def columns(self, request, pk=None):
+        '''
+        Runtimes, ids and parameters of the runs in the dataset as arrays (?output=json|npz|arrow)
+        '''
+        dataset = self.get_object()
+        return columns_response(dataset.runs.all(), request)
+
+    @action(detail=True, methods=['get'])
+    def aggregate(self, request, pk=None):
+        '''
+        Statistics of image values grouped by run parameters
+        (?group_by=TOF&values=total_atoms,settings.fudge&bad_shots=include)
+        '''
+        dataset = self.get_object()
+        return aggregate_response(Image.objects.filter(run__dataset=dataset), request)
+
+class ProjectViewSet(CachedResponseMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows groups of datasets (projects) to be viewed or edited
     """
+    cache_namespace = 'project'
     queryset = Project.objects.all()
     serializer_class = ProjectSerializer
     filter_backends = (filters.SearchFilter, DjangoFilterBackend)
     filterset_fields = ('name', 'lab__name')
     search_fields = ('name', 'notes')
 
-class LabViewSet(viewsets.ModelViewSet):
+    def get_queryset(self):
+        # Related ids (or counts, with ?related=count) for all objects in a single query
+        return ProjectSerializer.prefetch_queryset(super().get_queryset(), self.request)
+
+class LabViewSet(CachedResponseMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows groups of users and datasets (labs) to be viewed or edited
     """
+    cache_namespace = 'lab'
     queryset = Lab.objects.all()
     serializer_class = LabSerializer
     filter_backends = (filters.SearchFilter, DjangoFilterBackend)
     filterset_fields = ('name',)
     search_fields = ('name',)
+
+    def get_queryset(self):
+        # Related ids (or counts, with ?related=count) for all objects in a single query
+        return LabSerializer.prefetch_queryset(super().get_queryset(), self.request)
@@ -1,13 +1,15 @@
 import time
 
+from django.db import transaction
 from django.shortcuts import render
 from rest_framework import viewsets
 from django.contrib.auth.models import User, Group
 from django.shortcuts import get_object_or_404
 from rest_framework import permissions
 from rest_framework.generics import CreateAPIView
-from rest_framework.exceptions import ParseError
+from rest_framework.exceptions import ParseError, ValidationError
 from rest_framework.response import Response
+from rest_framework.decorators import action
 from django.core.signals import request_finished, request_started
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import cache_page
@@ -15,15 +17,65 @@ from django.views.decorators.cache import cache_page
 from api.serializers import (
                 RunSerializerList,
                 RunSerializerDetail,
+                RunBulkSerializer,
         )
 
-from api.models import Run
+from api.models import Run, Lab, Dataset
+from api.parsers import ORJSONParser, NDJSONParser
+from api.pagination import RunCursorPagination, OptInCursorPaginationMixin
+from api.export import export_runs_response
+from api.cache import CachedResponseMixin, invalidate
+from api.summaries import add_runs
+from api.filters import filter_parameters
+from api.views.mixins import SparseListMixin
+from api.conditional import conditional_response
 
 
-class RunViewSet(viewsets.ModelViewSet):
+BULK_BATCH_SIZE = 1000 # runs per insert statement
+
+
+def check_related_ids(model, ids):
+    # Check that all the ids exist, with a single query
+    ids = set(i for i in ids if i is not None)
+    missing = ids - set(model.objects.filter(id__in=ids).values_list('id', flat=True))
+    if missing:
+        raise ValidationError({model._meta.model_name: 'Not found: ' + ', '.join(str(i) for i in sorted(missing))})
+
+
+def bulk_create_runs(items):
+    """
+    Validate a list of runs and insert them in batches within one transaction.
+    Returns the created runs.
+    """
+    if not isinstance(items, list):
+        raise ParseError(detail='Expected a list of runs')
+    serializer = RunBulkSerializer(data=items, many=True)
+    serializer.is_valid(raise_exception=True)
+    check_related_ids(Lab, [run.get('lab') for run in serializer.validated_data])
+    check_related_ids(Dataset, [run.get('dataset') for run in serializer.validated_data])
+
+    runs = []
+    for data in serializer.validated_data:
+        data = dict(data)
+        lab_id = data.pop('lab', None)
+        dataset_id = data.pop('dataset', None)
+        runs.append(Run(lab_id=lab_id, dataset_id=dataset_id, **data))
+    with transaction.atomic():
+        Run.objects.bulk_create(runs, batch_size=BULK_BATCH_SIZE)
+        add_runs(runs)
+        # bulk_create doesn't send signals: invalidate cached responses here
+        transaction.on_commit(lambda: invalidate('Run'))
+    return runs
+
+
+class RunViewSet(CachedResponseMixin, SparseListMixin, OptInCursorPaginationMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows runs to be viewed or edited
     """
+    cursor_pagination_class = RunCursorPagination
+    cache_namespace = 'run'
+    cached_actions = ('retrieve',)
+
     def get_serializer_class(self):
         if self.action == 'list':
             return RunSerializerList
@@ -33,11 +85,29 @@ class RunViewSet(viewsets.ModelViewSet):
 
     # Cache page for the requested url
     def list(self, request):
-        return super().list(request)
+        # 304 Not Modified for polling clients when the runs haven't changed
+        queryset = self.filter_queryset(self.get_queryset())
+        return conditional_response(request, queryset, 'updated',
+                    lambda: super(RunViewSet, self).list(request))
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        '''
+        Stream all the runs matching the query as NDJSON or CSV (?output=ndjson|csv)
+        '''
+        return export_runs_response(self.get_queryset(), request)
+
+    @action(detail=False, methods=['post'], parser_classes=[ORJSONParser, NDJSONParser])
+    def bulk(self, request):
+        '''
+        Create many runs at once, from a JSON list or NDJSON (one run per line)
+        '''
+        runs = bulk_create_runs(request.data)
+        return Response({'count': len(runs), 'ids': [run.id for run in runs]}, status=201)
 
     def get_queryset(self):
         """
-        Restricts queries by lab and/or a datetime range 
+        Restricts queries by lab and/or a datetime range, and by parameters (see api/filters.py)
         """
         queryset = Run.objects.all()
         filter_dirty = {
@@ -54,4 +124,7 @@ class RunViewSet(viewsets.ModelViewSet):
 
         if len(filter_clean) is not 0:
             queryset = queryset.filter(**filter_clean)
+
+        # Filters on parameters: ?param.TOF__gte=2&param.evap=90
+        queryset = filter_parameters(queryset, self.request.query_params)
         return queryset
@@ -0,0 +1,145 @@
+import base64
+import binascii
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import APIException, ParseError
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from api.serializers import (
+                ImageSerializerList,
+                RunSerializerList,
+                DatasetSerializer,
+        )
+
+from api.models import Image, Run, Dataset, Lab, Tombstone
+from breadboard.db.routers import primary
+
+
+SYNC_LIMIT = 1000 # default and max number of changes per kind in a response
+SYNC_LAG = timedelta(seconds=10) # changes more recent than this may still be committing
+# Tombstones older than this are deleted (python manage.py prune_tombstones), so
+# tokens which haven't seen every deletion up to then can't be synced from
+TOMBSTONE_RETENTION = timedelta(days=getattr(settings, 'BREADBOARD_TOMBSTONE_RETENTION_DAYS', 30))
+
+# kind: (model, serializer, field ordering the changes)
+SYNC_KINDS = {
+    'images': (Image, ImageSerializerList, 'updated'),
+    'runs': (Run, RunSerializerList, 'updated'),
+    'datasets': (Dataset, DatasetSerializer, 'updated'),
+    'deleted': (Tombstone, None, 'deleted'),
+}
+
+
+class SyncTokenExpired(APIException):
+    status_code = 410
+    default_detail = 'The sync token is older than the deletions kept: sync again without a token.'
+    default_code = 'sync_token_expired'
+
+
+def encode_token(positions, synced):
+    data = dict(positions, synced=synced)
+    data = json.dumps(data, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def parse_position(position):
+    changed = parse_datetime(position[0])
+    if changed is None:
+        raise ValueError('Invalid datetime')
+    return changed, int(position[1])
+
+
+def decode_token(token):
+    """
+    ({kind: (datetime, id)} of the last change seen for each kind, datetime up to which
+    every deletion was seen). Raises SyncTokenExpired if tombstones since then were pruned.
+    """
+    if not token:
+        return {}, None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token.encode()))
+        positions = {kind: parse_position(position) for kind, position in data.items() if kind in SYNC_KINDS}
+        synced = parse_datetime(data['synced'])
+        if synced is None:
+            raise ValueError('Invalid datetime')
+    except (ValueError, TypeError, KeyError, IndexError, AttributeError, binascii.Error):
+        raise ParseError(detail='Invalid sync token')
+    if synced < timezone.now() - TOMBSTONE_RETENTION:
+        raise SyncTokenExpired()
+    return positions, synced
+
+
+def changes_after(queryset, field, position, limit, horizon):
+    """
+    Rows changed after position (a (datetime, id) pair), in order of change.
+    Returns (rows, new position, more). The position only moves past rows
+    older than horizon, so rows still being committed are sent again next time.
+    """
+    if position is not None:
+        changed, last_id = position
+        queryset = queryset.filter(Q(**{field + '__gt': changed}) | Q(**{field: changed, 'id__gt': last_id}))
+    rows = list(queryset.order_by(field, 'id')[:limit+1])
+    more = len(rows) > limit
+    rows = rows[:limit]
+    settled = [row for row in rows if getattr(row, field) <= horizon]
+    if settled:
+        position = (getattr(settled[-1], field), settled[-1].id)
+    return rows, position, more and bool(settled)
+
+
+class ChangesView(APIView):
+    """
+    API endpoint with the images, runs and datasets of a lab created, modified
+    or deleted since a sync token: /changes/?lab=bec1&since=<token>
+    Without a token, everything is sent (in pages of limit changes per kind).
+    Call again with the returned token while more is true. Changes are sent at
+    least once: a change can come up again in the next response.
+    Tokens not used for TOMBSTONE_RETENTION get a 410: sync again without one.
+    """
+    def get(self, request):
+        # A lagging replica could move the positions past rows it doesn't have yet
+        with primary():
+            return self.get_changes(request)
+
+    def get_changes(self, request):
+        lab = get_object_or_404(Lab, name=request.query_params.get('lab'))
+        positions, synced = decode_token(request.query_params.get('since'))
+        try:
+            limit = min(int(request.query_params.get('limit', SYNC_LIMIT)), SYNC_LIMIT)
+        except ValueError:
+            raise ParseError(detail='limit must be an integer')
+        horizon = timezone.now() - SYNC_LAG
+        context = {'request': request}
+
+        data = {}
+        more = False
+        for kind, (model, serializer_class, field) in SYNC_KINDS.items():
+            queryset = model.objects.filter(lab=lab)
+            if hasattr(serializer_class, 'prefetch_queryset'):
+                queryset = serializer_class.prefetch_queryset(queryset, request)
+            rows, position, kind_more = changes_after(queryset, field, positions.get(kind), limit, horizon)
+            more = more or kind_more
+            if position is not None:
+                positions[kind] = position
+            if serializer_class is None:
+                # Every deletion up to the horizon was sent, unless there are more
+                synced = (position[0] if position else synced) if kind_more else horizon
+                deleted = {}
+                for tombstone in rows:
+                    deleted.setdefault(tombstone.model + 's', []).append(tombstone.object_id)
+                data[kind] = deleted
+            else:
+                data[kind] = serializer_class(rows, many=True, context=context).data
+
+        data['token'] = encode_token({kind: [changed.isoformat(), last_id]
+                                        for kind, (changed, last_id) in positions.items()},
+                                     synced.isoformat() if synced else None)
+        data['more'] = more
+        return Response(data)
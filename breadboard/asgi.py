@@ -0,0 +1,85 @@
+"""
+ASGI entry point, eg. `gunicorn -k uvicorn.workers.UvicornWorker breadboard.asgi:application`
+
+Django 2.2 has no ASGI handler of its own: the api views run through the WSGI
+application, each request in a thread of api.asgi.executor (BREADBOARD_ASGI_THREADS
+threads per worker), while the event loop keeps the connections. Server-sent
+event streams of the live feed are served natively on the event loop (see api/asgi.py).
+"""
+import os
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'breadboard.settings')
+
+django_application = get_wsgi_application()
+
+from api.asgi import executor, is_live_feed, live_feed
+
+
+class PooledWsgiToAsgiInstance(WsgiToAsgiInstance):
+    """
+    WsgiToAsgiInstance running the WSGI application in executor. asgiref runs it
+    thread sensitive, in a single thread shared by every request.
+    """
+    async def run_wsgi_app(self, body):
+        await sync_to_async(self.call_wsgi_app, thread_sensitive=False, executor=executor)(body)
+
+    def call_wsgi_app(self, body):
+        # As asgiref's run_wsgi_app, closing the response as PEP 3333 requires
+        # (Django sends request_finished on close)
+        environ = self.build_environ(self.scope, body)
+        response = self.wsgi_application(environ, self.start_response)
+        bytes_sent = 0
+        content_length = None
+        try:
+            for output in response:
+                if not self.response_started:
+                    self.response_started = True
+                    self.sync_send(self.response_start)
+                    content_length = next((int(value) for name, value in self.response_start['headers']
+                                           if name.lower() == b'content-length'), None)
+                # Not more than the Content-Length header allows
+                if content_length is not None:
+                    output = output[:content_length - bytes_sent]
+                self.sync_send({'type': 'http.response.body', 'body': output, 'more_body': True})
+                bytes_sent += len(output)
+                if bytes_sent == content_length:
+                    break
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+        if not self.response_started:
+            self.response_started = True
+            self.sync_send(self.response_start)
+        self.sync_send({'type': 'http.response.body'})
+
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+
+    async def __call__(self, scope, receive, send):
+        await PooledWsgiToAsgiInstance(self.wsgi_application)(scope, receive, send)
+
+
+wsgi_application = PooledWsgiToAsgi(django_application)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif is_live_feed(scope):
+        await live_feed(scope, receive, send)
+    else:
+        await wsgi_application(scope, receive, send)
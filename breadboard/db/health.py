@@ -0,0 +1,39 @@
+"""
+Health checks of persistent database connections.
+
+With CONN_MAX_AGE, connections outlive requests, and the server (or the Cloud
+SQL proxy) may drop them while idle. Before a request, connections idle for
+more than CONN_HEALTH_CHECK_AFTER seconds are checked, and closed when
+unusable, so that Django reconnects instead of failing the request.
+Connections in use by the previous request are trusted without a query.
+"""
+import time
+
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db import connections
+
+
+CONN_HEALTH_CHECK_AFTER = getattr(settings, 'BREADBOARD_CONN_HEALTH_CHECK_AFTER', 30)
+
+
+def check_connections(**kwargs):
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is None or connection.in_atomic_block:
+            continue
+        idle = now - getattr(connection, 'breadboard_last_used', now)
+        if idle > CONN_HEALTH_CHECK_AFTER and not connection.is_usable():
+            connection.close()
+
+
+def mark_connections_used(**kwargs):
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is not None:
+            connection.breadboard_last_used = now
+
+
+def connect_health_checks():
+    request_started.connect(check_connections, dispatch_uid='breadboard-db-health-check')
+    request_finished.connect(mark_connections_used, dispatch_uid='breadboard-db-last-used')
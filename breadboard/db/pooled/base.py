@@ -0,0 +1,83 @@
+"""
+Postgres backend with an in-process connection pool.
+
+Use it with 'ENGINE': 'breadboard.db.pooled' and the pool settings in the
+database settings, eg. 'POOL': {'min': 1, 'max': 10, 'timeout': 10}.
+Closing a connection (at the end of every request when CONN_MAX_AGE is 0)
+returns it to the pool instead of closing the socket, so requests reuse warm
+connections. At most max connections are open per process and database: a
+request waits up to timeout seconds for a free one.
+"""
+import threading
+
+from django.db.backends.postgresql import base
+from psycopg2 import extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+
+POOL_DEFAULTS = {'min': 1, 'max': 10, 'timeout': 10}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """
+    ThreadedConnectionPool, waiting for a free connection when all are in use
+    """
+    def __init__(self, minconn, maxconn, timeout, **params):
+        self.pool = ThreadedConnectionPool(minconn, maxconn, **params)
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.timeout = timeout
+
+    def getconn(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise base.Database.OperationalError(
+                    'No database connection available in the pool after %s seconds' % self.timeout)
+        try:
+            return self.pool.getconn()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def putconn(self, connection, close=False):
+        try:
+            self.pool.putconn(connection, close=close)
+        finally:
+            self.slots.release()
+
+
+def get_pool(alias, pool_settings, params):
+    with _pools_lock:
+        if alias not in _pools:
+            pool_settings = dict(POOL_DEFAULTS, **pool_settings)
+            _pools[alias] = ConnectionPool(pool_settings['min'], pool_settings['max'], pool_settings['timeout'], **params)
+        return _pools[alias]
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_new_connection(self, conn_params):
+        pool = get_pool(self.alias, self.settings_dict.get('POOL', {}), conn_params)
+        connection = pool.getconn()
+        if connection.closed:
+            # closed by the server while in the pool
+            pool.putconn(connection, close=True)
+            connection = pool.getconn()
+        # As the postgresql backend
+        options = self.settings_dict['OPTIONS']
+        self.isolation_level = options.get('isolation_level', connection.isolation_level)
+        if self.isolation_level != connection.isolation_level:
+            connection.set_session(isolation_level=self.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        pool = get_pool(self.alias, self.settings_dict.get('POOL', {}), self.get_connection_params())
+        broken = self.connection.closed or self.errors_occurred
+        if not broken and self.connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            # Don't hand an open transaction to the next request
+            with self.wrap_database_errors:
+                self.connection.rollback()
+        pool.putconn(self.connection, close=broken)
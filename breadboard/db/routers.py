@@ -0,0 +1,104 @@
+"""
+Read replica routing.
+
+ReplicaRouter sends the reads of safe (GET, HEAD, OPTIONS) requests, ie. the
+list and retrieve actions of the viewsets, to the read replicas listed in
+settings.DATABASE_REPLICAS, and everything else to the primary ('default').
+ReplicaMiddleware tells the router which kind of request is being handled.
+
+Replicas lag behind the primary: after a write, a client is pinned to the
+primary for REPLICA_PIN_SECONDS, so that it reads its own writes. Clients are
+pinned by their credentials (token or session) in the cache, which must be
+shared by the workers (BREADBOARD_CACHE=redis), and with a cookie.
+Views which must see every committed row (cached responses, sync) read from the
+primary in a `with primary():` block.
+"""
+import hashlib
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+
+REPLICA_PIN_COOKIE = 'breadboard_primary'
+REPLICA_PIN_SECONDS = getattr(settings, 'BREADBOARD_REPLICA_PIN_SECONDS', 5)
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_state = threading.local()
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def use_replica(value):
+    _state.use_replica = value
+
+
+@contextmanager
+def primary():
+    # Reads in the block go to the primary
+    previous = getattr(_state, 'use_replica', False)
+    use_replica(False)
+    try:
+        yield
+    finally:
+        use_replica(previous)
+
+
+def pin_key(request):
+    # Token clients send no cookies: pin the credentials
+    credentials = request.META.get('HTTP_AUTHORIZATION') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if not credentials:
+        return None
+    return 'db:replica-pin:' + hashlib.sha1(credentials.encode()).hexdigest()
+
+
+def is_pinned(request):
+    if REPLICA_PIN_COOKIE in request.COOKIES:
+        return True
+    key = pin_key(request)
+    return key is not None and cache.get(key) is not None
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if not getattr(_state, 'use_replica', False) or not replicas():
+            return 'default'
+        if connections['default'].in_atomic_block:
+            # Reads within a transaction see its writes
+            return 'default'
+        return random.choice(replicas())
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+class ReplicaMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        use_replica(request.method in SAFE_METHODS and bool(replicas()) and not is_pinned(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            use_replica(False)
+        if request.method not in SAFE_METHODS and replicas():
+            key = pin_key(request)
+            if key is not None:
+                cache.set(key, 1, REPLICA_PIN_SECONDS)
+            response.set_cookie(REPLICA_PIN_COOKIE, '1', max_age=REPLICA_PIN_SECONDS, httponly=True)
+        return response
@@ -34,9 +34,12 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.QueryStatsMiddleware',
+    'breadboard.db.routers.ReplicaMiddleware',
     'corsheaders.middleware.CorsMiddleware',
-    'django.middleware.common.CommonMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'api.middleware.CompressionMiddleware',
+    'django.middleware.http.ConditionalGetMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -89,9 +92,69 @@ if os.getenv('GAE_INSTANCE'):
     pass
 else:
     DATABASES['default']['HOST'] = '127.0.0.1'
+
+# Connection management (see breadboard/db/). Connections persist for
+# BREADBOARD_CONN_MAX_AGE seconds, and are checked before reuse when idle for
+# BREADBOARD_CONN_HEALTH_CHECK_AFTER seconds. BREADBOARD_DB_POOL=<max> uses an
+# in-process pool instead, with up to max connections per process.
+DATABASES['default']['CONN_MAX_AGE'] = int(os.getenv('BREADBOARD_CONN_MAX_AGE', 60))
+BREADBOARD_CONN_HEALTH_CHECK_AFTER = int(os.getenv('BREADBOARD_CONN_HEALTH_CHECK_AFTER', 30))
+if os.getenv('BREADBOARD_DB_POOL'):
+    DATABASES['default']['ENGINE'] = 'breadboard.db.pooled'
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['POOL'] = {'max': int(os.getenv('BREADBOARD_DB_POOL'))}
+
+# Read replicas: BREADBOARD_DB_REPLICAS is a comma separated list of hosts.
+# Reads of GET requests go to the replicas, everything else to the primary.
+DATABASE_REPLICAS = []
+for i, host in enumerate(filter(None, os.getenv('BREADBOARD_DB_REPLICAS', '').split(','))):
+    DATABASES['replica%d' % i] = dict(DATABASES['default'], HOST=host.strip(), TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append('replica%d' % i)
+DATABASE_ROUTERS = ['breadboard.db.routers.ReplicaRouter']
+BREADBOARD_REPLICA_PIN_SECONDS = int(os.getenv('BREADBOARD_REPLICA_PIN_SECONDS', 5))
 # [END dbconfig]
 
 
+# Cache for api responses (see api/cache.py). BREADBOARD_CACHE selects the backend:
+# locmem (default, per process), file (shared by the processes on a host), or
+# redis (needs django-redis). BREADBOARD_CACHE_LOCATION is the directory or url.
+CACHE_BACKENDS = {
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+    'redis': 'django_redis.cache.RedisCache',
+}
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKENDS[os.getenv('BREADBOARD_CACHE', 'locmem')],
+        'LOCATION': os.getenv('BREADBOARD_CACHE_LOCATION', 'breadboard'),
+    }
+}
+BREADBOARD_CACHE_TIMEOUT = int(os.getenv('BREADBOARD_CACHE_TIMEOUT', 60*5))
+# Api responses are cached (see api/cache.py) only when the cache is shared by
+# every worker and instance: locmem is per process, and the file cache per host.
+# Set BREADBOARD_RESPONSE_CACHE=1 to cache with them anyway, eg. with a single process.
+BREADBOARD_RESPONSE_CACHE = os.getenv('BREADBOARD_RESPONSE_CACHE',
+                                      '1' if os.getenv('BREADBOARD_CACHE')=='redis' else '0') == '1'
+
+# Requests slower than this are logged with their queries (see api/middleware.py)
+BREADBOARD_SLOW_REQUEST_MS = int(os.getenv('BREADBOARD_SLOW_REQUEST_MS', 1000))
+
+# Threads per worker running the api views under ASGI (see breadboard/asgi.py)
+BREADBOARD_ASGI_THREADS = int(os.getenv('BREADBOARD_ASGI_THREADS', 16))
+
+# Tombstones of deleted objects are kept this long for /changes/ (see
+# api/views/syncviews.py): run `python manage.py prune_tombstones` daily.
+BREADBOARD_TOMBSTONE_RETENTION_DAYS = int(os.getenv('BREADBOARD_TOMBSTONE_RETENTION_DAYS', 30))
+
+# Image previews (see api/imagedata.py): BREADBOARD_IMAGE_ROOT is where the lab
+# file server is mounted, and previews are cached in BREADBOARD_PREVIEW_CACHE_DIR,
+# up to BREADBOARD_PREVIEW_CACHE_MB.
+BREADBOARD_IMAGE_ROOT = os.getenv('BREADBOARD_IMAGE_ROOT')
+if os.getenv('BREADBOARD_PREVIEW_CACHE_DIR'):
+    BREADBOARD_PREVIEW_CACHE_DIR = os.getenv('BREADBOARD_PREVIEW_CACHE_DIR')
+BREADBOARD_PREVIEW_CACHE_BYTES = int(os.getenv('BREADBOARD_PREVIEW_CACHE_MB', 512))*1024*1024
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
 
@@ -141,12 +204,29 @@ REST_FRAMEWORK = {
         'anon': '100/hour',
         'user': '100/second'
     },
+    'DEFAULT_RENDERER_CLASSES': (
+        'api.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'api.parsers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
     'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',),
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
     'PAGE_SIZE': 200,
 }
 
 
+# Notifications to clients (see api/notifications.py)
+BREADBOARD_NOTIFICATIONS = {
+    'BACKEND': 'api.notifications.PusherBackend',
+    'COALESCE_WINDOW': 0.05,
+    'MAX_RETRIES': 3,
+}
+
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
 
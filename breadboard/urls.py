@@ -24,4 +24,7 @@ urlpatterns = [
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     url(r'^api-token-auth/', authviews.obtain_auth_token),
     url(r'^users/register', views.CreateUserView.as_view()),
+    url(r'^stats/', views.StatsView.as_view()),
+    url(r'^changes/', views.ChangesView.as_view()),
+    url(r'^feed/', views.LiveFeedView.as_view()),
 ]